@@ -0,0 +1,130 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionRejected(Exception):
+    """Raised by :meth:`AdmissionController.admit` when a call is shed
+
+    ``reason`` is one of ``rate_limited``, ``queue_full``, ``deadline`` or
+    ``timeout``.
+    """
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class AdmissionController:
+    """Concurrency limit with a bounded wait queue and per-key token buckets
+
+    At most ``max_concurrent`` callers run at once and at most ``max_queue``
+    wait for a slot. A waiter gives up after ``queue_timeout`` seconds, and a
+    caller is turned away immediately when the expected wait (queue position
+    times the average service time) already exceeds that deadline. Each key
+    (a LINE user) may start ``rate_per_minute`` calls per minute with bursts
+    of ``burst``; ``rate_per_minute=0`` disables the per-key limit.
+    """
+
+    def __init__(self, max_concurrent: int = 4, max_queue: int = 16, queue_timeout: float = 5.0,
+                 rate_per_minute: float = 0.0, burst: int = 3, max_keys: int = 10000):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.rate_per_second = rate_per_minute / 60.0
+        self.burst = max(1, burst)
+        self.max_keys = max_keys
+        self._condition = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self._buckets = OrderedDict()  # key -> (tokens, เวลาที่เติมล่าสุด), เรียงจากใช้ล่าสุดน้อยที่สุด
+        self._service_seconds = None  # ค่าเฉลี่ยแบบ EWMA ของเวลาที่ใช้ต่อการเรียก
+        self._stats = {"admitted": 0, "queued": 0, "rate_limited": 0, "queue_full": 0, "deadline": 0, "timeout": 0}
+
+    @property
+    def queue_depth(self) -> int:
+        return self._waiting
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    def _take_token(self, key) -> bool:
+        if not self.rate_per_second or key is None:
+            return True
+        now = time.monotonic()
+        tokens, last = self._buckets.pop(key, (float(self.burst), now))
+        tokens = min(float(self.burst), tokens + (now - last) * self.rate_per_second)
+        allowed = tokens >= 1.0
+        self._buckets[key] = (tokens - 1.0 if allowed else tokens, now)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return allowed
+
+    def charge(self, key) -> bool:
+        """Take a rate token from ``key`` for a call admitted without one; returns False if none was left"""
+        with self._condition:
+            return self._take_token(key)
+
+    def _reject(self, reason: str):
+        self._stats[reason] += 1
+        raise AdmissionRejected(reason)
+
+    def _acquire(self, key):
+        with self._condition:
+            if not self._take_token(key):
+                self._reject("rate_limited")
+            if self._active < self.max_concurrent and not self._waiting:
+                self._active += 1
+                self._stats["admitted"] += 1
+                return
+            if self._waiting >= self.max_queue:
+                self._reject("queue_full")
+            if self._service_seconds is not None:
+                expected_wait = (self._waiting + 1) * self._service_seconds / self.max_concurrent
+                if expected_wait > self.queue_timeout:
+                    self._reject("deadline")
+
+            self._waiting += 1
+            self._stats["queued"] += 1
+            deadline = time.monotonic() + self.queue_timeout
+            try:
+                while self._active >= self.max_concurrent:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._reject("timeout")
+                    self._condition.wait(remaining)
+            finally:
+                self._waiting -= 1
+            self._active += 1
+            self._stats["admitted"] += 1
+
+    def _release(self, elapsed: float):
+        with self._condition:
+            self._active -= 1
+            self._service_seconds = elapsed if self._service_seconds is None else \
+                0.8 * self._service_seconds + 0.2 * elapsed
+            self._condition.notify_all()
+
+    @contextmanager
+    def admit(self, key=None):
+        """Hold a slot for the duration of the block; raises :class:`AdmissionRejected` instead of waiting too long"""
+        self._acquire(key)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(time.monotonic() - start)
+
+    def get_stats(self) -> Dict:
+        with self._condition:
+            stats = dict(self._stats)
+            stats["active"] = self._active
+            stats["queue_depth"] = self._waiting
+            stats["avg_service_ms"] = self._service_seconds * 1000 if self._service_seconds is not None else None
+        return stats
@@ -1,24 +1,33 @@
 import os
-import json
 import logging
 import re
+import threading
 from datetime import datetime
-from flask import Flask, request, abort, jsonify
+from flask import Flask, Response, request, abort, jsonify
 from dotenv import load_dotenv  
 from linebot.v3 import WebhookHandler
 from linebot.v3.messaging import Configuration, ApiClient, MessagingApi
 from linebot.v3.webhooks import MessageEvent, TextMessageContent
-from linebot.v3.messaging import (
-    TextMessage, FlexMessage, QuickReply, QuickReplyItem, MessageAction
-)
+from linebot.v3.messaging import TextMessage
 from linebot.v3.exceptions import InvalidSignatureError
 from google.protobuf.json_format import MessageToDict
 
-from retriever import search_from_documents
-from dialogflow import detect_intent_texts
+from retriever import (
+    search_from_documents, start_speculative_search, get_cache_stats, get_llm_admission_stats, encode_texts,
+    warm_up_rag, get_rag_stats
+)
+from dialogflow import (
+    detect_intent_texts, init_clients as init_dialogflow_clients, get_stats as get_dialogflow_stats,
+    warm_up as warm_up_dialogflow
+)
+from ollama_client import get_client as get_ollama_client
+from warmup import WarmUp
+from worker_pool import KeyedWorkerPool
+from intent_classifier import LocalIntentClassifier
+import metrics
 from message import (
-    process_payload, create_flex_message,
-    send_multiple_messages, send_text_message
+    translate_query_result, translate_query_result_dict, describe_query_result,
+    get_message_cache_stats, send_multiple_messages, send_text_message
 )
 
 # โหลด environment variables จากไฟล์ .env
@@ -45,16 +54,47 @@ if not LINE_CHANNEL_SECRET:
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = GOOGLE_APPLICATION_CREDENTIALS
 SESSION_ID = "line-bot-session"
 
+# โหมดตอบรับ webhook ทันทีแล้วประมวลผลใน worker pool เบื้องหลัง
+WEBHOOK_ASYNC = os.getenv("WEBHOOK_ASYNC", "false").lower() in ("1", "true", "yes")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS") or 8)
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE") or 100)
+
+# จำแนก intent ในเครื่องจากคำตอบของ Dialogflow ที่เคยได้ (หรือจากไฟล์ export ของ agent)
+# แล้วตอบจากคำตอบที่เก็บไว้โดยไม่เรียก Dialogflow เมื่อมั่นใจพอ
+INTENT_CLASSIFIER = os.getenv("INTENT_CLASSIFIER", "false").lower() in ("1", "true", "yes")
+INTENT_CLASSIFIER_PATH = os.getenv("INTENT_CLASSIFIER_PATH") or None
+INTENT_CLASSIFIER_THRESHOLD = float(os.getenv("INTENT_CLASSIFIER_THRESHOLD") or 0.92)
+INTENT_CLASSIFIER_MIN_EXAMPLES = int(os.getenv("INTENT_CLASSIFIER_MIN_EXAMPLES") or 2)
+INTENT_AGENT_EXPORT = os.getenv("INTENT_AGENT_EXPORT") or None
+# อายุของคำตอบ intent ที่เก็บไว้ (วินาที) เกินแล้วถาม Dialogflow ใหม่ เพื่อรับคำตอบที่แก้ใน console
+INTENT_RESPONSE_TTL = float(os.getenv("INTENT_RESPONSE_TTL") or 3600)
+
+# เตรียม encoder, index, โมเดลของ Ollama และ channel ของ Dialogflow ตอนเริ่มระบบ แทนการให้ผู้ใช้คนแรกรอ
+# WARMUP_MODE: background (รันเบื้องหลัง /ready ตอบ 503 จนเสร็จ), blocking (รอให้เสร็จก่อนรับคำขอ) หรือ off
+WARMUP_MODE = (os.getenv("WARMUP_MODE") or "background").lower()
+WARMUP_OLLAMA = os.getenv("WARMUP_OLLAMA", "true").lower() in ("1", "true", "yes")
+WARMUP_RETRY_SECONDS = float(os.getenv("WARMUP_RETRY_SECONDS") or 30)
+
 # Flask App
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = app.logger
 
 # Line Bot
-configuration = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
+# LINE_API_HOST ใช้ชี้ไปยัง server จำลองตอนทดสอบโหลด (benchmark_e2e.py)
+configuration = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN, host=os.getenv("LINE_API_HOST") or None)
 handler = WebhookHandler(LINE_CHANNEL_SECRET)
 api_client = ApiClient(configuration)
 line_bot_api = MessagingApi(api_client)
+# สร้าง Dialogflow client ครั้งเดียวตอนเริ่มระบบ แทนการสร้างใหม่ทุกข้อความ
+try:
+    init_dialogflow_clients()
+except Exception as e:
+    logger.error(f"ไม่สามารถสร้าง Dialogflow client ได้: {str(e)}")
+
+event_pool = KeyedWorkerPool(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE, name="webhook") if WEBHOOK_ASYNC else None
+if event_pool is not None:
+    metrics.gauge("linebot_webhook_queue_depth", "Events waiting for a webhook worker", event_pool.qsize)
 
 # คำตอบที่ไม่ต้องการจาก Dialogflow (หากได้คำตอบเหล่านี้จะถือว่า Dialogflow ไม่สามารถตอบคำถามได้)
 INVALID_DIALOGFLOW_RESPONSES = [
@@ -65,6 +105,88 @@ INVALID_DIALOGFLOW_RESPONSES = [
     "พูดอีกทีได้ไหมคะ" 
 ]
 
+intent_classifier = None
+_intent_classifier_lock = threading.Lock()
+
+def get_intent_classifier():
+    """
+    สร้าง intent classifier เมื่อใช้ครั้งแรก (ต้องรอ encoder ของระบบค้นเอกสารพร้อมก่อน) คืนค่า None เมื่อปิดใช้งาน
+    """
+    global intent_classifier
+    if not INTENT_CLASSIFIER:
+        return None
+    if intent_classifier is None:
+        with _intent_classifier_lock:
+            if intent_classifier is None:
+                classifier = LocalIntentClassifier(
+                    encode_texts,
+                    threshold=INTENT_CLASSIFIER_THRESHOLD,
+                    min_examples=INTENT_CLASSIFIER_MIN_EXAMPLES,
+                    path=INTENT_CLASSIFIER_PATH,
+                    invalid_texts=INVALID_DIALOGFLOW_RESPONSES,
+                    response_ttl=INTENT_RESPONSE_TTL
+                )
+                if INTENT_AGENT_EXPORT:
+                    classifier.load_agent_export(INTENT_AGENT_EXPORT)
+                intent_classifier = classifier
+    return intent_classifier
+
+def warm_up_intent_classifier():
+    """
+    โหลดตัวอย่างของ intent classifier (encode ทั้งหมดครั้งเดียว) ก่อนคำขอแรก
+    """
+    classifier = get_intent_classifier()
+    if classifier is not None:
+        classifier.classify("ทดสอบระบบ")
+    return True
+
+def create_warm_up():
+    """
+    ขั้นตอน warm-up ของแต่ละส่วน ระบบค้นเอกสารและ Dialogflow ต้องพร้อมก่อนรับคำขอ
+    ส่วน Ollama และ intent classifier ไม่บังคับ (ถ้าล้มเหลวบอทยังตอบจาก Dialogflow และเอกสารได้)
+    """
+    warm = WarmUp(retry_interval=WARMUP_RETRY_SECONDS)
+    warm.add("documents", warm_up_rag)
+    warm.add("dialogflow", warm_up_dialogflow)
+    if INTENT_CLASSIFIER:
+        warm.add("intent_classifier", warm_up_intent_classifier, required=False)
+    if WARMUP_OLLAMA:
+        warm.add("ollama", lambda: get_ollama_client().warm_up(prime=True), required=False)
+    return warm
+
+warm_up = create_warm_up() if WARMUP_MODE != "off" else None
+if warm_up is not None:
+    metrics.gauge("linebot_ready", "1 once start-up warm-up has finished", lambda: 1 if warm_up.ready else 0)
+    if WARMUP_MODE == "blocking":
+        warm_up.run()
+    # ส่วนที่ยังไม่ได้รัน (โหมด background) หรือล้มเหลวจะรันหรือลองใหม่เบื้องหลัง
+    warm_up.start()
+
+def classify_intent_locally(text, session_id):
+    """
+    คืนค่าคำตอบในรูปแบบเดียวกับ response ของ Dialogflow เมื่อ classifier มั่นใจ ไม่เช่นนั้นคืนค่า None
+    """
+    try:
+        classifier = get_intent_classifier()
+        if classifier is None:
+            return None
+        with metrics.timed("intent_classify"):
+            return classifier.classify(text, session_id)
+    except Exception as e:
+        logger.error(f"ไม่สามารถจำแนก intent ในเครื่องได้: {str(e)}")
+        return None
+
+def learn_intent_locally(text, response, session_id):
+    """
+    เก็บคู่คำถามและคำตอบของ Dialogflow ไว้ให้ classifier ในเครื่อง (แปลงเป็น dict เฉพาะเมื่อเปิดใช้งาน)
+    """
+    try:
+        classifier = get_intent_classifier()
+        if classifier is not None:
+            classifier.learn(text, MessageToDict(response._pb), session_id)
+    except Exception as e:
+        logger.error(f"ไม่สามารถบันทึก intent ได้: {str(e)}")
+
 @app.route("/callback", methods=['POST'])
 def callback():
     """
@@ -75,20 +197,51 @@ def callback():
     logger.info(f"ได้รับคำขอ: {body}")
 
     try:
-        handler.handle(body, signature)
+        if event_pool is None:
+            handler.handle(body, signature)
+        else:
+            # ตรวจลายเซ็นแล้วส่งเข้าคิว เพื่อตอบ 200 ให้ LINE ทันที
+            payload = handler.parser.parse(body, signature, as_payload=True)
+            for event in payload.events:
+                if not event_pool.submit(get_conversation_id(event.source), dispatch_event, event):
+                    logger.warning("คิวประมวลผลเต็ม ประมวลผลข้อความทันที")
+                    dispatch_event(event)
     except InvalidSignatureError:
         logger.error("ลายเซ็นไม่ถูกต้อง")
         abort(400)
 
     return 'OK'
 
+def get_conversation_id(source):
+    """
+    คืนค่า id ของห้องสนทนา (group/room/user) ใช้เป็นปลายทาง push message และคีย์ลำดับของคิว
+    """
+    return getattr(source, 'group_id', None) or getattr(source, 'room_id', None) or source.user_id
+
+def dispatch_event(event):
+    """
+    ส่ง event ที่ดึงออกจากคิวไปยังฟังก์ชันจัดการที่ตรงกับชนิดของ event
+    """
+    if isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent):
+        handle_message(event)
+
 @handler.add(MessageEvent, message=TextMessageContent)
+def on_text_message(event):
+    """
+    ตัวรับ event ของ WebhookHandler (handler นับจำนวนพารามิเตอร์ของฟังก์ชัน จึงไม่ลงทะเบียนฟังก์ชันที่ถูกห่อโดยตรง)
+    """
+    handle_message(event)
+
+@metrics.traced("handle_message")
 def handle_message(event):
     """
     จัดการข้อความที่ได้รับจากผู้ใช้ LINE
     """
     user_id = event.source.user_id
     text_from_user = event.message.text
+    # ใช้ push message แทน reply เมื่อประมวลผลนานจน reply token หมดอายุ
+    push_to = get_conversation_id(event.source)
+    received_at = event.timestamp / 1000 if event.timestamp else None
     logger.info(f"ข้อความจาก {user_id}: {text_from_user}")
 
     # ตรวจสอบว่าเป็นข้อความในกลุ่มหรือห้องสนทนาหรือไม่
@@ -110,86 +263,59 @@ def handle_message(event):
         if not actual_message:
             # กรณีที่ข้อความว่างเปล่า (เช่น เพียงแค่เรียกชื่อบอทในกลุ่ม)
             reply_text = f"สวัสดีค่ะ หนูชื่อ {bot_name} คุณต้องการสอบถามอะไรค่ะ?"
-            send_text_message(line_bot_api, event.reply_token, reply_text)
+            send_text_message(line_bot_api, event.reply_token, reply_text, push_to, received_at)
         else:
+            speculation = None
             try:
-                # ขั้นตอนที่ 1: ส่งคำถามไปยัง Dialogflow
-                logger.info("เริ่มขั้นตอนที่ 1: ส่งคำถามไปยัง Dialogflow")
                 user_session_id = f"{SESSION_ID}-{user_id}"
-                response = detect_intent_texts(DIALOGFLOW_PROJECT_ID, user_session_id, actual_message, 'th')
-                
-                # แปลง response เป็น dict สำหรับตรวจสอบ
-                response_dict = MessageToDict(response._pb)
-                logger.info(f"คำตอบจาก Dialogflow: {json.dumps(response_dict, indent=2, ensure_ascii=False)[:1000]}")
-                
-                # เตรียมข้อมูลที่จะส่งกลับ
-                messages_to_reply = []
-                quick_replies = []
-                has_payload = False
-                
-                # ตรวจสอบและรวบรวมทุกข้อความจาก Dialogflow
-                if 'queryResult' in response_dict:
-                    # ตรวจสอบหา messages ที่มี quick replies และ payloads
-                    if 'fulfillmentMessages' in response_dict['queryResult']:
-                        for message in response_dict['queryResult']['fulfillmentMessages']:
-                            # ตรวจสอบข้อความปกติ
-                            if 'text' in message and 'text' in message['text'] and message['text']['text']:
-                                for text in message['text']['text']:
-                                    if text and text not in INVALID_DIALOGFLOW_RESPONSES:
-                                        text_message = TextMessage(text=text)
-                                        messages_to_reply.append(text_message)
-                            
-                            # ตรวจสอบ Quick Replies
-                            if 'quickReplies' in message:
-                                quick_reply_items = []
-                                if 'quickReplies' in message['quickReplies'] and isinstance(message['quickReplies']['quickReplies'], list):
-                                    for qr in message['quickReplies']['quickReplies']:
-                                        quick_reply_items.append(
-                                            QuickReplyItem(
-                                                action=MessageAction(
-                                                    label=qr[:20],  # LINE จำกัดความยาวของป้ายชื่อไม่เกิน 20 ตัวอักษร
-                                                    text=qr
-                                                )
-                                            )
-                                        )
-                                if quick_reply_items:
-                                    quick_replies = QuickReply(items=quick_reply_items)
-                                    # ใส่ quick replies ในข้อความสุดท้าย (ถ้ามี)
-                                    if messages_to_reply:
-                                        messages_to_reply[-1].quick_reply = quick_replies
-                                    
-                            # ตรวจสอบ Custom Payload (เช่น Flex Message)
-                            if 'payload' in message:
-                                has_payload = True
-                                process_payload(message['payload'], messages_to_reply)
-                
-                # ถ้าไม่มีข้อความใน fulfillmentMessages ให้ใช้ fulfillmentText (ถ้ามี)
-                if not messages_to_reply and 'fulfillmentText' in response_dict['queryResult']:
-                    text_response = response_dict['queryResult']['fulfillmentText']
-                    if text_response and text_response not in INVALID_DIALOGFLOW_RESPONSES:
-                        text_message = TextMessage(text=text_response, quick_reply=quick_replies if quick_replies else None)
-                        messages_to_reply.append(text_message)
-                
+                local_answer = classify_intent_locally(actual_message, user_session_id)
+                if local_answer is not None:
+                    logger.info(f"ตอบจาก intent ในเครื่อง: {local_answer['queryResult']['intent']['displayName']}")
+                    messages_to_reply, quick_replies = translate_query_result_dict(
+                        local_answer['queryResult'], INVALID_DIALOGFLOW_RESPONSES)
+                else:
+                    # ค้นหาเอกสารล่วงหน้าไปพร้อมกับ Dialogflow (เมื่อเปิด RAG_SPECULATIVE)
+                    speculation = start_speculative_search(actual_message, user_id)
+
+                    # ขั้นตอนที่ 1: ส่งคำถามไปยัง Dialogflow
+                    logger.info("เริ่มขั้นตอนที่ 1: ส่งคำถามไปยัง Dialogflow")
+                    response = detect_intent_texts(DIALOGFLOW_PROJECT_ID, user_session_id, actual_message, 'th')
+                    logger.info("คำตอบจาก Dialogflow: %s", describe_query_result(response.query_result))
+
+                    # แปลงข้อความ, quick replies และ Flex payload เป็นข้อความ LINE โดยตรงจาก protobuf
+                    messages_to_reply, quick_replies = translate_query_result(
+                        response.query_result, INVALID_DIALOGFLOW_RESPONSES)
+
                 # หากมีอย่างน้อยหนึ่งข้อความให้ส่งทั้งหมด
                 if messages_to_reply:
                     logger.info("พบคำตอบจาก Dialogflow ส่งคำตอบให้ผู้ใช้")
-                    # เพิ่ม quick replies ให้กับข้อความสุดท้าย (ถ้ามี quick replies แต่ยังไม่ได้ใส่)
-                    if quick_replies and not messages_to_reply[-1].quick_reply:
-                        messages_to_reply[-1].quick_reply = quick_replies
-                    
-                    send_multiple_messages(line_bot_api, event.reply_token, messages_to_reply)
+                    metrics.record_outcome("local_intent" if local_answer is not None else "dialogflow_answered")
+                    if speculation is not None:
+                        speculation.cancel()
+                    send_multiple_messages(line_bot_api, event.reply_token, messages_to_reply, push_to, received_at)
                 else:
                     # ขั้นตอนที่ 2: ค้นหาในเอกสาร
                     logger.info("เริ่มขั้นตอนที่ 2: ค้นหาในเอกสาร")
-                    reply_text, found_in_docs, rag_context = search_from_documents(actual_message)
+                    metrics.record_outcome("rag_fallback")
+                    if speculation is not None:
+                        reply_text, found_in_docs, rag_context = speculation.result()
+                    else:
+                        reply_text, found_in_docs, rag_context = search_from_documents(actual_message, user_id)
 
                     # ส่งข้อความที่ได้
-                    text_message = TextMessage(text=reply_text, quick_reply=quick_replies if quick_replies else None)
-                    send_multiple_messages(line_bot_api, event.reply_token, [text_message])
+                    text_message = TextMessage(text=reply_text, quick_reply=quick_replies)
+                    send_multiple_messages(line_bot_api, event.reply_token, [text_message], push_to, received_at)
+
+                # เรียนรู้จากคำตอบของ Dialogflow หลังส่งข้อความแล้ว เพื่อไม่ให้ผู้ใช้ต้องรอ
+                if local_answer is None:
+                    learn_intent_locally(actual_message, response, user_session_id)
                 
             except Exception as e:
                 logger.error(f"เกิดข้อผิดพลาดในการประมวลผลข้อความ: {str(e)}")
-                send_text_message(line_bot_api, event.reply_token, "ขออภัย เกิดข้อผิดพลาดในการประมวลผล กรุณาลองใหม่อีกครั้ง")
+                metrics.record_outcome("error")
+                if speculation is not None:
+                    speculation.cancel()
+                send_text_message(line_bot_api, event.reply_token, "ขออภัย เกิดข้อผิดพลาดในการประมวลผล กรุณาลองใหม่อีกครั้ง", push_to, received_at)
 
 @app.route("/")
 def home():
@@ -198,25 +324,42 @@ def home():
     """
     return "LINE Bot with Dialogflow + Document + Hugging Face กำลังทำงาน!"
 
+@app.route("/ready")
+def ready():
+    """
+    readiness สำหรับ load balancer: 200 เมื่อ warm-up เสร็จ ไม่เช่นนั้น 503 (อ่านจากสถานะที่บันทึกไว้ ไม่ตรวจซ้ำ)
+    """
+    if warm_up is None:
+        return jsonify({"ready": True})
+    report = warm_up.get_status()
+    return jsonify(report), 200 if report["ready"] else 503
+
 @app.route("/status")
 def status():
     """
     แสดงสถานะของบอทและส่วนประกอบต่าง ๆ ในรูปแบบ JSON
     """
-    doc_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "documents.json")
+    documents = get_rag_stats()
     cred_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
     
     status_report = {
         "dialogflow": {
             "status": "✅ พร้อมใช้งาน" if DIALOGFLOW_PROJECT_ID and os.path.exists(cred_path) else "❌ ยังไม่ได้ตั้งค่า",
             "project_id": DIALOGFLOW_PROJECT_ID,
-            "credentials": "พบไฟล์" if os.path.exists(cred_path) else "ไม่พบไฟล์"
+            "credentials": "พบไฟล์" if os.path.exists(cred_path) else "ไม่พบไฟล์",
+            "stats": get_dialogflow_stats()
         },
         "documents": {
-            "status": "✅ พร้อมใช้งาน" if os.path.exists(doc_path) else "❌ ไม่พบไฟล์",
-            "path": doc_path,
-            "exists": os.path.exists(doc_path)
+            "status": "✅ พร้อมใช้งาน" if documents["loaded"] and documents.get("documents")
+            else "❌ ไม่พบไฟล์" if not documents["exists"] else "⏳ ยังไม่ได้โหลด",
+            **documents,
+            "answer_cache": get_cache_stats(),
+            "llm_admission": get_llm_admission_stats()
         },
+        "intent_classifier": intent_classifier.get_stats() if intent_classifier is not None else None,
+        "warmup": warm_up.get_status() if warm_up is not None else None,
+        "outcomes": metrics.get_summary(),
+        "message_cache": get_message_cache_stats(),
         "line_api": {
             "status": "✅ ตั้งค่าแล้ว" if LINE_CHANNEL_ACCESS_TOKEN and LINE_CHANNEL_SECRET else "❌ ยังไม่ได้ตั้งค่า"
         }
@@ -228,5 +371,12 @@ def status():
         "timestamp": datetime.now().isoformat()
     })
 
+@app.route("/metrics")
+def metrics_endpoint():
+    """
+    metrics ในรูปแบบข้อความของ Prometheus (latency ของแต่ละขั้นตอน, ผลลัพธ์, งานที่กำลังทำ)
+    """
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,403 @@
+"""
+ทดสอบโหลดแบบ end-to-end โดยไม่ต้องใช้บริการจริง: ส่ง webhook ที่ลงลายเซ็นแล้วเข้า /callback ของ app.py
+ผ่าน HTTP จริง โดยมี server จำลองของ LINE, Dialogflow และ Ollama (fake_services.py) แทนบริการภายนอก
+รายงาน throughput และ latency p50/p95/p99 ของแต่ละขั้นตอนที่ระดับ concurrency ต่าง ๆ
+
+ตัวอย่าง:
+    python benchmark_e2e.py --concurrency 1,4,16 --requests 200
+    python benchmark_e2e.py --replay captured.jsonl --async --ollama-latency-ms 800 --ollama-token-ms 20
+    python benchmark_e2e.py --dialogflow-failure-rate 0.05 --line-latency-ms 50 --json
+
+ไฟล์ --replay เป็น JSONL บรรทัดละหนึ่งรายการ: webhook body ทั้งก้อน (มีฟิลด์ events)
+หรือ object ที่มีฟิลด์ text/question
+"""
+import os
+import sys
+import time
+import json
+import hmac
+import uuid
+import base64
+import hashlib
+import argparse
+import logging
+import tempfile
+import threading
+import functools
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import requests
+
+from fake_services import FaultInjector, FakeLineServer, FakeDialogflowServer, FakeOllamaServer
+
+logger = logging.getLogger(__name__)
+
+BENCHMARK_CHANNEL_SECRET = 'benchmark-channel-secret'
+STAGES = ('callback', 'end_to_end', 'dialogflow', 'faq_match', 'retrieval', 'llm', 'rag_total', 'line_send')
+
+
+class StageRecorder:
+    """Thread-safe collection of per-stage durations in milliseconds"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, stage, elapsed_ms):
+        with self._lock:
+            self.samples[stage].append(elapsed_ms)
+
+    def error(self, kind):
+        with self._lock:
+            self.errors[kind] += 1
+
+    def wrap(self, stage, fn):
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.record(stage, (time.perf_counter() - start) * 1000)
+        return timed
+
+    def reset(self):
+        with self._lock:
+            self.samples = defaultdict(list)
+            self.errors = defaultdict(int)
+
+    def summary(self):
+        with self._lock:
+            samples = {stage: list(values) for stage, values in self.samples.items()}
+            errors = dict(self.errors)
+        stages = {}
+        for stage in STAGES:
+            values = samples.get(stage)
+            if not values:
+                continue
+            stages[stage] = {
+                'count': len(values),
+                'p50_ms': float(np.percentile(values, 50)),
+                'p95_ms': float(np.percentile(values, 95)),
+                'p99_ms': float(np.percentile(values, 99))
+            }
+        return stages, errors
+
+
+class DeliveryTracker:
+    """Matches replies/pushes seen by the fake LINE server with the webhook events that caused them"""
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._pending_by_user = defaultdict(list)
+        self._done = threading.Condition(self._lock)
+
+    def expect(self, reply_token, user_id):
+        with self._lock:
+            self._pending[reply_token] = (time.perf_counter(), user_id)
+            self._pending_by_user[user_id].append(reply_token)
+
+    def on_delivery(self, kind, key, messages):
+        with self._lock:
+            token = key if kind == 'reply' else next(iter(self._pending_by_user.get(key) or []), None)
+            entry = self._pending.pop(token, None)
+            if entry is None:
+                return
+            sent_at, user_id = entry
+            self._pending_by_user[user_id].remove(token)
+            self.recorder.record('end_to_end', (time.perf_counter() - sent_at) * 1000)
+            self._done.notify_all()
+
+    def wait(self, timeout):
+        deadline = time.perf_counter() + timeout
+        with self._lock:
+            while self._pending and time.perf_counter() < deadline:
+                self._done.wait(deadline - time.perf_counter())
+            missing = len(self._pending)
+            self._pending.clear()
+            self._pending_by_user.clear()
+            return missing
+
+
+def sign(body, secret=BENCHMARK_CHANNEL_SECRET):
+    digest = hmac.new(secret.encode('utf-8'), body.encode('utf-8'), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode('utf-8')
+
+
+def text_event(text, user_id, reply_token):
+    return {
+        'type': 'message',
+        'mode': 'active',
+        'timestamp': int(time.time() * 1000),
+        'source': {'type': 'user', 'userId': user_id},
+        'webhookEventId': uuid.uuid4().hex,
+        'deliveryContext': {'isRedelivery': False},
+        'replyToken': reply_token,
+        'message': {'id': uuid.uuid4().hex[:16], 'type': 'text', 'quoteToken': uuid.uuid4().hex, 'text': text}
+    }
+
+
+def load_workload(replay_path, data_dir):
+    """รายการงานเป็น webhook body (dict) หรือข้อความคำถาม (str)"""
+    if replay_path:
+        workload = []
+        with open(replay_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                if isinstance(record, dict) and 'events' in record:
+                    workload.append(record)
+                elif isinstance(record, dict):
+                    text = record.get('text') or record.get('question') or record.get('message')
+                    if isinstance(text, str) and text:
+                        workload.append(text)
+                elif isinstance(record, str):
+                    workload.append(record)
+        return workload
+
+    from rag import list_json_files, parse_documents
+    return [doc['question'] for json_file in list_json_files(data_dir) for doc in parse_documents(json_file)]
+
+
+def build_body(item, sequence):
+    """สร้าง webhook body พร้อม reply token ใหม่ที่ไม่ซ้ำ เพื่อจับคู่กับคำตอบที่ LINE จำลองได้รับ"""
+    if isinstance(item, str):
+        user_id = f"Ubench{sequence % 1000:04d}"
+        token = f"bench-{sequence}-{uuid.uuid4().hex[:8]}"
+        return {'destination': 'Ubenchmarkbot', 'events': [text_event(item, user_id, token)]}, [(token, user_id)]
+
+    body = json.loads(json.dumps(item))
+    tracked = []
+    for i, event in enumerate(body.get('events', [])):
+        event['timestamp'] = int(time.time() * 1000)
+        if 'replyToken' in event and event.get('type') == 'message':
+            event['replyToken'] = f"bench-{sequence}-{i}-{uuid.uuid4().hex[:8]}"
+            source = event.get('source', {})
+            push_to = source.get('groupId') or source.get('roomId') or source.get('userId')
+            tracked.append((event['replyToken'], push_to))
+    return body, tracked
+
+
+def configure_environment(args, line, dialogflow, ollama):
+    """ตั้งค่า environment ให้ app.py ชี้ไปยัง server จำลอง ต้องเรียกก่อน import app"""
+    credentials = os.path.join(tempfile.gettempdir(), 'benchmark-credentials.json')
+    os.environ.update({
+        'LINE_CHANNEL_SECRET': BENCHMARK_CHANNEL_SECRET,
+        'LINE_CHANNEL_ACCESS_TOKEN': 'benchmark-access-token',
+        'LINE_API_HOST': line.url,
+        'DIALOGFLOW_PROJECT_ID': 'benchmark-project',
+        'DIALOGFLOW_API_ENDPOINT': dialogflow.endpoint,
+        'GOOGLE_APPLICATION_CREDENTIALS': credentials,
+        'OLLAMA_URL': ollama.generate_url,
+        'WEBHOOK_ASYNC': 'true' if args.use_async else 'false'
+    })
+    if args.index_dir:
+        os.environ['RAG_INDEX_DIR'] = args.index_dir
+    if args.no_faq:
+        # คำถามที่สร้างจาก data/json ตรงกับ FAQ ทุกข้อ ปิด fast path เพื่อวัดการค้นและ LLM
+        os.environ['RAG_FAQ_FAST_PATH'] = 'false'
+    if args.intent_classifier:
+        os.environ['INTENT_CLASSIFIER'] = 'true'
+
+
+def instrument(recorder):
+    """ห่อฟังก์ชันของแต่ละขั้นตอนใน pipeline ด้วยตัวจับเวลา"""
+    import app
+    import retriever
+    import message
+    from rag import RAGSystem
+
+    app.detect_intent_texts = recorder.wrap('dialogflow', app.detect_intent_texts)
+    app.search_from_documents = recorder.wrap('rag_total', app.search_from_documents)
+    retriever.SpeculativeSearch.result = recorder.wrap('rag_total', retriever.SpeculativeSearch.result)
+    retriever.generate_response = recorder.wrap('llm', retriever.generate_response)
+    message.deliver_messages = recorder.wrap('line_send', message.deliver_messages)
+    RAGSystem.match_question = recorder.wrap('faq_match', RAGSystem.match_question)
+    RAGSystem.search_with_embedding = recorder.wrap('retrieval', RAGSystem.search_with_embedding)
+    return app
+
+
+def serve(flask_app):
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', 0, flask_app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='benchmark-app', daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/callback"
+
+
+def wait_ready(url, timeout):
+    """รอจน /ready ของ app ตอบ 200 (warm-up เสร็จ) คืนค่ารายงาน warm-up และเวลาที่รอ"""
+    ready_url = url.rsplit('/', 1)[0] + '/ready'
+    start = time.perf_counter()
+    report = {}
+    while time.perf_counter() - start < timeout:
+        try:
+            response = requests.get(ready_url, timeout=timeout)
+            report = response.json()
+            if response.status_code == 200:
+                break
+        except (requests.RequestException, ValueError):
+            pass
+        time.sleep(0.1)
+    return dict(report, waited_seconds=time.perf_counter() - start)
+
+
+def run_level(url, workload, concurrency, total, recorder, tracker, timeout, offset):
+    local = threading.local()
+
+    def post(sequence):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        body, tracked = build_body(workload[sequence % len(workload)], offset + sequence)
+        data = json.dumps(body, ensure_ascii=False)
+        for token, user_id in tracked:
+            tracker.expect(token, user_id)
+        start = time.perf_counter()
+        try:
+            response = local.session.post(url, data=data.encode('utf-8'), timeout=timeout, headers={
+                'Content-Type': 'application/json',
+                'X-Line-Signature': sign(data)
+            })
+            if response.status_code != 200:
+                recorder.error(f"http_{response.status_code}")
+        except requests.RequestException:
+            recorder.error('http_error')
+        finally:
+            recorder.record('callback', (time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(post, range(total)))
+    missing = tracker.wait(timeout)
+    elapsed = time.perf_counter() - start
+    stages, errors = recorder.summary()
+    if missing:
+        errors['no_reply'] = missing
+    completed = stages.get('end_to_end', {}).get('count', 0)
+    return {
+        'concurrency': concurrency,
+        'requests': total,
+        'completed': completed,
+        'seconds': elapsed,
+        'throughput_rps': completed / elapsed if elapsed else 0.0,
+        'stages': stages,
+        'errors': errors
+    }
+
+
+def print_report(report):
+    print(f"mode={'async' if report['async'] else 'sync'} workload={report['workload']} "
+          f"dialogflow_answer_rate={report['fakes']['dialogflow_answer_rate']}")
+    startup = report['startup']
+    components = ', '.join(f"{name} {c['status']} {c['seconds'] or 0:.2f}s"
+                           for name, c in (startup.get('components') or {}).items())
+    print(f"startup: ready={startup.get('ready')} after {startup['waited_seconds']:.2f}s"
+          + (f" ({components})" if components else ''))
+    for level in report['levels']:
+        errors = ', '.join(f"{k}={v}" for k, v in sorted(level['errors'].items())) or 'none'
+        print(f"\nconcurrency={level['concurrency']} completed={level['completed']}/{level['requests']} "
+              f"throughput={level['throughput_rps']:.1f} req/s errors: {errors}")
+        print(f"  {'stage':<12}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for stage, s in level['stages'].items():
+            print(f"  {stage:<12}{s['count']:>8}{s['p50_ms']:>10.1f}{s['p95_ms']:>10.1f}{s['p99_ms']:>10.1f}")
+    print("\nfake services: " + ', '.join(f"{name} {s['requests']} req / {s['failures']} failed"
+                                          for name, s in report['fakes']['stats'].items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end load test of the LINE webhook")
+    base_dir = os.path.abspath(os.path.dirname(__file__))
+    parser.add_argument('--data', default=os.path.join(base_dir, 'data', 'json'),
+                        help="generate questions from this JSON/JSONL file or directory")
+    parser.add_argument('--replay', help="JSONL of webhook bodies or {\"text\": ...} records to replay")
+    parser.add_argument('--index-dir', help="RAG_INDEX_DIR for the app under test")
+    parser.add_argument('--concurrency', default='1,4,16', help="comma-separated concurrency levels")
+    parser.add_argument('--requests', type=int, default=100, help="webhook requests per concurrency level")
+    parser.add_argument('--warmup', type=int, default=5, help="requests sent before measuring")
+    parser.add_argument('--timeout', type=float, default=120.0, help="seconds to wait for replies per level")
+    parser.add_argument('--async', dest='use_async', action='store_true', help="run the app with WEBHOOK_ASYNC")
+    parser.add_argument('--no-faq', action='store_true', help="disable the exact-FAQ fast path (RAG_FAQ_FAST_PATH)")
+    parser.add_argument('--intent-classifier', action='store_true',
+                        help="answer repeated Dialogflow intents locally (INTENT_CLASSIFIER)")
+    parser.add_argument('--seed', type=int, default=0)
+    for name, latency in (('line', 20.0), ('dialogflow', 80.0), ('ollama', 300.0)):
+        parser.add_argument(f'--{name}-latency-ms', type=float, default=latency)
+        parser.add_argument(f'--{name}-jitter-ms', type=float, default=latency / 4)
+        parser.add_argument(f'--{name}-failure-rate', type=float, default=0.0)
+    parser.add_argument('--dialogflow-answer-rate', type=float, default=0.5,
+                        help="share of questions Dialogflow answers itself (the rest go to RAG)")
+    parser.add_argument('--ollama-tokens', type=int, default=40)
+    parser.add_argument('--ollama-token-ms', type=float, default=10.0)
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    parser.add_argument('--verbose', action='store_true', help="keep the app's INFO logging")
+    args = parser.parse_args()
+
+    def faults(name, offset):
+        return FaultInjector(getattr(args, f'{name}_latency_ms'), getattr(args, f'{name}_jitter_ms'),
+                             getattr(args, f'{name}_failure_rate'), seed=args.seed + offset)
+
+    recorder = StageRecorder()
+    tracker = DeliveryTracker(recorder)
+    line = FakeLineServer(faults('line', 1), on_delivery=tracker.on_delivery).start()
+    dialogflow = FakeDialogflowServer(faults('dialogflow', 2), answer_rate=args.dialogflow_answer_rate).start()
+    ollama = FakeOllamaServer(faults('ollama', 3), tokens=args.ollama_tokens, token_ms=args.ollama_token_ms).start()
+    configure_environment(args, line, dialogflow, ollama)
+
+    workload = load_workload(args.replay, args.data)
+    if not workload:
+        raise SystemExit("Workload is empty")
+
+    app = instrument(recorder)
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+        app.app.logger.setLevel(logging.WARNING)
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server, url = serve(app.app)
+
+    try:
+        startup = wait_ready(url, args.timeout)
+        sequence = 0
+        if args.warmup:
+            run_level(url, workload, 1, args.warmup, recorder, tracker, args.timeout, sequence)
+            sequence += args.warmup
+        levels = []
+        for concurrency in [int(level) for level in args.concurrency.split(',') if level.strip()]:
+            recorder.reset()
+            levels.append(run_level(url, workload, concurrency, args.requests, recorder, tracker, args.timeout,
+                                    sequence))
+            sequence += args.requests
+            if not args.json:
+                print(f"concurrency {concurrency}: {levels[-1]['throughput_rps']:.1f} req/s", file=sys.stderr)
+    finally:
+        server.shutdown()
+        line.stop()
+        dialogflow.stop()
+        ollama.stop()
+
+    report = {
+        'async': args.use_async,
+        'workload': len(workload),
+        'startup': startup,
+        'levels': levels,
+        'fakes': {
+            'dialogflow_answer_rate': args.dialogflow_answer_rate,
+            'stats': {
+                'line': line.faults.get_stats(),
+                'dialogflow': dialogflow.faults.get_stats(),
+                'ollama': ollama.faults.get_stats()
+            }
+        }
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+เปรียบเทียบ encoder แบบ PyTorch (SentenceTransformer) กับ ONNX Runtime (int8)
+ตรวจความสอดคล้องของ embedding (cosine), ความซ้ำของผลค้นหา top-k, latency และหน่วยความจำ
+
+ต้องติดตั้ง onnxruntime เพิ่ม: pip install -r requirements-onnx.txt
+
+ตัวอย่าง:
+    python benchmark_encoder.py --data data/json --threads 4
+    python benchmark_encoder.py --fp32 --json
+"""
+import os
+import gc
+import json
+import time
+import argparse
+import logging
+import resource
+import numpy as np
+from rag import list_json_files, parse_documents
+from encoders import create_encoder
+from doc_store import document_text
+
+logger = logging.getLogger(__name__)
+
+
+def _rss_bytes():
+    """หน่วยความจำ RSS ปัจจุบันของ process (Linux), ใช้ค่าสูงสุดจาก getrusage เมื่ออ่านไม่ได้"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except Exception:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(backend, model_name, texts, queries, onnx_dir, quantize, threads, batch_size):
+    gc.collect()
+    rss_before = _rss_bytes()
+    start = time.perf_counter()
+    encoder = create_encoder(backend, model_name, onnx_dir, quantize, threads)
+    load_ms = (time.perf_counter() - start) * 1000
+    memory = _rss_bytes() - rss_before
+
+    start = time.perf_counter()
+    doc_embeddings = encoder.encode(texts, batch_size=batch_size, convert_to_numpy=True, normalize_embeddings=True)
+    corpus_ms = (time.perf_counter() - start) * 1000
+
+    latencies = []
+    query_embeddings = []
+    for query in queries:
+        start = time.perf_counter()
+        query_embeddings.append(encoder.encode([query], convert_to_numpy=True, normalize_embeddings=True)[0])
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    stats = {
+        'backend': backend if backend == 'torch' else f"onnx-{'int8' if quantize else 'fp32'}",
+        'load_ms': load_ms,
+        'memory_bytes': memory,
+        'corpus_ms_per_doc': corpus_ms / max(1, len(texts)),
+        'query_p50_ms': float(np.percentile(latencies, 50)),
+        'query_p95_ms': float(np.percentile(latencies, 95))
+    }
+    del encoder
+    return stats, np.asarray(doc_embeddings, dtype='float32'), np.vstack(query_embeddings).astype('float32')
+
+
+def parity(reference_docs, reference_queries, candidate_docs, candidate_queries, k):
+    cosine = np.sum(reference_docs * candidate_docs, axis=1)
+    reference_top = np.argsort(-(reference_queries @ reference_docs.T), axis=1)[:, :k]
+    candidate_top = np.argsort(-(candidate_queries @ candidate_docs.T), axis=1)[:, :k]
+    overlap = [len(set(a) & set(b)) / k for a, b in zip(reference_top, candidate_top)]
+    return {
+        'cosine_mean': float(cosine.mean()),
+        'cosine_min': float(cosine.min()),
+        'top_k_overlap': float(np.mean(overlap)),
+        'top_1_agreement': float(np.mean(reference_top[:, 0] == candidate_top[:, 0]))
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the PyTorch and ONNX encoder backends")
+    base_dir = os.path.abspath(os.path.dirname(__file__))
+    parser.add_argument('--data', default=os.path.join(base_dir, 'data', 'json'), help="JSON/JSONL file or directory")
+    parser.add_argument('--model', default='intfloat/multilingual-e5-base')
+    parser.add_argument('--onnx-dir', default=os.getenv("RAG_ONNX_DIR") or None)
+    parser.add_argument('--fp32', action='store_true', help="compare the non-quantized ONNX model")
+    parser.add_argument('--threads', type=int, default=int(os.getenv("RAG_ONNX_THREADS") or 0) or None)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--k', type=int, default=3)
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    documents = [doc for json_file in list_json_files(args.data) for doc in parse_documents(json_file)]
+    if not documents:
+        raise SystemExit(f"No documents loaded from {args.data}")
+    texts = [document_text(doc) for doc in documents]
+    queries = [doc['question'] for doc in documents]
+
+    torch_stats, torch_docs, torch_queries = measure('torch', args.model, texts, queries, args.onnx_dir,
+                                                     True, args.threads, args.batch_size)
+    onnx_stats, onnx_docs, onnx_queries = measure('onnx', args.model, texts, queries, args.onnx_dir,
+                                                  not args.fp32, args.threads, args.batch_size)
+    report = {
+        'documents': len(texts),
+        'backends': [torch_stats, onnx_stats],
+        'parity': parity(torch_docs, torch_queries, onnx_docs, onnx_queries, args.k)
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"documents={len(texts)} k={args.k}")
+    print(f"{'backend':<12}{'load ms':>10}{'memory MB':>12}{'ms/doc':>10}{'query p50':>12}{'query p95':>12}")
+    for r in report['backends']:
+        print(f"{r['backend']:<12}{r['load_ms']:>10.0f}{r['memory_bytes'] / 1e6:>12.1f}"
+              f"{r['corpus_ms_per_doc']:>10.2f}{r['query_p50_ms']:>12.2f}{r['query_p95_ms']:>12.2f}")
+    p = report['parity']
+    print(f"cosine mean={p['cosine_mean']:.4f} min={p['cosine_min']:.4f}  "
+          f"top-{args.k} overlap={p['top_k_overlap']:.3f}  top-1 agreement={p['top_1_agreement']:.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+เปรียบเทียบชนิดของ FAISS index บน corpus เดียวกัน: recall@k เทียบกับการค้นแบบ exact,
+latency ต่อคำถาม (p50/p95/p99) และขนาดหน่วยความจำของ index
+
+ตัวอย่าง:
+    python benchmark_index.py --data data/json --k 3
+    python benchmark_index.py --types flat,hnsw --ef-search 32 --synthetic 50000
+    python benchmark_index.py --queries queries.jsonl --json
+"""
+import os
+import json
+import time
+import argparse
+import logging
+import numpy as np
+from rag import RAGSystem
+from index_factory import INDEX_TYPES, build_index, index_kind, index_memory_bytes
+
+logger = logging.getLogger(__name__)
+
+
+def load_queries(path):
+    """อ่านคำถามจากไฟล์ .jsonl (ฟิลด์ question/text) หรือไฟล์ข้อความบรรทัดละคำถาม"""
+    queries = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if path.endswith('.jsonl'):
+                record = json.loads(line)
+                line = record.get('question') or record.get('text') or ''
+            if line:
+                queries.append(line)
+    return queries
+
+
+def synthesize(embeddings, ids, total, noise=0.05, seed=0):
+    """ขยาย corpus ด้วยสำเนาของ embedding ที่เพิ่ม noise เพื่อจำลอง corpus ขนาดใหญ่"""
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, len(embeddings), size=total - len(embeddings))
+    extra = embeddings[picks] + rng.normal(0, noise, size=(len(picks), embeddings.shape[1])).astype('float32')
+    extra /= np.linalg.norm(extra, axis=1, keepdims=True)
+    extra_ids = np.arange(ids.max() + 1, ids.max() + 1 + len(picks), dtype='int64')
+    return np.vstack([embeddings, extra]).astype('float32'), np.concatenate([ids, extra_ids])
+
+
+def benchmark(index, queries, truth, k):
+    latencies = []
+    hits = 0
+    for i in range(len(queries)):
+        start = time.perf_counter()
+        _, found = index.search(queries[i:i + 1], k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        expected = set(int(x) for x in truth[i] if x >= 0)
+        hits += len(expected & set(int(x) for x in found[0] if x >= 0)) / max(1, len(expected))
+    return {
+        'recall_at_k': hits / len(queries),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'memory_bytes': index_memory_bytes(index)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark FAISS index types for the RAG corpus")
+    base_dir = os.path.abspath(os.path.dirname(__file__))
+    parser.add_argument('--data', default=os.path.join(base_dir, 'data', 'json'), help="JSON/JSONL file or directory")
+    parser.add_argument('--index-dir', default=os.getenv("RAG_INDEX_DIR") or os.path.join(base_dir, 'data', 'index'),
+                        help="reuse persisted embeddings from this artifact directory (opened read-only)")
+    parser.add_argument('--queries', help="query file (.jsonl or one question per line); defaults to corpus questions")
+    parser.add_argument('--num-queries', type=int, default=500)
+    parser.add_argument('--k', type=int, default=3)
+    parser.add_argument('--types', default=','.join(INDEX_TYPES))
+    parser.add_argument('--nlist', type=int)
+    parser.add_argument('--nprobe', type=int)
+    parser.add_argument('--ef-search', type=int)
+    parser.add_argument('--pq-m', type=int)
+    parser.add_argument('--synthetic', type=int, default=0, help="pad the corpus to this many vectors")
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    # เปิด artifact แบบอ่านอย่างเดียว ไม่ให้ benchmark เขียนทับ index ที่ใช้งานจริง
+    rag = RAGSystem(index_dir=args.index_dir, hybrid=False, read_only=True)
+    if not rag.load_documents(args.data):
+        logger.warning(f"No usable index artifact in {args.index_dir}, encoding {args.data} in memory")
+        rag = RAGSystem(hybrid=False)
+        rag.load_documents(args.data)
+    if rag.snapshot.embeddings is None:
+        raise SystemExit(f"No documents loaded from {args.data}")
+    snapshot = rag.snapshot
+    embeddings, ids = snapshot.embeddings, snapshot.ids
+
+    if args.queries:
+        questions = load_queries(args.queries)
+    else:
+        questions = [doc['question'] for doc in snapshot.documents.values()]
+    questions = questions[:args.num_queries]
+    queries = rag.encode_queries(questions)
+
+    if args.synthetic > len(embeddings):
+        embeddings, ids = synthesize(embeddings, ids, args.synthetic)
+
+    params = {'nlist': args.nlist, 'nprobe': args.nprobe, 'ef_search': args.ef_search, 'pq_m': args.pq_m}
+    exact = build_index('flat', embeddings, ids)
+    _, truth = exact.search(queries, args.k)
+
+    results = []
+    for index_type in args.types.split(','):
+        start = time.perf_counter()
+        index = build_index(index_type.strip(), embeddings, ids, params)
+        build_ms = (time.perf_counter() - start) * 1000
+        result = {'index_type': index_type.strip(), 'built_as': index_kind(index), 'build_ms': build_ms}
+        result.update(benchmark(index, queries, truth, args.k))
+        results.append(result)
+
+    if args.json:
+        print(json.dumps({'vectors': len(embeddings), 'queries': len(queries), 'k': args.k, 'results': results},
+                         indent=2))
+        return
+
+    print(f"vectors={len(embeddings)} queries={len(queries)} k={args.k}")
+    print(f"{'type':<10}{'built as':<10}{'recall@k':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+          f"{'memory MB':>12}{'build ms':>12}")
+    for r in results:
+        print(f"{r['index_type']:<10}{r['built_as']:<10}{r['recall_at_k']:>10.3f}{r['p50_ms']:>10.3f}"
+              f"{r['p95_ms']:>10.3f}{r['p99_ms']:>10.3f}{r['memory_bytes'] / 1e6:>12.2f}{r['build_ms']:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+สร้างหรืออัปเดต artifact ของ index (FAISS index, embedding และ document store แบบ columnar)
+เพื่อให้ worker หลาย process เปิดใช้ร่วมกันแบบ memory-map ด้วย RAG_READ_ONLY=true
+
+ตัวอย่าง:
+    python build_index.py
+    python build_index.py --data data/json --index-dir /srv/rag-index --index-type hnsw
+    python build_index.py --stream --data corpus.jsonl --batch-size 256 --workers 4
+    RAG_SHARD_BY_SOURCE=true python build_index.py --stream --shard faq
+
+--dedupe-threshold (หรือ RAG_DEDUPE_THRESHOLD) รวมเอกสารที่ซ้ำกันเกือบทั้งหมดไว้เป็นรายการเดียวใน index
+คำถามของเอกสารที่ถูกรวมยังใช้ค้นหาและจับคู่ FAQ ได้
+
+--stream สร้าง index ใหม่ทั้งหมดแบบ streaming: อ่านทีละ record, encode ทีละ batch
+และเขียนลงดิสก์ระหว่างทาง หน่วยความจำจึงไม่โตตามขนาด corpus
+
+เมื่อตั้ง RAG_SHARDS หรือ RAG_SHARD_BY_SOURCE จะสร้าง index แยกต่อ shard ใต้ <index-dir>/shards
+และ --shard สร้างใหม่เฉพาะ shard นั้นโดยไม่แตะ shard อื่น
+"""
+import os
+import argparse
+import logging
+from rag import RAGSystem
+from sharding import ShardedRAGSystem, ShardRouter, load_shard_rules
+
+
+def print_compaction(stats):
+    if stats['duplicates']:
+        print(f"Merged {stats['duplicates']} near-duplicate documents: {stats['indexed']} index entries "
+              f"instead of {stats['documents']} ({stats['reduction']:.1%} smaller)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the shared RAG index artifact")
+    base_dir = os.path.abspath(os.path.dirname(__file__))
+    parser.add_argument('--data', default=os.path.join(base_dir, 'data', 'json'), help="JSON/JSONL file or directory")
+    parser.add_argument('--index-dir', default=os.getenv("RAG_INDEX_DIR") or os.path.join(base_dir, 'data', 'index'))
+    parser.add_argument('--index-type', default=os.getenv("RAG_INDEX_TYPE") or 'flat')
+    parser.add_argument('--encoder-backend', default=os.getenv("RAG_ENCODER_BACKEND") or 'torch')
+    parser.add_argument('--stream', action='store_true', help="rebuild from scratch with the streaming ingest path")
+    parser.add_argument('--batch-size', type=int, default=256, help="documents encoded per batch with --stream")
+    parser.add_argument('--workers', type=int, default=0, help="encoder processes with --stream (0 = in-process)")
+    parser.add_argument('--shards', default=os.getenv("RAG_SHARDS"), help="shard rules as JSON (see RAG_SHARDS)")
+    parser.add_argument('--shard-by-source', action='store_true',
+                        default=os.getenv("RAG_SHARD_BY_SOURCE", "false").lower() in ("1", "true", "yes"),
+                        help="one shard per file not matched by --shards")
+    parser.add_argument('--shard', help="rebuild only this shard")
+    parser.add_argument('--dedupe-threshold', type=float, default=float(os.getenv("RAG_DEDUPE_THRESHOLD") or 0),
+                        help="merge near-duplicate documents at or above this cosine similarity (0 = off)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    options = dict(index_dir=args.index_dir, index_type=args.index_type, encoder_backend=args.encoder_backend,
+                   onnx_dir=os.getenv("RAG_ONNX_DIR") or None, dedupe_threshold=args.dedupe_threshold)
+    rules = load_shard_rules(args.shards)
+    if rules or args.shard_by_source:
+        rag = ShardedRAGSystem(ShardRouter(rules, by_source=args.shard_by_source), **options)
+    elif args.shard:
+        raise SystemExit("--shard needs --shards or --shard-by-source")
+    else:
+        rag = RAGSystem(**options)
+    if args.stream:
+        kwargs = {'shard': args.shard} if args.shard else {}
+        summary = rag.ingest(args.data, batch_size=args.batch_size, workers=args.workers, **kwargs)
+        if summary is None:
+            raise SystemExit(f"Failed to ingest {args.data}")
+        print(f"Indexed {summary['documents']} documents from {summary['files']} files into {args.index_dir} "
+              f"in {summary['seconds']:.1f}s ({summary['docs_per_second']:.1f} docs/s)")
+        if summary['failed']:
+            print(f"Files with errors (partially indexed): {', '.join(summary['failed'])}")
+        print_compaction(summary['compaction'])
+        for name, shard_summary in (summary.get('shards') or {}).items():
+            print(f"  shard {name}: {shard_summary['documents']} documents from {shard_summary['files']} files")
+        return
+
+    if args.shard:
+        summary = rag.reload(args.data, shard=args.shard)
+        if summary is None:
+            raise SystemExit(f"Failed to update shard {args.shard} from {args.data}")
+        print(f"Updated shard {args.shard}: {len(summary['added'])} added, {len(summary['changed'])} changed, "
+              f"{len(summary['removed'])} removed files")
+        return
+
+    if not rag.load_documents(args.data):
+        raise SystemExit(f"Failed to build index from {args.data}")
+    stats = rag.get_stats()
+    print(f"Indexed {stats['documents']} documents into {args.index_dir}")
+    print_compaction(stats['compaction'])
+    for name, shard_stats in (stats.get('shards') or {}).items():
+        print(f"  shard {name}: {shard_stats['documents']} documents")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import faiss
+import numpy as np
+from typing import Callable, Dict, List, Optional
+# documents that differ only in a fee, a year or a date are never merged
+from lexical import number_signature
+
+
+def find_duplicates(ids: np.ndarray, embeddings: np.ndarray, signatures: List[frozenset], threshold: float,
+                    index=None, index_signature: Optional[Callable[[int], frozenset]] = None,
+                    neighbours: int = 4) -> Dict[int, int]:
+    """Map each document of a batch that near-duplicates an earlier one to that canonical entry
+
+    ``index`` holds the canonical entries indexed so far (aliases are never
+    added to it). A document is an alias when its cosine similarity to a
+    canonical entry, indexed or earlier in the batch, is at least
+    ``threshold`` and both contain the same numbers. Documents are taken in
+    batch order and compared with canonical entries only, so every alias is
+    close to its canonical entry itself rather than through a chain.
+    Returns ``{alias_id: canonical_id}`` for the batch.
+    """
+    aliases = {}
+    if not len(ids):
+        return aliases
+    embeddings = np.ascontiguousarray(embeddings, dtype='float32')
+    if index is not None and index.ntotal:
+        scores, found = index.search(embeddings, min(neighbours, index.ntotal))
+        for row, doc_id in enumerate(ids):
+            for score, other in zip(scores[row], found[row]):
+                if other >= 0 and score >= threshold and index_signature(int(other)) == signatures[row]:
+                    aliases[int(doc_id)] = int(other)
+                    break
+
+    batch = faiss.IndexFlatIP(embeddings.shape[1])
+    batch.add(embeddings)
+    scores, found = batch.search(embeddings, min(neighbours + 1, len(ids)))
+    for row, doc_id in enumerate(ids):
+        if int(doc_id) in aliases:
+            continue
+        for score, other in zip(scores[row], found[row]):
+            # เทียบกับแถวก่อนหน้าที่เป็นตัวหลักอยู่แล้วเท่านั้น
+            if 0 <= other < row and score >= threshold and int(ids[other]) not in aliases \
+                    and signatures[other] == signatures[row]:
+                aliases[int(doc_id)] = int(ids[other])
+                break
+    return aliases
+
+
+def compaction_stats(documents: int, aliases: int) -> Dict:
+    indexed = documents - aliases
+    return {
+        'documents': documents,
+        'indexed': indexed,
+        'duplicates': aliases,
+        'reduction': aliases / documents if documents else 0.0
+    }
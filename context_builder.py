@@ -0,0 +1,84 @@
+import re
+import numpy as np
+from typing import Dict, List, Optional
+
+# ตัวอักษรที่ไม่ใช่ ASCII (ภาษาไทย) ถูกตัดเป็น token ถี่กว่าภาษาอังกฤษมาก จึงประมาณแยกกัน
+ASCII_CHARS_PER_TOKEN = 4.0
+OTHER_CHARS_PER_TOKEN = 1.5
+
+_NON_ASCII = re.compile(r'[^\x00-\x7f]')
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count for ``text`` without loading the model's tokenizer
+
+    Deliberately errs high for Thai so a budget is not overrun.
+    """
+    other = len(_NON_ASCII.findall(text))
+    ascii_chars = len(text) - other
+    return int(ascii_chars / ASCII_CHARS_PER_TOKEN + other / OTHER_CHARS_PER_TOKEN) + 1
+
+
+def format_passage(result: Dict) -> str:
+    return f"Q: {result['question']}\nA: {result['answer']}"
+
+
+def _truncate(text: str, max_tokens: int) -> str:
+    # ตัดตามสัดส่วน แล้วลดลงทีละนิดจนพอดีงบ
+    if max_tokens <= 0:
+        return ''
+    cut = int(len(text) * max_tokens / max(estimate_tokens(text), 1))
+    while cut > 0 and estimate_tokens(text[:cut]) > max_tokens:
+        cut = int(cut * 0.9)
+    return text[:cut].rstrip() + '…' if cut < len(text) else text
+
+
+def select_passages(query_embedding: np.ndarray, results: List[Dict], embeddings: Optional[np.ndarray],
+                    max_tokens: int = 1024, mmr_lambda: float = 0.7, duplicate_threshold: float = 0.95,
+                    min_score: float = 0.2) -> List[Dict]:
+    """Pick passages for the prompt by maximal marginal relevance within a token budget
+
+    ``results`` are search hits (with ``score`` = cosine to the query) and
+    ``embeddings`` their normalised vectors, row for row. Each step takes the
+    passage with the best ``mmr_lambda * relevance - (1 - mmr_lambda) * redundancy``;
+    passages nearly identical to one already chosen (cosine at or above
+    ``duplicate_threshold``) are dropped, as are those that no longer fit.
+    The first passage is truncated rather than dropped if it alone exceeds
+    the budget. Returns the chosen results in selection order, each with a
+    ``passage`` (the text to put in the prompt) and its ``tokens``.
+    """
+    candidates = [i for i, result in enumerate(results) if result['score'] >= min_score]
+    if not candidates:
+        return []
+
+    similarity = None
+    if embeddings is not None and len(candidates) > 1:
+        vectors = np.asarray(embeddings, dtype='float32')[candidates]
+        similarity = vectors @ vectors.T
+
+    relevance = {i: results[i]['score'] for i in candidates}
+    position = {i: p for p, i in enumerate(candidates)}
+    selected = []
+    remaining = max_tokens
+    while candidates and remaining > 0:
+        def mmr(i):
+            if similarity is None or not selected:
+                return relevance[i]
+            redundancy = max(similarity[position[i], position[j]] for j, _ in selected)
+            return mmr_lambda * relevance[i] - (1 - mmr_lambda) * redundancy
+
+        best = max(candidates, key=mmr)
+        candidates.remove(best)
+        if similarity is not None and any(similarity[position[best], position[j]] >= duplicate_threshold
+                                          for j, _ in selected):
+            continue
+        passage = format_passage(results[best])
+        tokens = estimate_tokens(passage)
+        if tokens > remaining:
+            if selected:
+                continue
+            passage = _truncate(passage, remaining)
+            tokens = estimate_tokens(passage)
+        selected.append((best, dict(results[best], passage=passage, tokens=tokens)))
+        remaining -= tokens
+    return [result for _, result in selected]
@@ -1,28 +1,166 @@
+import os
+import time
+import asyncio
+import itertools
 import logging
-from google.cloud.dialogflow_v2 import SessionsClient
-from google.cloud.dialogflow_v2.types import TextInput, QueryInput
+import threading
+import grpc
+import metrics
+from google.cloud.dialogflow_v2 import SessionsClient, SessionsAsyncClient
+from google.cloud.dialogflow_v2.services.sessions.transports import SessionsGrpcTransport, SessionsGrpcAsyncIOTransport
+from google.cloud.dialogflow_v2.types import TextInput, QueryInput, DetectIntentResponse
 
 logger = logging.getLogger(__name__)
 
+# จำนวน SessionsClient (gRPC channel) ที่สร้างไว้ใช้ร่วมกันทั้ง process
+DIALOGFLOW_CHANNEL_POOL_SIZE = int(os.getenv("DIALOGFLOW_CHANNEL_POOL_SIZE") or 1)
+# ปลายทางของ Dialogflow API (host:port) ค่าที่ขึ้นต้นด้วย localhost/127.0.0.1 จะใช้ channel
+# แบบไม่เข้ารหัสและไม่ใช้ credentials สำหรับ server จำลองของ benchmark_e2e.py
+DIALOGFLOW_API_ENDPOINT = os.getenv("DIALOGFLOW_API_ENDPOINT") or None
+
+_clients = []
+_client_cycle = None
+_client_lock = threading.Lock()
+_async_clients = {}
+
+_stats_lock = threading.Lock()
+_stats = {
+    "calls": 0,
+    "errors": 0,
+    "clients_created": 0,
+    "channel_reuses": 0,
+    "total_latency_ms": 0.0,
+    "max_latency_ms": 0.0,
+    "last_latency_ms": 0.0
+}
+
+def _record_call(latency_ms, reused, error=False):
+    with _stats_lock:
+        _stats["calls"] += 1
+        _stats["errors"] += 1 if error else 0
+        _stats["channel_reuses"] += 1 if reused else 0
+        _stats["total_latency_ms"] += latency_ms
+        _stats["last_latency_ms"] = latency_ms
+        _stats["max_latency_ms"] = max(_stats["max_latency_ms"], latency_ms)
+
+def get_stats():
+    """
+    คืนค่าสถิติการเรียก Dialogflow (จำนวนครั้ง, latency, การใช้ channel ซ้ำ)
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["avg_latency_ms"] = stats["total_latency_ms"] / stats["calls"] if stats["calls"] else 0.0
+    stats["pool_size"] = len(_clients)
+    return stats
+
+def _is_local_endpoint():
+    return bool(DIALOGFLOW_API_ENDPOINT) and DIALOGFLOW_API_ENDPOINT.startswith(("localhost", "127.0.0.1"))
+
+def _new_client():
+    if _is_local_endpoint():
+        return SessionsClient(transport=SessionsGrpcTransport(channel=grpc.insecure_channel(DIALOGFLOW_API_ENDPOINT)))
+    if DIALOGFLOW_API_ENDPOINT:
+        return SessionsClient(client_options={"api_endpoint": DIALOGFLOW_API_ENDPOINT})
+    return SessionsClient()
+
+def _new_async_client():
+    if _is_local_endpoint():
+        channel = grpc.aio.insecure_channel(DIALOGFLOW_API_ENDPOINT)
+        return SessionsAsyncClient(transport=SessionsGrpcAsyncIOTransport(channel=channel))
+    if DIALOGFLOW_API_ENDPOINT:
+        return SessionsAsyncClient(client_options={"api_endpoint": DIALOGFLOW_API_ENDPOINT})
+    return SessionsAsyncClient()
+
+def init_clients(pool_size=None):
+    """
+    สร้าง SessionsClient ไว้ล่วงหน้าครั้งเดียว (อ่าน credentials และเปิด channel ตอนเริ่มระบบ)
+    """
+    global _clients, _client_cycle
+    with _client_lock:
+        if _clients:
+            return _clients
+        pool_size = max(1, pool_size or DIALOGFLOW_CHANNEL_POOL_SIZE)
+        _clients = [_new_client() for _ in range(pool_size)]
+        _client_cycle = itertools.cycle(_clients)
+        with _stats_lock:
+            _stats["clients_created"] += pool_size
+        logger.info(f"สร้าง Dialogflow SessionsClient จำนวน {pool_size} ตัว")
+        return _clients
+
+def warm_up(timeout=10.0):
+    """
+    สร้าง client แล้วรอให้ gRPC channel เชื่อมต่อเสร็จ (DNS, TCP, TLS) เพื่อไม่ให้คำขอแรกต้องรอ
+    """
+    for client in init_clients():
+        grpc.channel_ready_future(client.transport.grpc_channel).result(timeout=timeout)
+    return True
+
+def get_session_client():
+    """
+    คืนค่า SessionsClient จาก pool แบบวนรอบ (gRPC client ใช้งานพร้อมกันหลาย thread ได้)
+    """
+    created = not _clients
+    if created:
+        init_clients()
+    with _client_lock:
+        return next(_client_cycle), not created
+
+def _empty_response():
+    # response ว่างเพื่อให้โค้ดยังทำงานต่อได้ (ไม่มีข้อความ จึงไปค้นในเอกสารต่อ)
+    return DetectIntentResponse()
+
+def _build_request(project_id, session_id, text, language_code):
+    session = SessionsClient.session_path(project_id, session_id)
+    text_input = TextInput(text=text, language_code=language_code)
+    query_input = QueryInput(text=text_input)
+    return {"session": session, "query_input": query_input}
+
+@metrics.track("dialogflow")
 def detect_intent_texts(project_id, session_id, text, language_code):
     """
     ส่งข้อความไปยัง Dialogflow เพื่อตรวจจับเจตนา (intent)
     """
+    start = time.perf_counter()
+    reused = False
     try:
         logger.info(f"กำลังติดต่อ Dialogflow: Project={project_id}, Session={session_id}")
-        session_client = SessionsClient()
-        session = session_client.session_path(project_id, session_id)
-        text_input = TextInput(text=text, language_code=language_code)
-        query_input = QueryInput(text=text_input)
-        response = session_client.detect_intent(request={"session": session, "query_input": query_input})
+        session_client, reused = get_session_client()
+        response = session_client.detect_intent(request=_build_request(project_id, session_id, text, language_code))
+        _record_call((time.perf_counter() - start) * 1000, reused)
+        return response
+    except Exception as e:
+        _record_call((time.perf_counter() - start) * 1000, reused, error=True)
+        metrics.record_error("dialogflow")
+        logger.error(f"เกิดข้อผิดพลาดกับ Dialogflow: {str(e)}")
+        return _empty_response()
+
+def _get_async_client():
+    # SessionsAsyncClient ผูกกับ event loop ที่สร้าง จึงเก็บแยกตาม loop
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is not None:
+        return client, True
+    client = _new_async_client()
+    _async_clients[loop] = client
+    with _stats_lock:
+        _stats["clients_created"] += 1
+    return client, False
+
+@metrics.track("dialogflow")
+async def detect_intent_texts_async(project_id, session_id, text, language_code):
+    """
+    detect_intent_texts สำหรับผู้เรียกที่ทำงานบน asyncio event loop
+    """
+    start = time.perf_counter()
+    reused = False
+    try:
+        logger.info(f"กำลังติดต่อ Dialogflow (async): Project={project_id}, Session={session_id}")
+        session_client, reused = _get_async_client()
+        response = await session_client.detect_intent(request=_build_request(project_id, session_id, text, language_code))
+        _record_call((time.perf_counter() - start) * 1000, reused)
         return response
     except Exception as e:
+        _record_call((time.perf_counter() - start) * 1000, reused, error=True)
+        metrics.record_error("dialogflow")
         logger.error(f"เกิดข้อผิดพลาดกับ Dialogflow: {str(e)}")
-        # สร้าง response จำลองเพื่อให้โค้ดยังทำงานต่อได้
-        class MockResponse:
-            class MockQueryResult:
-                fulfillment_text = ""
-                fulfillment_messages = []
-            query_result = MockQueryResult()
-            _pb = type('MockPb', (object,), {})()
-        return MockResponse()
+        return _empty_response()
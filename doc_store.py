@@ -0,0 +1,127 @@
+import os
+import mmap
+import logging
+import numpy as np
+from collections.abc import Mapping
+from typing import Dict, Iterator
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ('question', 'answer', 'source')
+STORE_IDS_FILE = 'doc_ids.npy'
+
+
+def document_text(doc: Dict) -> str:
+    """Text that is embedded and returned as ``text``; derived instead of stored"""
+    return f"{doc['question']} {doc['answer']}".strip()
+
+
+def _offsets_file(column: str) -> str:
+    return f"{column}.offsets.npy"
+
+
+def _data_file(column: str) -> str:
+    return f"{column}.bin"
+
+
+class DocumentStoreWriter:
+    """Append documents one at a time; files are swapped into place on ``close``
+
+    Strings go straight to disk, so writing a large corpus only keeps the
+    offset arrays in memory.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._files = {column: open(os.path.join(path, _data_file(column) + '.tmp'), 'wb') for column in COLUMNS}
+        self._offsets = {column: [0] for column in COLUMNS}
+        self._ids = []
+
+    def add(self, doc_id: int, doc: Dict):
+        if self._ids and doc_id <= self._ids[-1]:
+            raise ValueError("Document ids must be added in ascending order")
+        self._ids.append(doc_id)
+        for column in COLUMNS:
+            encoded = doc[column].encode('utf-8')
+            self._files[column].write(encoded)
+            self._offsets[column].append(self._offsets[column][-1] + len(encoded))
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def close(self):
+        for column in COLUMNS:
+            self._files[column].close()
+            tmp_offsets = os.path.join(self.path, _offsets_file(column) + '.tmp')
+            with open(tmp_offsets, 'wb') as f:
+                np.save(f, np.asarray(self._offsets[column], dtype='int64'))
+            os.replace(os.path.join(self.path, _data_file(column) + '.tmp'), os.path.join(self.path, _data_file(column)))
+            os.replace(tmp_offsets, os.path.join(self.path, _offsets_file(column)))
+        tmp_ids = os.path.join(self.path, STORE_IDS_FILE + '.tmp')
+        with open(tmp_ids, 'wb') as f:
+            np.save(f, np.asarray(self._ids, dtype='int64'))
+        os.replace(tmp_ids, os.path.join(self.path, STORE_IDS_FILE))
+
+    def abort(self):
+        for column in COLUMNS:
+            self._files[column].close()
+            tmp_path = os.path.join(self.path, _data_file(column) + '.tmp')
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+class DocumentStore(Mapping):
+    """Read-only, memory-mapped columnar store of documents keyed by id
+
+    Each column is one UTF-8 blob plus an ``offsets`` array, so opening the
+    store costs nothing and a lookup only decodes the strings of the rows
+    it returns. Several processes opening the same directory share the
+    pages through the OS page cache.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.ids = np.load(os.path.join(path, STORE_IDS_FILE), mmap_mode='r')
+        self._offsets = {}
+        self._data = {}
+        for column in COLUMNS:
+            self._offsets[column] = np.load(os.path.join(path, _offsets_file(column)), mmap_mode='r')
+            with open(os.path.join(path, _data_file(column)), 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                self._data[column] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+
+    @staticmethod
+    def write(path: str, documents: Mapping, ids: np.ndarray):
+        """Write ``documents`` in ``ids`` order (ids must be sorted ascending)"""
+        writer = DocumentStoreWriter(path)
+        for doc_id in ids:
+            writer.add(int(doc_id), documents[int(doc_id)])
+        writer.close()
+
+    def _row(self, doc_id: int) -> int:
+        row = int(np.searchsorted(self.ids, doc_id))
+        if row >= len(self.ids) or self.ids[row] != doc_id:
+            raise KeyError(doc_id)
+        return row
+
+    def _value(self, column: str, row: int) -> str:
+        offsets = self._offsets[column]
+        return self._data[column][int(offsets[row]):int(offsets[row + 1])].decode('utf-8')
+
+    def __getitem__(self, doc_id: int) -> Dict:
+        row = self._row(int(doc_id))
+        return {column: self._value(column, row) for column in COLUMNS}
+
+    def __iter__(self) -> Iterator[int]:
+        return (int(doc_id) for doc_id in self.ids)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, doc_id) -> bool:
+        try:
+            self._row(int(doc_id))
+            return True
+        except (KeyError, TypeError, ValueError):
+            return False
@@ -0,0 +1,155 @@
+import time
+import queue
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_query(text: str) -> str:
+    """Collapse whitespace; every query is encoded and cached in this form"""
+    return ' '.join(text.split())
+
+
+class EmbeddingCache:
+    """Thread-safe LRU cache of query text -> embedding"""
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, text: str):
+        with self._lock:
+            embedding = self._entries.get(text)
+            if embedding is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(text)
+            self.hits += 1
+            return embedding
+
+    def put(self, text: str, embedding):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[text] = embedding
+            self._entries.move_to_end(text)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class _Pending:
+    __slots__ = ('item', 'event', 'result', 'error', 'cancelled')
+
+    def __init__(self, item):
+        self.item = item
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.cancelled = False
+
+
+class MicroBatcher:
+    """Collects concurrent calls into one batched call
+
+    ``submit`` blocks the caller until its item has been processed. A single
+    background thread waits up to ``max_wait_ms`` after the first queued item
+    (or until ``max_batch_size`` items arrive) and hands the whole batch to
+    ``batch_fn``, which must return one result per item in the same order.
+    If that thread has died, the next ``submit`` starts a new one; an item
+    whose caller timed out is dropped from its batch.
+    """
+
+    def __init__(self, batch_fn: Callable[[List], List], max_batch_size: int = 16, max_wait_ms: float = 2.0,
+                 name: str = "batcher"):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.name = name
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._thread_lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+        self.restarts = 0
+        self._thread = None
+        self._ensure_running()
+
+    def _ensure_running(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._thread_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            if self._thread is not None:
+                logger.error(f"Batch thread {self.name} stopped, restarting it")
+                self.restarts += 1
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def submit(self, item, timeout: Optional[float] = None):
+        """Queue ``item`` and wait for its result; raises TimeoutError after ``timeout`` seconds"""
+        self._ensure_running()
+        pending = _Pending(item)
+        self._queue.put(pending)
+        if not pending.event.wait(timeout):
+            pending.cancelled = True
+            raise TimeoutError("Batched call did not complete in time")
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def get_stats(self):
+        with self._stats_lock:
+            return {
+                'batches': self.batches,
+                'items': self.items,
+                'avg_batch_size': self.items / self.batches if self.batches else 0.0,
+                'queued': self._queue.qsize(),
+                'restarts': self.restarts
+            }
+
+    def _collect(self) -> List[_Pending]:
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = [pending for pending in self._collect() if not pending.cancelled]
+            if not batch:
+                continue
+            try:
+                results = self.batch_fn([pending.item for pending in batch])
+                if len(results) != len(batch):
+                    raise ValueError(f"Batch function returned {len(results)} results for {len(batch)} items")
+                for pending, result in zip(batch, results):
+                    pending.result = result
+            except BaseException as e:
+                logger.error(f"Error in batched call: {e!r}")
+                error = e if isinstance(e, Exception) else RuntimeError(f"Batch thread {self.name} stopped")
+                for pending in batch:
+                    pending.error = error
+                if error is not e:
+                    raise
+            finally:
+                with self._stats_lock:
+                    self.batches += 1
+                    self.items += len(batch)
+                for pending in batch:
+                    pending.event.set()
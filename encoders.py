@@ -0,0 +1,120 @@
+import os
+import logging
+import numpy as np
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+ENCODER_BACKENDS = ('torch', 'onnx')
+ONNX_FP32_FILE = 'model.onnx'
+ONNX_INT8_FILE = 'model.int8.onnx'
+
+
+def export_onnx(model_name: str, onnx_dir: str, quantize: bool = True) -> str:
+    """Export the Hugging Face encoder to ONNX and optionally apply dynamic int8 quantization
+
+    Returns the path of the model file to load. Needs ``torch``,
+    ``transformers`` and ``onnxruntime`` at export time only.
+    """
+    import torch
+    from transformers import AutoTokenizer, AutoModel
+
+    os.makedirs(onnx_dir, exist_ok=True)
+    fp32_path = os.path.join(onnx_dir, ONNX_FP32_FILE)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name).eval()
+    sample = tokenizer(["ตัวอย่างข้อความ"], return_tensors='pt')
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (sample['input_ids'], sample['attention_mask']),
+            fp32_path,
+            input_names=['input_ids', 'attention_mask'],
+            output_names=['last_hidden_state'],
+            dynamic_axes={
+                'input_ids': {0: 'batch', 1: 'sequence'},
+                'attention_mask': {0: 'batch', 1: 'sequence'},
+                'last_hidden_state': {0: 'batch', 1: 'sequence'}
+            },
+            opset_version=14
+        )
+    tokenizer.save_pretrained(onnx_dir)
+    logger.info(f"Exported {model_name} to {fp32_path}")
+    if not quantize:
+        return fp32_path
+
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    int8_path = os.path.join(onnx_dir, ONNX_INT8_FILE)
+    quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+    logger.info(f"Quantized ONNX model to int8: {int8_path}")
+    return int8_path
+
+
+class OnnxEncoder:
+    """ONNX Runtime encoder with the same ``encode`` signature as SentenceTransformer
+
+    Reproduces the e5 sentence-transformers pipeline: mean pooling over the
+    attention mask followed by optional L2 normalization. ``onnxruntime`` is
+    an optional dependency (``pip install -r requirements-onnx.txt``).
+    """
+
+    def __init__(self, model_name: str, onnx_dir: str, quantize: bool = True, num_threads: Optional[int] = None,
+                 max_length: int = 512):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        model_file = ONNX_INT8_FILE if quantize else ONNX_FP32_FILE
+        model_path = os.path.join(onnx_dir, model_file)
+        if not os.path.exists(model_path):
+            logger.info(f"ONNX model not found at {model_path}, exporting {model_name}")
+            model_path = export_onnx(model_name, onnx_dir, quantize)
+
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+            options.inter_op_num_threads = 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.tokenizer = AutoTokenizer.from_pretrained(onnx_dir)
+        self.max_length = max_length
+        self.model_path = model_path
+        logger.info(f"Loaded ONNX encoder: {model_path} (threads: {num_threads or 'auto'})")
+
+    def encode(self, texts: List[str], batch_size: int = 32, convert_to_numpy: bool = True,
+               normalize_embeddings: bool = True, **kwargs) -> np.ndarray:
+        outputs = []
+        for start in range(0, len(texts), batch_size):
+            tokens = self.tokenizer(texts[start:start + batch_size], padding=True, truncation=True,
+                                    max_length=self.max_length, return_tensors='np')
+            mask = tokens['attention_mask'].astype('int64')
+            hidden = self.session.run(None, {
+                'input_ids': tokens['input_ids'].astype('int64'),
+                'attention_mask': mask
+            })[0]
+            mask = mask[..., None].astype('float32')
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            outputs.append(pooled)
+        embeddings = np.vstack(outputs) if outputs else np.zeros((0, 0), dtype='float32')
+        if normalize_embeddings and len(embeddings):
+            embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        return embeddings.astype('float32')
+
+
+def create_encoder(backend: str, model_name: str, onnx_dir: Optional[str] = None, quantize: bool = True,
+                   num_threads: Optional[int] = None):
+    """Build the sentence encoder for ``backend`` ('torch' or 'onnx')"""
+    if backend == 'torch':
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(model_name)
+    if backend == 'onnx':
+        base_dir = os.path.abspath(os.path.dirname(__file__))
+        onnx_dir = onnx_dir or os.path.join(base_dir, 'data', 'onnx', model_name.replace('/', '__'))
+        return OnnxEncoder(model_name, onnx_dir, quantize, num_threads)
+    raise ValueError(f"Unknown encoder backend: {backend} (expected one of {', '.join(ENCODER_BACKENDS)})")
+
+
+def encoder_id(backend: str, model_name: str, quantize: bool = True) -> str:
+    """Identifier stored in the index manifest; embeddings from different backends are not mixed"""
+    if backend == 'torch':
+        return model_name
+    return f"{model_name}#{backend}-{'int8' if quantize else 'fp32'}"
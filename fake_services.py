@@ -0,0 +1,234 @@
+"""
+server จำลองของ LINE Messaging API, Dialogflow (gRPC) และ Ollama สำหรับทดสอบโหลดแบบ offline
+กำหนด latency และอัตราความล้มเหลวของแต่ละบริการได้ ใช้งานผ่าน benchmark_e2e.py
+"""
+import json
+import time
+import random
+import hashlib
+import logging
+import threading
+from concurrent import futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+
+import grpc
+from google.cloud.dialogflow_v2.types import DetectIntentRequest, DetectIntentResponse, Intent
+
+logger = logging.getLogger(__name__)
+
+# คำตอบที่ app.py ถือว่า Dialogflow ตอบไม่ได้ ทำให้ไปค้นในเอกสารต่อ
+DIALOGFLOW_FALLBACK_TEXT = "ขอโทษค่ะ ไม่เข้าใจ"
+
+
+class FaultInjector:
+    """Per-request latency (``latency_ms`` +/- ``jitter_ms``) and random failures"""
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, failure_rate: float = 0.0,
+                 seed: Optional[int] = None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+
+    def delay(self):
+        with self._lock:
+            jitter = self._random.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0.0
+        latency = max(0.0, self.latency_ms + jitter)
+        if latency:
+            time.sleep(latency / 1000)
+
+    def should_fail(self) -> bool:
+        with self._lock:
+            self.requests += 1
+            failed = self._random.random() < self.failure_rate
+            self.failures += 1 if failed else 0
+            return failed
+
+    def get_stats(self):
+        with self._lock:
+            return {'requests': self.requests, 'failures': self.failures}
+
+
+class _HttpServer:
+    def __init__(self, handler_class, host: str, port: int):
+        self._server = ThreadingHTTPServer((host, port), handler_class)
+        self._server.daemon_threads = True
+        self._server.owner = self
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class _JsonHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def send_json(self, status: int, body):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class _LineHandler(_JsonHandler):
+    def do_POST(self):
+        owner = self.server.owner
+        body = self.read_json()
+        owner.faults.delay()
+        if owner.faults.should_fail():
+            self.send_json(500, {'message': 'Injected failure'})
+            return
+        if self.path.endswith('/message/reply'):
+            owner.record('reply', body.get('replyToken'), body.get('messages', []))
+        elif self.path.endswith('/message/push'):
+            owner.record('push', body.get('to'), body.get('messages', []))
+        else:
+            self.send_json(404, {'message': 'Not found'})
+            return
+        self.send_json(200, {'sentMessages': [{'id': '0'} for _ in body.get('messages', [])]})
+
+
+class FakeLineServer(_HttpServer):
+    """Accepts reply and push calls and reports each delivery to ``on_delivery(kind, key, messages)``"""
+
+    def __init__(self, faults: Optional[FaultInjector] = None, on_delivery: Optional[Callable] = None,
+                 host: str = '127.0.0.1', port: int = 0):
+        super().__init__(_LineHandler, host, port)
+        self.faults = faults or FaultInjector()
+        self.on_delivery = on_delivery
+        self.deliveries = 0
+
+    def record(self, kind: str, key: str, messages):
+        self.deliveries += 1
+        if self.on_delivery is not None:
+            self.on_delivery(kind, key, messages)
+
+
+class _OllamaHandler(_JsonHandler):
+    def do_POST(self):
+        owner = self.server.owner
+        body = self.read_json()
+        # latency ของ FaultInjector คือเวลาก่อนได้ token แรก
+        owner.faults.delay()
+        if owner.faults.should_fail():
+            self.send_json(500, {'error': 'Injected failure'})
+            return
+        words = [f"คำตอบจำลอง{i}." if i % 8 == 7 else f"คำตอบจำลอง{i}" for i in range(owner.tokens)]
+        if not body.get('stream'):
+            time.sleep(owner.token_ms * owner.tokens / 1000)
+            self.send_json(200, {'response': ' '.join(words), 'done': True})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for word in words:
+                self._chunk({'response': word + ' ', 'done': False})
+                if owner.token_ms:
+                    time.sleep(owner.token_ms / 1000)
+            self._chunk({'response': '', 'done': True})
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # client หยุดอ่านเมื่อได้ข้อความครบตามงบประมาณ
+            pass
+
+    def _chunk(self, record):
+        data = json.dumps(record, ensure_ascii=False).encode('utf-8') + b"\n"
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+
+class FakeOllamaServer(_HttpServer):
+    """``/api/generate`` that emits ``tokens`` words, ``token_ms`` apart, in both streaming modes"""
+
+    def __init__(self, faults: Optional[FaultInjector] = None, tokens: int = 40, token_ms: float = 0.0,
+                 host: str = '127.0.0.1', port: int = 0):
+        super().__init__(_OllamaHandler, host, port)
+        self.faults = faults or FaultInjector()
+        self.tokens = tokens
+        self.token_ms = token_ms
+
+    @property
+    def generate_url(self) -> str:
+        return f"{self.url}/api/generate"
+
+
+class FakeDialogflowServer:
+    """gRPC ``Sessions.DetectIntent`` stand-in
+
+    A stable ``answer_rate`` share of questions (chosen by hashing the text)
+    gets a fulfillment text; the rest get the fallback reply so the bot goes
+    on to the document search, like an unmatched intent.
+    """
+
+    def __init__(self, faults: Optional[FaultInjector] = None, answer_rate: float = 0.5,
+                 host: str = '127.0.0.1', port: int = 0, max_workers: int = 32):
+        self.faults = faults or FaultInjector()
+        self.answer_rate = answer_rate
+        handler = grpc.method_handlers_generic_handler('google.cloud.dialogflow.v2.Sessions', {
+            'DetectIntent': grpc.unary_unary_rpc_method_handler(
+                self._detect_intent,
+                request_deserializer=DetectIntentRequest.deserialize,
+                response_serializer=DetectIntentResponse.serialize
+            )
+        })
+        self._server = grpc.server(futures.ThreadPoolExecutor(max_workers))
+        self._server.add_generic_rpc_handlers((handler,))
+        self.port = self._server.add_insecure_port(f"{host}:{port}")
+        self.endpoint = f"{host}:{self.port}"
+
+    def answers(self, text: str) -> bool:
+        bucket = int(hashlib.md5(text.encode('utf-8')).hexdigest()[:8], 16) % 1000
+        return bucket < self.answer_rate * 1000
+
+    def _detect_intent(self, request, context):
+        self.faults.delay()
+        if self.faults.should_fail():
+            context.abort(grpc.StatusCode.INTERNAL, "Injected failure")
+        text = request.query_input.text.text
+        response = DetectIntentResponse()
+        response.query_result.query_text = text
+        if self.answers(text):
+            answer = f"คำตอบจาก intent จำลองสำหรับ: {text}"
+            response.query_result.intent.display_name = f"intent-{hashlib.md5(text.encode('utf-8')).hexdigest()[:8]}"
+            response.query_result.intent_detection_confidence = 1.0
+            response.query_result.fulfillment_text = answer
+            response.query_result.fulfillment_messages.append(Intent.Message(text=Intent.Message.Text(text=[answer])))
+        else:
+            response.query_result.intent.display_name = "Default Fallback Intent"
+            response.query_result.intent.is_fallback = True
+            response.query_result.fulfillment_text = DIALOGFLOW_FALLBACK_TEXT
+        return response
+
+    def start(self):
+        self._server.start()
+        return self
+
+    def stop(self):
+        self._server.stop(grace=None)
@@ -0,0 +1,136 @@
+import logging
+import math
+import numpy as np
+import faiss
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+INDEX_TYPES = ('flat', 'ivf_flat', 'hnsw', 'ivf_pq')
+
+DEFAULT_INDEX_PARAMS = {
+    'nlist': None,          # จำนวน cluster ของ IVF (None = คำนวณจากขนาด corpus)
+    'nprobe': 8,            # จำนวน cluster ที่ค้นต่อคำถาม
+    'pq_m': 48,             # จำนวน sub-quantizer ของ PQ (ปรับให้หาร dimension ลงตัว)
+    'pq_nbits': 8,
+    'hnsw_m': 32,
+    'ef_construction': 200,
+    'ef_search': 64
+}
+
+
+def resolve_params(params: Optional[Dict] = None) -> Dict:
+    resolved = dict(DEFAULT_INDEX_PARAMS)
+    resolved.update({key: value for key, value in (params or {}).items() if value is not None})
+    return resolved
+
+
+def _nlist_for(num_vectors: int, requested: Optional[int]) -> int:
+    # faiss แนะนำให้มีจุด train อย่างน้อย ~39 จุดต่อ cluster
+    nlist = requested or int(4 * math.sqrt(num_vectors))
+    return max(1, min(nlist, num_vectors // 39 or 1))
+
+
+def _pq_subquantizers(dimension: int, requested: int) -> int:
+    for m in range(min(requested, dimension), 0, -1):
+        if dimension % m == 0:
+            return m
+    return 1
+
+
+def effective_index_type(index_type: str, num_vectors: int, params: Optional[Dict] = None) -> str:
+    """The structure :func:`build_index` actually builds for ``num_vectors`` vectors
+
+    IVF needs about 39 training points per cluster and PQ ``2 ** pq_nbits``
+    points per code book; below that the requested type falls back to flat.
+    """
+    params = resolve_params(params)
+    if index_type == 'ivf_pq' and num_vectors < 2 ** params['pq_nbits']:
+        return 'flat'
+    if index_type in ('ivf_flat', 'ivf_pq') and num_vectors < 39:
+        return 'flat'
+    return index_type
+
+
+def build_index(index_type: str, embeddings: np.ndarray, ids: np.ndarray, params: Optional[Dict] = None):
+    """Create, train and fill an ID-mapped inner-product index of ``index_type``
+
+    Falls back to an exact flat index when the corpus is too small to train
+    the requested structure.
+    """
+    params = resolve_params(params)
+    num_vectors, dimension = embeddings.shape
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type: {index_type} (expected one of {', '.join(INDEX_TYPES)})")
+
+    effective = effective_index_type(index_type, num_vectors, params)
+    if effective != index_type:
+        logger.warning(f"Only {num_vectors} vectors, too few to train {index_type}; using a flat index")
+        index_type = effective
+
+    if index_type == 'flat':
+        base = faiss.IndexFlatIP(dimension)
+    elif index_type == 'hnsw':
+        base = faiss.IndexHNSWFlat(dimension, params['hnsw_m'], faiss.METRIC_INNER_PRODUCT)
+        base.hnsw.efConstruction = params['ef_construction']
+    else:
+        nlist = _nlist_for(num_vectors, params['nlist'])
+        quantizer = faiss.IndexFlatIP(dimension)
+        if index_type == 'ivf_flat':
+            base = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_INNER_PRODUCT)
+        else:
+            m = _pq_subquantizers(dimension, params['pq_m'])
+            base = faiss.IndexIVFPQ(quantizer, dimension, nlist, m, params['pq_nbits'], faiss.METRIC_INNER_PRODUCT)
+        base.train(embeddings)
+
+    index = faiss.IndexIDMap2(base)
+    if num_vectors:
+        index.add_with_ids(embeddings, ids)
+    configure_search(index, params)
+    logger.info(f"Built {index_type} index with {index.ntotal} vectors")
+    return index
+
+
+def read_index(path: str, mmap: bool = False):
+    """Read a saved index; with ``mmap`` its vectors stay in the page cache shared by every process
+
+    ``IO_FLAG_MMAP_IFC`` maps the codes of flat, HNSW and IVF indexes
+    alike, whereas ``IO_FLAG_MMAP`` only covers IVF inverted lists and
+    would copy a flat index into each worker's heap.
+    """
+    io_flags = faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY if mmap else 0
+    return faiss.read_index(path, io_flags)
+
+
+def base_index(index):
+    return faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+
+
+def index_kind(index) -> str:
+    base = base_index(index)
+    if isinstance(base, faiss.IndexHNSW):
+        return 'hnsw'
+    if isinstance(base, faiss.IndexIVFPQ):
+        return 'ivf_pq'
+    if isinstance(base, faiss.IndexIVF):
+        return 'ivf_flat'
+    return 'flat'
+
+
+def configure_search(index, params: Optional[Dict] = None):
+    """Apply query-time parameters (``nprobe`` for IVF, ``ef_search`` for HNSW)"""
+    params = resolve_params(params)
+    base = base_index(index)
+    if isinstance(base, faiss.IndexIVF):
+        base.nprobe = min(params['nprobe'], base.nlist)
+    elif isinstance(base, faiss.IndexHNSW):
+        base.hnsw.efSearch = params['ef_search']
+
+
+def supports_remove(index) -> bool:
+    # HNSW ลบเวกเตอร์ออกจากกราฟไม่ได้ ต้องสร้าง index ใหม่
+    return not isinstance(base_index(index), faiss.IndexHNSW)
+
+
+def index_memory_bytes(index) -> int:
+    return int(faiss.serialize_index(index).nbytes)
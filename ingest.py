@@ -0,0 +1,246 @@
+import os
+import json
+import time
+import logging
+import multiprocessing
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+READ_CHUNK_SIZE = 1 << 16
+# ไม่ log record ที่เสียทุกตัว เผื่อไฟล์ใหญ่ที่เสียทั้งไฟล์
+MAX_LOGGED_BAD_RECORDS = 10
+# record เดียวที่ยาวเกินนี้ (จำนวนตัวอักษร) ถือว่าไฟล์เสีย เช่น array ที่ไม่มีวงเล็บปิด ไม่อ่านทั้งไฟล์เข้า memory
+MAX_RECORD_SIZE = 16 << 20
+
+
+def _iter_json_array(f, chunk_size: int = READ_CHUNK_SIZE, max_record_size: int = MAX_RECORD_SIZE) -> Iterator:
+    """Yield the items of a top-level JSON array one at a time
+
+    Only the current item and one read chunk are held in memory; an item
+    longer than ``max_record_size`` characters raises ``ValueError``.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    pos = 0
+    eof = False
+    started = False
+    while True:
+        while pos < len(buffer) and buffer[pos] in ' \t\r\n' + (',' if started else ''):
+            pos += 1
+        if pos >= len(buffer):
+            if eof:
+                raise ValueError("Unexpected end of file" if started else "Empty file, expected a JSON array")
+            chunk = f.read(chunk_size)
+            buffer, pos, eof = buffer[pos:] + chunk, 0, not chunk
+            continue
+        if not started:
+            if buffer[pos] != '[':
+                raise ValueError("Expected a JSON array")
+            started = True
+            pos += 1
+            continue
+        if buffer[pos] == ']':
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            end = None
+        # ค่าที่จบพอดีท้าย buffer อาจยังอ่านไม่ครบ (เช่นตัวเลข) ให้อ่านต่อก่อน
+        if end is None or (end == len(buffer) and not eof):
+            if len(buffer) - pos > max_record_size:
+                raise ValueError(f"Record longer than {max_record_size} characters, the file may be truncated")
+            chunk = f.read(chunk_size)
+            buffer, pos, eof = buffer[pos:] + chunk, 0, not chunk
+            continue
+        yield item
+        pos = end
+
+
+def iter_records(path: str, stats: Optional[Dict] = None) -> Iterator:
+    """Lazily yield raw records from a JSON array file or a JSONL file
+
+    Malformed JSONL lines are skipped and counted in ``stats['bad_records']``;
+    a syntax error inside a JSON array ends that file after the records
+    already yielded.
+    """
+    stats = stats if stats is not None else {}
+    with open(path, 'r', encoding='utf-8-sig') as f:
+        if not path.endswith('.jsonl'):
+            yield from _iter_json_array(f)
+            return
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                stats['bad_records'] = stats.get('bad_records', 0) + 1
+                if stats['bad_records'] <= MAX_LOGGED_BAD_RECORDS:
+                    logger.warning(f"Skipping malformed line {line_number} in {path}: {str(e)}")
+                continue
+            yield record
+
+
+def to_document(record, source: str) -> Optional[Dict]:
+    """Normalize a Q&A item or a policy passage (``text``/``content`` with optional ``title``)"""
+    if not isinstance(record, dict):
+        return None
+    if 'question' in record and 'answer' in record:
+        question, answer = record['question'], record['answer']
+    elif record.get('text') or record.get('content'):
+        question, answer = record.get('title') or '', record.get('text') or record.get('content')
+    else:
+        return None
+    if not isinstance(question, str) or not isinstance(answer, str):
+        return None
+    return {'question': question, 'answer': answer, 'source': source}
+
+
+def iter_documents(path: str, stats: Optional[Dict] = None) -> Iterator[Dict]:
+    stats = stats if stats is not None else {}
+    source = os.path.basename(path)
+    for record in iter_records(path, stats):
+        doc = to_document(record, source)
+        if doc is None:
+            stats['skipped'] = stats.get('skipped', 0) + 1
+            continue
+        yield doc
+
+
+def batched(iterable: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+_worker_encoder = None
+
+
+def _init_worker(encoder_args: Tuple):
+    global _worker_encoder
+    from encoders import create_encoder
+    _worker_encoder = create_encoder(*encoder_args)
+
+
+def _encode_in_worker(texts: List[str]) -> np.ndarray:
+    embeddings = _worker_encoder.encode(texts, convert_to_numpy=True, normalize_embeddings=True)
+    return embeddings.astype('float32')
+
+
+def encode_batches(batches: Iterable[Tuple[object, List[str]]], encode_fn: Callable[[List[str]], np.ndarray],
+                   workers: int = 0, encoder_args: Optional[Tuple] = None) -> Iterator[Tuple[object, np.ndarray]]:
+    """Encode ``(payload, texts)`` batches and yield ``(payload, embeddings)`` in input order
+
+    With ``workers > 1`` each worker process loads its own copy of the encoder
+    (``encoder_args`` are passed to ``create_encoder``) and at most two
+    batches per worker are in flight, so memory stays bounded.
+    """
+    if workers <= 1:
+        for payload, texts in batches:
+            yield payload, encode_fn(texts)
+        return
+
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker,
+                             initargs=(encoder_args,)) as pool:
+        pending = deque()
+        for payload, texts in batches:
+            pending.append((payload, pool.submit(_encode_in_worker, texts)))
+            if len(pending) >= workers * 2:
+                payload, future = pending.popleft()
+                yield payload, future.result()
+        while pending:
+            payload, future = pending.popleft()
+            yield payload, future.result()
+
+
+class EmbeddingSpool:
+    """Collect embedding batches without holding two copies of the matrix
+
+    With a ``path`` rows are appended to a raw file and converted to a
+    memory-mapped ``.npy`` on ``finish``; without one they are kept in memory.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.rows = 0
+        self.dimension = None
+        self._parts = []
+        self._raw = open(f"{path}.raw", 'wb') if path else None
+
+    def append(self, embeddings: np.ndarray):
+        if self.dimension is None:
+            self.dimension = embeddings.shape[1]
+        self.rows += len(embeddings)
+        if self._raw is not None:
+            self._raw.write(np.ascontiguousarray(embeddings, dtype='float32').tobytes())
+        else:
+            self._parts.append(embeddings)
+
+    def abort(self):
+        if self._raw is not None:
+            self._raw.close()
+            if os.path.exists(f"{self.path}.raw"):
+                os.remove(f"{self.path}.raw")
+
+    def finish(self, chunk_rows: int = 65536) -> Optional[np.ndarray]:
+        if self._raw is None:
+            return np.vstack(self._parts).astype('float32') if self._parts else None
+        self._raw.close()
+        raw_path = f"{self.path}.raw"
+        try:
+            if not self.rows:
+                return None
+            raw = np.memmap(raw_path, dtype='float32', mode='r', shape=(self.rows, self.dimension))
+            out = np.lib.format.open_memmap(f"{self.path}.tmp", mode='w+', dtype='float32',
+                                            shape=(self.rows, self.dimension))
+            for start in range(0, self.rows, chunk_rows):
+                out[start:start + chunk_rows] = raw[start:start + chunk_rows]
+            out.flush()
+            del out, raw
+            os.replace(f"{self.path}.tmp", self.path)
+            return np.load(self.path, mmap_mode='r')
+        finally:
+            os.remove(raw_path)
+
+
+class ProgressReporter:
+    """Log throughput every ``every`` documents and at the end"""
+
+    def __init__(self, every: int = 1000, callback: Optional[Callable[[Dict], None]] = None):
+        self.every = every
+        self.callback = callback
+        self.start = time.perf_counter()
+        self.documents = 0
+        self._next = every
+
+    def update(self, count: int, source: str):
+        self.documents += count
+        if self.documents >= self._next:
+            self._next += self.every
+            self.report(source)
+
+    def report(self, source: Optional[str] = None):
+        elapsed = time.perf_counter() - self.start
+        progress = {
+            'documents': self.documents,
+            'seconds': elapsed,
+            'docs_per_second': self.documents / elapsed if elapsed else 0.0,
+            'source': source
+        }
+        logger.info(f"Ingested {self.documents} documents ({progress['docs_per_second']:.1f} docs/s)"
+                    + (f", current file {source}" if source else ""))
+        if self.callback is not None:
+            self.callback(progress)
+        return progress
@@ -0,0 +1,334 @@
+import os
+import json
+import time
+import zipfile
+import logging
+import threading
+import numpy as np
+from typing import Callable, Dict, List, Optional
+from embedding_service import normalize_query
+
+logger = logging.getLogger(__name__)
+
+INTENT_CACHE_FORMAT_VERSION = 1
+# context ที่ Dialogflow สร้างเองทุกครั้ง ไม่ได้แปลว่า intent นี้อยู่ในบทสนทนาต่อเนื่อง
+SYSTEM_CONTEXT_SUFFIXES = ('__system_counters__',)
+
+
+def _normalize(text: str) -> str:
+    # ใช้เป็น key สำหรับรวมตัวอย่างที่ซ้ำกันเท่านั้น ส่วนข้อความที่ encode คือ normalize_query(text)
+    return normalize_query(text).lower()
+
+
+def _cacheable_result(query_result: Dict, min_confidence: float, invalid_texts=()) -> bool:
+    """Only static, context-free answers may be served without Dialogflow"""
+    intent = query_result.get('intent') or {}
+    if not intent.get('displayName') or intent.get('isFallback'):
+        return False
+    if query_result.get('intentDetectionConfidence', 0.0) < min_confidence:
+        return False
+    if query_result.get('webhookSource') or query_result.get('webhookPayload'):
+        return False
+    if any(value not in ('', None, [], {}) for value in (query_result.get('parameters') or {}).values()):
+        return False
+    for context in query_result.get('outputContexts') or []:
+        if not context.get('name', '').endswith(SYSTEM_CONTEXT_SUFFIXES):
+            return False
+    texts = [text for message in query_result.get('fulfillmentMessages') or []
+             for text in (message.get('text') or {}).get('text') or []]
+    has_payload = any('payload' in message or 'quickReplies' in message
+                      for message in query_result.get('fulfillmentMessages') or [])
+    if texts and all(text in invalid_texts for text in texts) and not has_payload:
+        return False
+    fulfillment_text = query_result.get('fulfillmentText')
+    return bool(has_payload or [text for text in texts if text not in invalid_texts]
+                or (fulfillment_text and fulfillment_text not in invalid_texts))
+
+
+def has_active_contexts(query_result: Dict) -> bool:
+    return any(not context.get('name', '').endswith(SYSTEM_CONTEXT_SUFFIXES)
+               for context in query_result.get('outputContexts') or [])
+
+
+def _export_messages(messages: List[Dict], language: str) -> List[Dict]:
+    """Convert the ``messages`` of an exported intent to ``fulfillmentMessages`` dicts"""
+    converted = []
+    for message in messages:
+        if message.get('lang', language) != language:
+            continue
+        kind = str(message.get('type'))
+        if kind in ('0', 'message') and message.get('speech'):
+            speech = message['speech']
+            converted.append({'text': {'text': speech if isinstance(speech, list) else [speech]}})
+        elif kind in ('2', 'quick_reply') and message.get('replies'):
+            converted.append({'quickReplies': {'title': message.get('title', ''), 'quickReplies': message['replies']}})
+        elif kind in ('4', 'custom_payload') and message.get('payload'):
+            converted.append({'payload': message['payload']})
+    return converted
+
+
+class LocalIntentClassifier:
+    """Nearest-neighbour intent classifier over the RAG encoder's embeddings
+
+    Learns (question, intent, fulfillment) triples from Dialogflow responses
+    or an exported agent. ``classify`` answers only when the nearest examples
+    agree on a cacheable intent above ``threshold``; otherwise the caller
+    should ask Dialogflow.
+
+    Examples are encoded in the ``normalize_query`` form that retrieval
+    uses, so a message costs one encoder pass shared with the document
+    search. A stored fulfillment is served for ``response_ttl`` seconds
+    after it was last seen; after that the intent defers to Dialogflow
+    again, whose next answer refreshes it.
+    """
+
+    def __init__(self, encode_fn: Callable[[List[str]], np.ndarray], threshold: float = 0.92, k: int = 5,
+                 min_agreement: float = 0.8, min_examples: int = 2, min_confidence: float = 0.7,
+                 max_examples: int = 5000, path: Optional[str] = None, invalid_texts=(),
+                 response_ttl: float = 3600):
+        self.encode_fn = encode_fn
+        self.threshold = threshold
+        self.k = k
+        self.min_agreement = min_agreement
+        self.min_examples = min_examples
+        self.min_confidence = min_confidence
+        self.max_examples = max_examples
+        self.path = path
+        self.invalid_texts = tuple(invalid_texts)
+        self.response_ttl = response_ttl
+        self._lock = threading.Lock()
+        self._texts = []
+        self._intents = []
+        self._counts = []
+        self._embeddings = None
+        self._responses = {}
+        self._learned_at = {}  # intent -> เวลาที่ได้ fulfillment นี้มา (time.time())
+        self._trusted = set()
+        self._unsaved = 0
+        # session ที่อยู่ระหว่างบทสนทนาต่อเนื่อง (มี context ค้างอยู่) ต้องถาม Dialogflow เสมอ
+        self._active_sessions = {}
+        self.session_ttl = 20 * 60
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        if path and os.path.exists(path):
+            self.load(path)
+
+    def __len__(self) -> int:
+        return len(self._texts)
+
+    def _add(self, texts: List[str], intent: str, embeddings: np.ndarray):
+        index = {_normalize(text): i for i, text in enumerate(self._texts)}
+        new_rows = []
+        for text, embedding in zip(texts, embeddings):
+            row = index.get(_normalize(text))
+            if row is not None:
+                # คำถามเดิมที่ได้ intent เดิมซ้ำ นับเป็นหลักฐานเพิ่ม
+                self._counts[row] = self._counts[row] + 1 if self._intents[row] == intent else 1
+                self._intents[row] = intent
+                continue
+            self._texts.append(text)
+            self._intents.append(intent)
+            self._counts.append(1)
+            new_rows.append(embedding.reshape(1, -1).astype('float32'))
+            index[_normalize(text)] = len(self._texts) - 1
+        if new_rows:
+            # สร้าง matrix ใหม่แทนการแก้ของเดิม classify ที่อ่านอยู่จึงไม่ต้องถือ lock ระหว่างคำนวณ
+            self._embeddings = np.vstack(([self._embeddings] if self._embeddings is not None else []) + new_rows)
+        overflow = len(self._texts) - self.max_examples
+        if overflow > 0:
+            # ลบตัวอย่างที่เก่าที่สุดออก
+            del self._texts[:overflow]
+            del self._intents[:overflow]
+            del self._counts[:overflow]
+            self._embeddings = self._embeddings[overflow:]
+
+    def learn(self, text: str, response: Dict, session_id: Optional[str] = None) -> bool:
+        """Record an observed Dialogflow response (``MessageToDict`` form); returns True if it was kept"""
+        query_result = response.get('queryResult') or {}
+        if session_id is not None:
+            with self._lock:
+                if has_active_contexts(query_result):
+                    self._active_sessions[session_id] = time.monotonic() + self.session_ttl
+                else:
+                    self._active_sessions.pop(session_id, None)
+        if not _cacheable_result(query_result, self.min_confidence, self.invalid_texts):
+            return False
+        intent = query_result['intent']['displayName']
+        # ข้อความเดียวกับที่การค้นเอกสาร encode ใช้ embedding ใน cache ร่วมกัน และตรงกับตอน load
+        text = normalize_query(text)
+        embedding = self.encode_fn([text])
+        with self._lock:
+            self._responses[intent] = {
+                'fulfillmentText': query_result.get('fulfillmentText', ''),
+                'fulfillmentMessages': query_result.get('fulfillmentMessages', [])
+            }
+            self._learned_at[intent] = time.time()
+            self._add([text], intent, embedding)
+            self._unsaved += 1
+            save = self.path and self._unsaved >= 20
+        if save:
+            self.save()
+        return True
+
+    def forget(self, intent: str):
+        with self._lock:
+            self._responses.pop(intent, None)
+            self._learned_at.pop(intent, None)
+
+    def _record(self, hit: bool, stale: bool = False):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self.stale += stale
+
+    def classify(self, text: str, session_id: Optional[str] = None) -> Optional[Dict]:
+        """Return ``{'queryResult': ...}`` with the cached fulfillment, or None to defer to Dialogflow"""
+        with self._lock:
+            expires = self._active_sessions.get(session_id) if session_id is not None else None
+            if expires is not None and expires < time.monotonic():
+                del self._active_sessions[session_id]
+                expires = None
+            embeddings = self._embeddings
+            intents = list(self._intents)
+            counts = list(self._counts)
+        if expires is not None or embeddings is None or not len(intents):
+            self._record(False)
+            return None
+        query = self.encode_fn([normalize_query(text)]).reshape(-1)
+        scores = embeddings @ query
+        top = np.argsort(-scores)[:self.k]
+        if scores[top[0]] < self.threshold:
+            self._record(False)
+            return None
+        votes = {}
+        for row in top:
+            if scores[row] >= self.threshold:
+                votes[intents[row]] = votes.get(intents[row], 0.0) + float(scores[row])
+        intent = max(votes, key=votes.get)
+        support = sum(counts[row] for row in top if scores[row] >= self.threshold and intents[row] == intent)
+        with self._lock:
+            response = self._responses.get(intent)
+            learned_at = self._learned_at.get(intent, 0.0)
+            trusted = intent in self._trusted
+        if response is not None and time.time() - learned_at > self.response_ttl:
+            # fulfillment อาจถูกแก้ใน Dialogflow console แล้ว ให้ Dialogflow ตอบและ learn ค่าใหม่
+            self._record(False, stale=True)
+            return None
+        if response is None or votes[intent] / sum(votes.values()) < self.min_agreement \
+                or (support < self.min_examples and not trusted):
+            self._record(False)
+            return None
+        self._record(True)
+        result = dict(response, intent={'displayName': intent}, intentDetectionConfidence=float(scores[top[0]]))
+        return {'queryResult': result, 'localIntent': True}
+
+    def load_agent_export(self, path: str, language: str = 'th') -> int:
+        """Learn training phrases and static responses from a Dialogflow ES agent export (zip or directory)
+
+        Intents that use a webhook, contexts or parameters are skipped. Returns
+        the number of intents loaded.
+        """
+        if zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path) as archive:
+                files = {name: archive.read(name) for name in archive.namelist() if name.startswith('intents/')}
+        else:
+            intents_dir = os.path.join(path, 'intents')
+            files = {}
+            for name in os.listdir(intents_dir):
+                with open(os.path.join(intents_dir, name), 'rb') as f:
+                    files[f"intents/{name}"] = f.read()
+
+        loaded = 0
+        for name, content in files.items():
+            if not name.endswith('.json') or '_usersays_' in name:
+                continue
+            intent = json.loads(content)
+            if intent.get('webhookUsed') or intent.get('contexts') or intent.get('fallbackIntent'):
+                continue
+            responses = intent.get('responses') or [{}]
+            response = responses[0]
+            if response.get('affectedContexts') or response.get('parameters'):
+                continue
+            messages = _export_messages(response.get('messages') or [], language)
+            usersays = files.get(name[:-len('.json')] + f"_usersays_{language}.json")
+            if not messages or not usersays:
+                continue
+            phrases = [normalize_query(''.join(part.get('text', '') for part in example.get('data', [])))
+                       for example in json.loads(usersays)]
+            phrases = [phrase for phrase in phrases if phrase]
+            if not phrases:
+                continue
+            display_name = intent.get('name', os.path.basename(name)[:-len('.json')])
+            embeddings = self.encode_fn(phrases)
+            with self._lock:
+                self._responses[display_name] = {'fulfillmentText': '', 'fulfillmentMessages': messages}
+                self._learned_at[display_name] = time.time()
+                self._trusted.add(display_name)
+                self._add(phrases, display_name, embeddings)
+            loaded += 1
+        logger.info(f"Loaded {loaded} intents from agent export {path}")
+        return loaded
+
+    def save(self, path: Optional[str] = None):
+        path = path or self.path
+        if not path:
+            return
+        with self._lock:
+            state = {
+                'version': INTENT_CACHE_FORMAT_VERSION,
+                'saved_at': time.time(),
+                'examples': [{'text': text, 'intent': intent, 'count': count}
+                             for text, intent, count in zip(self._texts, self._intents, self._counts)],
+                'responses': dict(self._responses),
+                'learned_at': dict(self._learned_at),
+                'trusted': sorted(self._trusted)
+            }
+            self._unsaved = 0
+        try:
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(state, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.error(f"Error saving intent cache: {str(e)}")
+
+    def load(self, path: str):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            if state.get('version') != INTENT_CACHE_FORMAT_VERSION:
+                logger.info("Intent cache has a different format, starting empty")
+                return
+            examples = state.get('examples') or []
+            embeddings = self.encode_fn([example['text'] for example in examples]) if examples else None
+            with self._lock:
+                self._texts = [example['text'] for example in examples]
+                self._intents = [example['intent'] for example in examples]
+                self._counts = [example.get('count', 1) for example in examples]
+                self._embeddings = np.asarray(embeddings, dtype='float32') if embeddings is not None else None
+                self._responses = state.get('responses') or {}
+                learned_at = state.get('learned_at') or {}
+                self._learned_at = {intent: learned_at.get(intent, state.get('saved_at', 0.0))
+                                    for intent in self._responses}
+                self._trusted = set(state.get('trusted') or [])
+            logger.info(f"Loaded {len(examples)} intent examples from {path}")
+        except Exception as e:
+            logger.error(f"Error loading intent cache: {str(e)}")
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            intents = len(self._responses)
+            examples = len(self._texts)
+            hits, misses, stale = self.hits, self.misses, self.stale
+        lookups = hits + misses
+        return {
+            'intents': intents,
+            'examples': examples,
+            'hits': hits,
+            'misses': misses,
+            'stale': stale,
+            'hit_rate': hits / lookups if lookups else 0.0
+        }
@@ -0,0 +1,158 @@
+import re
+import math
+import logging
+import unicodedata
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+try:
+    from pythainlp.tokenize import word_tokenize
+except ImportError:
+    word_tokenize = None
+
+logger = logging.getLogger(__name__)
+
+# pythainlp อยู่ใน requirements.txt ถ้าไม่ได้ติดตั้งจะตัดคำไทยเป็น n-gram ของตัวอักษรแทน
+# คะแนน BM25 และการตัดคำลงท้ายสุภาพจึงต่างกันระหว่างสองแบบ (log ไว้ครั้งแรกที่สร้าง index)
+_tokenizer_logged = False
+
+_LATIN_WORD = re.compile(r"[a-z0-9]+")
+_THAI_RUN = re.compile(r"[\u0e00-\u0e7f]+")
+_DIGITS = re.compile(r'\d+')
+# คำลงท้ายสุภาพที่ไม่เปลี่ยนความหมายของคำถาม
+_POLITE_PARTICLES = {'ครับผม', 'ครับ', 'คับ', 'ค่ะ', 'คะ', 'จ้า', 'จ้ะ', 'นะ', 'นะคะ', 'นะครับ'}
+
+
+def normalize_text(text: str) -> str:
+    """Lower-case and drop whitespace, punctuation, symbols and polite endings
+
+    Thai is written without spaces, so two phrasings that only differ in
+    spacing, a trailing question mark or "ครับ/ค่ะ" normalize to the same
+    string. A polite particle is only dropped when it is a word of its own
+    (pythainlp word boundaries, or whitespace without pythainlp), so a word
+    that merely ends in the same letters, like "ชนะ", is kept whole.
+    """
+    text = unicodedata.normalize('NFKC', text).lower()
+    text = ''.join(' ' if unicodedata.category(ch)[0] in ('Z', 'P', 'S', 'C') else ch for ch in text)
+    if word_tokenize is not None:
+        words = [word for word in word_tokenize(text, keep_whitespace=False) if word.strip()]
+    else:
+        words = text.split()
+    while len(words) > 1 and words[-1] in _POLITE_PARTICLES:
+        words.pop()
+    return ''.join(words)
+
+
+def number_signature(text: str) -> frozenset:
+    """The numbers in ``text``; texts that differ only in a fee, a year or a date never match"""
+    return frozenset(_DIGITS.findall(text))
+
+
+def tokenize(text: str) -> List[str]:
+    """Latin/digit words plus Thai words (pythainlp) or Thai character n-grams"""
+    text = unicodedata.normalize('NFKC', text).lower()
+    tokens = _LATIN_WORD.findall(text)
+    for run in _THAI_RUN.findall(text):
+        if word_tokenize is not None:
+            tokens.extend(token for token in word_tokenize(run, keep_whitespace=False) if token.strip())
+        else:
+            tokens.extend(run[i:i + n] for n in (2, 3) for i in range(len(run) - n + 1))
+            if len(run) == 1:
+                tokens.append(run)
+    return tokens
+
+
+def _bigrams(text: str) -> set:
+    return {text[i:i + 2] for i in range(len(text) - 1)} or {text}
+
+
+class LexicalIndex:
+    """BM25 inverted index over document questions and answers
+
+    Question tokens are counted twice so that a hit on the question
+    outranks the same hit buried in a long answer. Documents in ``aliases``
+    (near-duplicates merged at index time) are not indexed themselves;
+    their questions become extra keys of the canonical document instead.
+    """
+
+    def __init__(self, documents: Dict[int, Dict], k1: float = 1.5, b: float = 0.75,
+                 aliases: Optional[Dict[int, int]] = None):
+        global _tokenizer_logged
+        if not _tokenizer_logged:
+            _tokenizer_logged = True
+            if word_tokenize is None:
+                logger.warning("pythainlp is not installed, tokenizing Thai text into character n-grams")
+            else:
+                logger.info("Tokenizing Thai text with pythainlp")
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(list)  # token -> [(doc_id, tf)]
+        self.doc_lengths = {}
+        self.questions = {}  # normalized question -> doc_id
+        # doc_id -> [(bigram, ตัวเลขในคำถาม)] ของคำถามหลักและคำถามอื่นที่ถูกรวมไว้
+        self.question_bigrams = defaultdict(list)
+        alternates = defaultdict(list)
+        for alias_id, canonical_id in (aliases or {}).items():
+            alternates[canonical_id].append(documents[alias_id]['question'])
+        for doc_id, doc in documents.items():
+            if aliases and doc_id in aliases:
+                continue
+            tokens = tokenize(doc['question']) * 2 + tokenize(doc['answer'])
+            for question in alternates.get(doc_id, ()):
+                tokens.extend(tokenize(question))
+            self.doc_lengths[doc_id] = len(tokens)
+            for token, tf in Counter(tokens).items():
+                self.postings[token].append((doc_id, tf))
+            for question in [doc['question']] + alternates.get(doc_id, []):
+                normalized = normalize_text(question)
+                if normalized:
+                    self.questions.setdefault(normalized, doc_id)
+                    self.question_bigrams[doc_id].append((_bigrams(normalized), number_signature(normalized)))
+        self.num_docs = len(self.doc_lengths)
+        self.avg_length = sum(self.doc_lengths.values()) / self.num_docs if self.num_docs else 0.0
+        self.idf = {
+            token: math.log(1 + (self.num_docs - len(posting) + 0.5) / (len(posting) + 0.5))
+            for token, posting in self.postings.items()
+        }
+
+    def search(self, query: str, k: int = 10) -> List[Tuple[int, float]]:
+        if not self.num_docs:
+            return []
+        scores = defaultdict(float)
+        for token in set(tokenize(query)):
+            posting = self.postings.get(token)
+            if not posting:
+                continue
+            idf = self.idf[token]
+            for doc_id, tf in posting:
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / self.avg_length)
+                scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+    def match_question(self, query: str, min_similarity: float = 0.85) -> Optional[int]:
+        """Doc id whose question equals (or nearly equals) ``query``
+
+        Exact matches are a dict lookup on the normalized text; otherwise the
+        best BM25 candidates are compared by character-bigram Jaccard
+        similarity of their normalized questions. A near match must contain
+        the same numbers as ``query``, so asking about 2567 never returns the
+        answer stored for 2566.
+        """
+        normalized = normalize_text(query)
+        if not normalized:
+            return None
+        doc_id = self.questions.get(normalized)
+        if doc_id is not None or min_similarity >= 1.0:
+            return doc_id
+
+        query_bigrams = _bigrams(normalized)
+        query_numbers = number_signature(normalized)
+        best_id, best_similarity = None, min_similarity
+        for candidate_id, _ in self.search(query, k=5):
+            for candidate, numbers in self.question_bigrams.get(candidate_id, ()):
+                if numbers != query_numbers:
+                    continue
+                similarity = len(query_bigrams & candidate) / len(query_bigrams | candidate)
+                if similarity >= best_similarity:
+                    best_id, best_similarity = candidate_id, similarity
+        return best_id
@@ -1,37 +1,124 @@
+import os
 import json
+import hashlib
 import logging
+import threading
+import time
+from collections import OrderedDict
+import metrics
+from google.protobuf.json_format import MessageToDict, MessageToJson
 from linebot.v3.messaging import (
-    TextMessage, FlexMessage, FlexContainer, ReplyMessageRequest,
-    QuickReply, QuickReplyItem, MessageAction
+    TextMessage, FlexMessage, FlexContainer, ReplyMessageRequest, PushMessageRequest,
+    QuickReply, QuickReplyItem, MessageAction, ApiException
 )
 
 logger = logging.getLogger(__name__)
 
-def process_payload(payload, messages_list):
+# reply token ของ LINE ใช้ได้ประมาณ 1 นาที เผื่อเวลาไว้ก่อนหมดอายุจริง
+REPLY_TOKEN_TTL = 50
+
+# จำนวน Flex container และชุด quick reply ที่สร้างแล้วเก็บไว้ใช้ซ้ำ (คีย์คือ hash ของ payload)
+MESSAGE_CACHE_SIZE = int(os.getenv("MESSAGE_CACHE_SIZE") or 256)
+
+
+class _LazyFormat:
+    """
+    เลื่อนการจัดรูปข้อความ log ไปจนกว่า logger จะใช้จริง (ใช้กับ logger.info("... %s", ...))
+    """
+
+    def __init__(self, fn, *args):
+        self.fn = fn
+        self.args = args
+
+    def __str__(self):
+        return self.fn(*self.args)
+
+
+class _BuiltMessageCache:
+    """
+    LRU ของวัตถุข้อความ LINE ที่สร้างแล้ว ค่าที่เก็บต้องไม่ถูกแก้ไขหลังสร้าง
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_build(self, key, build):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        value = build()
+        if self.max_entries > 0:
+            with self._lock:
+                self._entries[key] = value
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return value
+
+    def get_stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+
+_flex_cache = _BuiltMessageCache(MESSAGE_CACHE_SIZE)
+_quick_reply_cache = _BuiltMessageCache(MESSAGE_CACHE_SIZE)
+
+def reply_token_expired(received_at):
+    """
+    ตรวจว่า reply token (ที่ได้รับเมื่อ received_at, epoch วินาที) น่าจะหมดอายุแล้วหรือไม่
+    """
+    return received_at is not None and time.time() - received_at > REPLY_TOKEN_TTL
+
+@metrics.track('line_send')
+def deliver_messages(line_bot_api, reply_token, messages, push_to=None, received_at=None):
+    """
+    ตอบกลับด้วย reply token และใช้ push message แทนเมื่อ token หมดอายุหรือใช้ไม่ได้
+    (ต้องระบุ push_to เป็น user/group/room id จึงจะ fallback ได้)
+    """
+    if push_to and reply_token_expired(received_at):
+        logger.info("reply token หมดอายุแล้ว ส่งด้วย push message แทน")
+        line_bot_api.push_message_with_http_info(PushMessageRequest(to=push_to, messages=messages))
+        return
     try:
-        logger.info(f"กำลังประมวลผล payload: {json.dumps(payload, indent=2, ensure_ascii=False)[:500]}")
-        if 'line' in payload and isinstance(payload['line'], dict):
-            line_content = payload['line']
-            if 'type' in line_content and line_content['type'] == 'flex':
-                flex_message = create_flex_message(line_content)
-                if flex_message:
-                    messages_list.append(flex_message)
-                return
-        if isinstance(payload, dict) and 'type' in payload and payload['type'] == 'flex':
-            flex_message = create_flex_message(payload)
-            if flex_message:
-                messages_list.append(flex_message)
-            return
-    except Exception as e:
-        logger.error(f"เกิดข้อผิดพลาดในการประมวลผล payload: {str(e)}")
+        reply_request = ReplyMessageRequest(
+            reply_token=reply_token,
+            messages=messages
+        )
+        line_bot_api.reply_message_with_http_info(reply_request)
+    except ApiException as e:
+        # 400 = reply token ไม่ถูกต้องหรือหมดอายุ ส่วนสถานะอื่นไม่ลองซ้ำเพื่อป้องกันข้อความซ้ำ
+        if not push_to or e.status != 400:
+            raise
+        logger.warning("reply token ใช้ไม่ได้ ส่งด้วย push message แทน")
+        line_bot_api.push_message_with_http_info(PushMessageRequest(to=push_to, messages=messages))
+
+def _flex_content(payload):
+    """
+    คืนค่าส่วน Flex ของ custom payload (รูปแบบ {"line": {...}} หรือ {"type": "flex", ...}) หรือ None
+    """
+    if not isinstance(payload, dict):
+        return None
+    if 'line' in payload and isinstance(payload['line'], dict):
+        line_content = payload['line']
+        return line_content if line_content.get('type') == 'flex' else None
+    return payload if payload.get('type') == 'flex' else None
 
 def create_flex_message(flex_content):
     try:
-        logger.info(f"กำลังสร้าง Flex Message: {json.dumps(flex_content)[:200]}...")
+        logger.info("กำลังสร้าง Flex Message: %s...", _LazyFormat(lambda: json.dumps(flex_content)[:200]))
         if 'contents' in flex_content:
-            flex_contents = flex_content['contents']
-            if isinstance(flex_contents, dict):
-                json.dumps(flex_contents)
             flex_container = FlexContainer.from_dict(flex_content['contents'])
             return FlexMessage(
                 alt_text=flex_content.get('altText', 'Flex Message'),
@@ -42,35 +129,142 @@ def create_flex_message(flex_content):
         logger.error(f"เกิดข้อผิดพลาดในการสร้าง Flex Message: {str(e)}")
         return None
 
-def send_multiple_messages(line_bot_api, reply_token, messages):
+def _build_flex(load_payload):
+    # คืนค่า (alt_text, FlexContainer) หรือ None เมื่อ payload ไม่ใช่ Flex จะได้ไม่ต้องตรวจซ้ำ
+    flex_message = None
+    flex_content = _flex_content(load_payload())
+    if flex_content is not None:
+        flex_message = create_flex_message(flex_content)
+    return (flex_message.alt_text, flex_message.contents) if flex_message else None
+
+def _cached_flex_message(key, load_payload):
+    built = _flex_cache.get_or_build(key, lambda: _build_flex(load_payload))
+    if built is None:
+        return None
+    # สร้าง FlexMessage ใหม่ทุกครั้ง เพราะผู้เรียกอาจใส่ quick_reply ลงในข้อความ ส่วน container ใช้ร่วมกันได้
+    alt_text, container = built
+    return FlexMessage(alt_text=alt_text, contents=container)
+
+def _build_quick_reply(replies):
+    items = [
+        # LINE จำกัดความยาวของป้ายชื่อไม่เกิน 20 ตัวอักษร
+        QuickReplyItem(action=MessageAction(label=reply[:20], text=reply))
+        for reply in replies
+    ]
+    return QuickReply(items=items) if items else None
+
+def _proto_parts(query_result):
+    for message in query_result.fulfillment_messages:
+        kind = message.WhichOneof('message')
+        if kind == 'text':
+            yield 'text', message.text.text
+        elif kind == 'quick_replies':
+            yield 'quick_replies', tuple(message.quick_replies.quick_replies)
+        elif kind == 'payload':
+            payload = message.payload
+            key = 'pb:' + hashlib.sha1(payload.SerializeToString(deterministic=True)).hexdigest()
+            yield 'payload', (key, lambda payload=payload: MessageToDict(payload))
+
+def _dict_parts(query_result):
+    for message in query_result.get('fulfillmentMessages') or []:
+        if 'text' in message:
+            yield 'text', (message['text'] or {}).get('text') or []
+        if 'quickReplies' in message:
+            replies = (message['quickReplies'] or {}).get('quickReplies')
+            yield 'quick_replies', tuple(replies) if isinstance(replies, list) else ()
+        if 'payload' in message:
+            payload = message['payload']
+            key = 'json:' + hashlib.sha1(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+            yield 'payload', (key, lambda payload=payload: payload)
+
+def _translate(parts, fulfillment_text, invalid_texts):
+    messages = []
+    quick_reply = None
+    for kind, value in parts:
+        if kind == 'text':
+            messages.extend(TextMessage(text=text) for text in value if text and text not in invalid_texts)
+        elif kind == 'quick_replies':
+            built = _quick_reply_cache.get_or_build(value, lambda: _build_quick_reply(value)) if value else None
+            if built is not None:
+                quick_reply = built
+                if messages:
+                    messages[-1].quick_reply = quick_reply
+        elif kind == 'payload':
+            key, load_payload = value
+            try:
+                flex_message = _cached_flex_message(key, load_payload)
+            except Exception as e:
+                logger.error(f"เกิดข้อผิดพลาดในการประมวลผล payload: {str(e)}")
+                flex_message = None
+            if flex_message is not None:
+                messages.append(flex_message)
+
+    # ถ้าไม่มีข้อความใน fulfillmentMessages ให้ใช้ fulfillmentText (ถ้ามี)
+    if not messages and fulfillment_text and fulfillment_text not in invalid_texts:
+        messages.append(TextMessage(text=fulfillment_text))
+    # ใส่ quick replies ในข้อความสุดท้ายถ้ายังไม่มี
+    if quick_reply is not None and messages and not messages[-1].quick_reply:
+        messages[-1].quick_reply = quick_reply
+    return messages, quick_reply
+
+@metrics.track('translate')
+def translate_query_result(query_result, invalid_texts=()):
+    """
+    แปลง QueryResult ของ Dialogflow เป็นข้อความ LINE โดยอ่าน field ของ protobuf โดยตรง
+    (ไม่แปลงทั้ง response เป็น dict) รับได้ทั้ง proto-plus และ protobuf ดิบ
+    คืนค่า (รายการข้อความ, QuickReply หรือ None)
+    """
+    query_result = getattr(query_result, '_pb', query_result)
+    return _translate(_proto_parts(query_result), query_result.fulfillment_text, invalid_texts)
+
+def translate_query_result_dict(query_result, invalid_texts=()):
+    """
+    เหมือน translate_query_result แต่รับ queryResult ในรูปแบบ dict (เช่นคำตอบที่ intent classifier เก็บไว้)
+    """
+    return _translate(_dict_parts(query_result), query_result.get('fulfillmentText'), invalid_texts)
+
+def _summarize_query_result(query_result):
+    kinds = [message.WhichOneof('message') for message in query_result.fulfillment_messages]
+    summary = (f"intent={query_result.intent.display_name or '-'} "
+               f"confidence={query_result.intent_detection_confidence:.2f} "
+               f"messages={kinds} text={query_result.fulfillment_text[:200]!r}")
+    if logger.isEnabledFor(logging.DEBUG):
+        summary += "\n" + MessageToJson(query_result, ensure_ascii=False)
+    return summary
+
+def describe_query_result(query_result):
+    """
+    ข้อความสรุป QueryResult สำหรับ log ที่สร้างเมื่อถูก log จริงเท่านั้น (ระดับ DEBUG จะแสดงทั้ง response)
+    """
+    return _LazyFormat(_summarize_query_result, getattr(query_result, '_pb', query_result))
+
+def get_message_cache_stats():
+    """
+    สถิติของแคช Flex container และ quick reply
+    """
+    return {"flex": _flex_cache.get_stats(), "quick_reply": _quick_reply_cache.get_stats()}
+
+def send_multiple_messages(line_bot_api, reply_token, messages, push_to=None, received_at=None):
     try:
         if not messages:
             logger.warning("ไม่มีข้อความที่จะส่ง")
             return
         logger.info(f"กำลังส่ง {len(messages)} ข้อความ")
-        reply_request = ReplyMessageRequest(
-            reply_token=reply_token,
-            messages=messages
-        )
-        line_bot_api.reply_message_with_http_info(reply_request)
+        deliver_messages(line_bot_api, reply_token, messages, push_to, received_at)
         logger.info("ส่งข้อความสำเร็จ")
     except Exception as e:
         logger.error(f"เกิดข้อผิดพลาดในการส่งข้อความหลายรายการ: {str(e)}")
         try:
-            send_text_message(line_bot_api, reply_token, "ขออภัย เกิดข้อผิดพลาดในการส่งข้อความ")
+            send_text_message(line_bot_api, reply_token, "ขออภัย เกิดข้อผิดพลาดในการส่งข้อความ", push_to, received_at)
         except:
             logger.error("ไม่สามารถส่งข้อความสำรองได้")
 
-def send_text_message(line_bot_api, reply_token, text):
+def send_text_message(line_bot_api, reply_token, text, push_to=None, received_at=None):
     try:
         text = text if text else "ขออภัย ไม่พบข้อมูล"
         if len(text) > 4997:
             text = text[:4997] + "..."
         logger.info(f"กำลังส่งข้อความตอบกลับ: {text[:100]}...")
-        reply_request = ReplyMessageRequest(
-            reply_token=reply_token,
-            messages=[TextMessage(text=text)]
-        )
-        line_bot_api.reply_message_with_http_info(reply_request)
+        deliver_messages(line_bot_api, reply_token, [TextMessage(text=text)], push_to, received_at)
     except Exception as e:
         logger.error(f"เกิดข้อผิดพลาดในการส่งข้อความตัวอักษร: {str(e)}")
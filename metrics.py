@@ -0,0 +1,287 @@
+import os
+import time
+import json
+import random
+import bisect
+import logging
+import threading
+import functools
+import inspect
+import contextvars
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# ปิดการเก็บ metrics ทั้งหมดได้ด้วย METRICS_ENABLED=false
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+# สัดส่วนของข้อความที่ log เวลาแต่ละขั้นตอนแบบละเอียด (0 = ปิด, 1 = ทุกข้อความ)
+METRICS_TRACE_SAMPLE_RATE = float(os.getenv("METRICS_TRACE_SAMPLE_RATE") or 0)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(names: Sequence[str], values: Tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        super().__init__(name, help_text, labels)
+        self._values = {}
+
+    def inc(self, *label_values, amount: float = 1.0):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def value(self, *label_values) -> float:
+        with self._lock:
+            return self._values.get(label_values, 0.0)
+
+    def items(self) -> Dict[Tuple, float]:
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+        return self.header() + [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+                                for key, value in sorted(values.items())]
+
+
+class Gauge(_Metric):
+    """Gauge set directly or read from ``fn`` at render time"""
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (), fn: Optional[Callable] = None):
+        super().__init__(name, help_text, labels)
+        self._values = {}
+        self.fn = fn
+
+    def inc(self, *label_values, amount: float = 1.0):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def dec(self, *label_values, amount: float = 1.0):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, value: float, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+    def render(self):
+        if self.fn is not None:
+            try:
+                values = {(): float(self.fn())}
+            except Exception as e:
+                logger.debug(f"Gauge {self.name} callback failed: {str(e)}")
+                return []
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return self.header() + [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+                                for key, value in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+
+    def observe(self, value: float, *label_values):
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # [นับแยกตาม bucket..., +Inf, sum]
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[position] += 1
+            series[-1] += value
+
+    def render(self):
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        lines = self.header()
+        for key, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), values[:-1]):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound!r}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {repr(values[-1])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.register(Histogram(
+    'linebot_stage_duration_seconds', 'Latency of each pipeline stage', ['stage']))
+STAGE_ERRORS = registry.register(Counter(
+    'linebot_stage_errors_total', 'Pipeline stage calls that raised or reported an error', ['stage']))
+IN_FLIGHT = registry.register(Gauge(
+    'linebot_in_flight', 'Calls currently running in each pipeline stage', ['stage']))
+OUTCOMES = registry.register(Counter(
+    'linebot_outcomes_total', 'How each message was answered', ['outcome']))
+
+# trace ที่กำลังเก็บอยู่ {'spans': [...], 'outcomes': [...]} ส่งต่อไปยัง thread อื่นได้ด้วย in_context
+_trace = contextvars.ContextVar('linebot_trace', default=None)
+
+
+def in_context(fn: Callable) -> Callable:
+    """Bind ``fn`` to a copy of the caller's context, so spans it records in an executor join the caller's trace"""
+    context = contextvars.copy_context()
+    return functools.partial(context.run, fn)
+
+
+@contextmanager
+def timed(stage: str):
+    """Time a block as ``stage``: histogram, in-flight gauge, error counter and the current trace"""
+    if not METRICS_ENABLED:
+        yield
+        return
+    IN_FLIGHT.inc(stage)
+    start = time.perf_counter()
+    failed = False
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        IN_FLIGHT.dec(stage)
+        STAGE_SECONDS.observe(elapsed, stage)
+        if failed:
+            STAGE_ERRORS.inc(stage)
+        state = _trace.get()
+        if state is not None:
+            state['spans'].append((stage, round(elapsed * 1000, 2), failed))
+
+
+def track(stage: str):
+    """Decorator form of ``timed`` for plain and ``async`` functions"""
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with timed(stage):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def traced(stage: str):
+    """Like ``track`` but also starts a sampled trace, for the entry point of a request"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with trace(stage), timed(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_outcome(outcome: str):
+    if METRICS_ENABLED:
+        OUTCOMES.inc(outcome)
+    state = _trace.get()
+    if state is not None:
+        state['outcomes'].append(outcome)
+
+
+def record_error(stage: str):
+    """Count an error that the stage handled itself instead of raising"""
+    if METRICS_ENABLED:
+        STAGE_ERRORS.inc(stage)
+
+
+@contextmanager
+def trace(name: str, sample_rate: Optional[float] = None, **fields):
+    """Collect the spans recorded in this context and log them as one JSON line, for a sample of calls
+
+    Work handed to another thread through :func:`in_context` records into
+    the same trace; spans that finish after the trace ended are dropped.
+    """
+    rate = METRICS_TRACE_SAMPLE_RATE if sample_rate is None else sample_rate
+    if rate <= 0 or _trace.get() is not None or random.random() >= rate:
+        yield
+        return
+    state = {'spans': [], 'outcomes': []}
+    token = _trace.set(state)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _trace.reset(token)
+        spans, outcomes = list(state['spans']), list(state['outcomes'])
+        record = dict(fields, trace=name, total_ms=round((time.perf_counter() - start) * 1000, 2),
+                      spans=[{'stage': stage, 'ms': ms, 'error': failed} for stage, ms, failed in spans],
+                      outcomes=outcomes)
+        logger.info(f"trace {json.dumps(record, ensure_ascii=False)}")
+
+
+def gauge(name: str, help_text: str, fn: Callable[[], float]) -> Gauge:
+    """Register a gauge whose value is read from ``fn`` when /metrics is scraped"""
+    return registry.register(Gauge(name, help_text, fn=fn))
+
+
+def render() -> str:
+    return registry.render()
+
+
+def get_summary() -> Dict:
+    """Outcome counts for /status"""
+    return {key[0]: int(value) for key, value in OUTCOMES.items().items()}
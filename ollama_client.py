@@ -1,50 +1,288 @@
+import os
+import re
+import json
+import time
 import logging
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from typing import Dict, Iterator, Optional
+import metrics
 
 logger = logging.getLogger(__name__)
 
-OLLAMA_URL = "http://localhost:11434/api/generate"
-OLLAMA_MODEL = "llama3.2"
+OLLAMA_URL = os.getenv("OLLAMA_URL") or "http://localhost:11434/api/generate"
+OLLAMA_MODEL = os.getenv("OLLAMA_MODEL") or "llama3.2"
+# ระยะเวลาที่ให้ Ollama เก็บโมเดลไว้ในหน่วยความจำหลังการเรียกแต่ละครั้ง
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE") or "30m"
+OLLAMA_PROFILE = os.getenv("OLLAMA_PROFILE") or "default"
+OLLAMA_STREAM = os.getenv("OLLAMA_STREAM", "false").lower() in ("1", "true", "yes")
+# งบความยาวของคำตอบเมื่อใช้โหมด stream (ข้อความ LINE รับได้สูงสุด 5000 ตัวอักษร)
+OLLAMA_MAX_CHARS = int(os.getenv("OLLAMA_MAX_CHARS") or 1500)
+OLLAMA_MAX_SENTENCES = int(os.getenv("OLLAMA_MAX_SENTENCES") or 0)
+# system prompt คงที่ทุกคำขอ ทำให้ Ollama ใช้ KV cache ของส่วนต้น prompt ซ้ำได้
+OLLAMA_SYSTEM_PROMPT = os.getenv("OLLAMA_SYSTEM_PROMPT") or "คุณเป็น AI ที่ช่วยตอบคำถามโดยใช้ข้อมูลที่ให้มา ตอบให้กระชับและตรงคำถาม"
+# จำกัด num_predict ตามชนิดของคำถาม (ถามใช่/ไม่ใช่ หรือถามข้อเท็จจริงสั้น ๆ ไม่ต้องการคำตอบยาว)
+# ปิดไว้เป็นค่าเริ่มต้น เพราะทำให้คำตอบสั้นลงกว่าที่ profile กำหนด
+OLLAMA_ADAPTIVE_NUM_PREDICT = os.getenv("OLLAMA_ADAPTIVE_NUM_PREDICT", "false").lower() in ("1", "true", "yes")
 
-def generate_response(question: str, context: str = None) -> str:
-    try:
-        if context:
-            prompt = f"""คุณเป็น AI ที่ช่วยตอบคำถามโดยใช้ข้อมูลที่ให้มา
+DEFAULT_PROFILES = {
+    "default": {"model": OLLAMA_MODEL, "temperature": 0.7, "num_predict": 512, "timeout": 30},
+    "fast": {"model": OLLAMA_MODEL, "temperature": 0.3, "num_predict": 200, "timeout": 15},
+}
+
+CONNECTION_ERROR_RESPONSE = "ขออภัย ระบบ AI ยังไม่พร้อมใช้งาน กรุณารอสักครู่"
+API_ERROR_RESPONSE = "ขออภัย ระบบยังไม่พร้อมใช้งาน กรุณาลองใหม่ภายหลัง"
+GENERIC_ERROR_RESPONSE = "ขออภัย เกิดข้อผิดพลาดในการประมวลผล"
+# ข้อความที่ generate_response คืนเมื่อเกิดข้อผิดพลาด (ไม่ใช่คำตอบจากโมเดล)
+OLLAMA_ERROR_RESPONSES = (CONNECTION_ERROR_RESPONSE, API_ERROR_RESPONSE, GENERIC_ERROR_RESPONSE)
+
+_SENTENCE_END = re.compile(r"[.!?。\n]+")
+
+# ตรวจตามลำดับ ชนิดแรกที่ตรงคือชนิดของคำถาม
+QUESTION_TYPE_MARKERS = (
+    ("explain", ("อย่างไร", "ยังไง", "ทำไม", "เพราะอะไร", "ขั้นตอน", "วิธี", "อธิบาย", "แตกต่าง", "เปรียบเทียบ")),
+    ("factual", ("เท่าไร", "เท่าไหร่", "เท่าใด", "กี่", "เมื่อไร", "เมื่อไหร่", "ที่ไหน", "ใคร", "คืออะไร")),
+    ("yes_no", ("ไหม", "มั้ย", "หรือไม่", "หรือเปล่า", "ใช่หรือ")),
+)
+# None = ใช้ num_predict ของ profile
+DEFAULT_NUM_PREDICT_BY_TYPE = {"yes_no": 96, "factual": 192, "explain": None, "general": None}
+
+
+def load_profiles() -> Dict[str, Dict]:
+    """Default profiles merged with overrides from the OLLAMA_PROFILES JSON env var
+
+    e.g. ``OLLAMA_PROFILES='{"fast": {"num_predict": 128}, "long": {"num_predict": 1024}}'``
+    """
+    profiles = {name: dict(profile) for name, profile in DEFAULT_PROFILES.items()}
+    raw = os.getenv("OLLAMA_PROFILES")
+    if raw:
+        try:
+            for name, overrides in json.loads(raw).items():
+                profiles[name] = dict(profiles.get(name, profiles["default"]), **overrides)
+        except Exception as e:
+            logger.error(f"Invalid OLLAMA_PROFILES: {str(e)}")
+    return profiles
+
+
+def load_num_predict_by_type() -> Dict[str, Optional[int]]:
+    """Per question type ``num_predict`` caps, overridable with the OLLAMA_NUM_PREDICT_BY_TYPE JSON env var"""
+    limits = dict(DEFAULT_NUM_PREDICT_BY_TYPE)
+    raw = os.getenv("OLLAMA_NUM_PREDICT_BY_TYPE")
+    if raw:
+        try:
+            limits.update(json.loads(raw))
+        except Exception as e:
+            logger.error(f"Invalid OLLAMA_NUM_PREDICT_BY_TYPE: {str(e)}")
+    return limits
 
-ข้อมูลอ้างอิง:
+
+NUM_PREDICT_BY_TYPE = load_num_predict_by_type()
+
+
+def question_type(question: str) -> str:
+    for name, markers in QUESTION_TYPE_MARKERS:
+        if any(marker in question for marker in markers):
+            return name
+    return "general"
+
+
+def num_predict_for(question: str) -> Optional[int]:
+    """``num_predict`` cap for ``question``, or None to keep the profile's"""
+    if not OLLAMA_ADAPTIVE_NUM_PREDICT:
+        return None
+    return NUM_PREDICT_BY_TYPE.get(question_type(question))
+
+
+def build_prompt(question: str, context: str = None) -> str:
+    """The per-request part of the prompt; the fixed instructions go in the ``system`` field"""
+    if context:
+        return f"""ข้อมูลอ้างอิง:
 {context}
 
 คำถาม: {question}
 
 คำตอบ:"""
+    return f"""คำถาม: {question}
+
+คำตอบ:"""
+
+
+class OllamaClient:
+    def __init__(self, url: str = OLLAMA_URL, keep_alive: str = OLLAMA_KEEP_ALIVE,
+                 profiles: Optional[Dict[str, Dict]] = None, default_profile: str = OLLAMA_PROFILE,
+                 pool_size: int = 10, system_prompt: Optional[str] = OLLAMA_SYSTEM_PROMPT):
+        self.url = url
+        self.system_prompt = system_prompt
+        self.keep_alive = keep_alive
+        self.profiles = profiles or load_profiles()
+        self.default_profile = default_profile if default_profile in self.profiles else "default"
+        # session เดียวพร้อม connection pool เพื่อใช้ TCP connection ซ้ำ
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._stats_lock = threading.Lock()
+        self._stats = {"calls": 0, "errors": 0, "total_ms": 0.0, "first_token_ms": 0.0, "last_total_ms": 0.0,
+                       "last_first_token_ms": 0.0, "stopped_early": 0}
+        logger.info(f"Initialized Ollama client: {url} (profile: {self.default_profile})")
+
+    def get_profile(self, profile: Optional[str] = None) -> Dict:
+        return self.profiles.get(profile or self.default_profile, self.profiles["default"])
+
+    def _payload(self, prompt: str, profile: Dict, stream: bool, num_predict: Optional[int] = None) -> Dict:
+        payload = {
+            "model": profile["model"],
+            "prompt": prompt,
+            "stream": stream,
+            "keep_alive": self.keep_alive,
+            "options": {
+                "temperature": profile["temperature"],
+                "num_predict": min(num_predict, profile["num_predict"]) if num_predict else profile["num_predict"]
+            }
+        }
+        if self.system_prompt:
+            payload["system"] = self.system_prompt
+        return payload
+
+    def _record(self, total_ms: float, first_token_ms: float, error: bool = False, stopped_early: bool = False):
+        with self._stats_lock:
+            self._stats["calls"] += 1
+            self._stats["errors"] += 1 if error else 0
+            self._stats["stopped_early"] += 1 if stopped_early else 0
+            self._stats["total_ms"] += total_ms
+            self._stats["first_token_ms"] += first_token_ms
+            self._stats["last_total_ms"] = total_ms
+            self._stats["last_first_token_ms"] = first_token_ms
+
+    def get_stats(self) -> Dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        calls = stats["calls"] or 1
+        stats["avg_total_ms"] = stats.pop("total_ms") / calls
+        stats["avg_first_token_ms"] = stats.pop("first_token_ms") / calls
+        return stats
+
+    def generate(self, prompt: str, profile: Optional[str] = None, num_predict: Optional[int] = None) -> str:
+        """Generate the full answer in one request; raises on HTTP/connection errors
+
+        ``num_predict`` can only lower the profile's limit.
+        """
+        settings = self.get_profile(profile)
+        start = time.perf_counter()
+        try:
+            response = self.session.post(self.url, json=self._payload(prompt, settings, False, num_predict),
+                                         timeout=settings["timeout"])
+            response.raise_for_status()
+            text = response.json()["response"].strip()
+        except Exception:
+            elapsed = (time.perf_counter() - start) * 1000
+            self._record(elapsed, elapsed, error=True)
+            raise
+        elapsed = (time.perf_counter() - start) * 1000
+        self._record(elapsed, elapsed)
+        return text
+
+    def stream(self, prompt: str, profile: Optional[str] = None, max_chars: Optional[int] = None,
+               max_sentences: Optional[int] = None, num_predict: Optional[int] = None) -> Iterator[str]:
+        """Yield tokens as Ollama produces them
+
+        Generation is cut off (and the connection closed, which stops the
+        model) once ``max_chars`` characters or ``max_sentences`` sentences
+        have been produced.
+        """
+        settings = self.get_profile(profile)
+        start = time.perf_counter()
+        first_token_ms = None
+        produced = ""
+        stopped_early = False
+        error = False
+        try:
+            with self.session.post(self.url, json=self._payload(prompt, settings, True, num_predict),
+                                   timeout=settings["timeout"], stream=True) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    chunk = json.loads(line)
+                    token = chunk.get("response", "")
+                    if token:
+                        if first_token_ms is None:
+                            first_token_ms = (time.perf_counter() - start) * 1000
+                        if max_chars and len(produced) + len(token) > max_chars:
+                            token = token[:max_chars - len(produced)]
+                            stopped_early = True
+                        produced += token
+                        yield token
+                        if not stopped_early and max_sentences and \
+                                len(_SENTENCE_END.findall(produced.strip())) >= max_sentences:
+                            stopped_early = True
+                    if stopped_early or chunk.get("done"):
+                        break
+        except Exception:
+            error = True
+            raise
+        finally:
+            total_ms = (time.perf_counter() - start) * 1000
+            self._record(total_ms, first_token_ms if first_token_ms is not None else total_ms, error, stopped_early)
+
+    def generate_streaming(self, prompt: str, profile: Optional[str] = None, max_chars: Optional[int] = None,
+                           max_sentences: Optional[int] = None, num_predict: Optional[int] = None) -> str:
+        """Collect :meth:`stream` into a single answer that fits the given budget"""
+        return "".join(self.stream(prompt, profile, max_chars, max_sentences, num_predict)).strip()
+
+    def warm_up(self, profile: Optional[str] = None, prime: bool = False) -> bool:
+        """Ask Ollama to load the model without generating anything
+
+        With ``prime`` a one-token answer is generated instead, so the system
+        prompt is already in the model's prompt cache for the first request.
+        """
+        settings = self.get_profile(profile)
+        if prime and self.system_prompt:
+            payload = self._payload(build_prompt("สวัสดี"), settings, False, num_predict=1)
         else:
-            prompt = f"""คุณเป็น AI ผู้ช่วยตอบคำถาม
+            payload = {"model": settings["model"], "keep_alive": self.keep_alive}
+        try:
+            response = self.session.post(self.url, json=payload, timeout=max(settings["timeout"], 120))
+            return response.status_code == 200
+        except Exception as e:
+            logger.error(f"Ollama warm-up failed: {str(e)}")
+            return False
 
-คำถาม: {question}
 
-คำตอบ:"""
+_client = None
+_client_lock = threading.Lock()
+
+def get_client() -> OllamaClient:
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = OllamaClient()
+    return _client
+
+@metrics.track('llm')
+def generate_response(question: str, context: str = None, profile: str = None) -> str:
+    try:
+        prompt = build_prompt(question, context)
+        num_predict = num_predict_for(question)
+        client = get_client()
 
         try:
-            response = requests.post(OLLAMA_URL, json={
-                "model": OLLAMA_MODEL,
-                "prompt": prompt,
-                "stream": False,
-                "options": {
-                    "temperature": 0.7,
-                    "num_predict": 512
-                }
-            }, timeout=30)
-
-            if response.status_code == 200:
-                return response.json()["response"].strip()
-            else:
-                logger.error(f"Ollama API error: {response.status_code}")
-                return "ขออภัย ระบบยังไม่พร้อมใช้งาน กรุณาลองใหม่ภายหลัง"
+            if OLLAMA_STREAM:
+                return client.generate_streaming(prompt, profile, OLLAMA_MAX_CHARS, OLLAMA_MAX_SENTENCES, num_predict)
+            return client.generate(prompt, profile, num_predict)
 
         except requests.exceptions.ConnectionError:
             logger.error("ไม่สามารถเชื่อมต่อกับ Ollama server ได้")
-            return "ขออภัย ระบบ AI ยังไม่พร้อมใช้งาน กรุณารอสักครู่"
-            
+            metrics.record_error('llm')
+            return CONNECTION_ERROR_RESPONSE
+        except requests.exceptions.HTTPError as e:
+            logger.error(f"Ollama API error: {e.response.status_code}")
+            metrics.record_error('llm')
+            return API_ERROR_RESPONSE
+
     except Exception as e:
         logger.error(f"Error generating response: {str(e)}")
-        return "ขออภัย เกิดข้อผิดพลาดในการประมวลผล"
+        metrics.record_error('llm')
+        return GENERIC_ERROR_RESPONSE
@@ -1,104 +1,869 @@
 import json
+import hashlib
 import logging
+import re
+import shutil
+import threading
 import numpy as np
 import faiss
 import os
-from sentence_transformers import SentenceTransformer
-from typing import List, Dict
+from typing import Callable, List, Dict, Optional
+from lexical import LexicalIndex
+from index_factory import build_index, configure_search, effective_index_type, index_kind, read_index, supports_remove
+from embedding_service import EmbeddingCache, MicroBatcher, normalize_query
+from encoders import create_encoder, encoder_id
+from doc_store import DocumentStore, DocumentStoreWriter, document_text
+from compaction import compaction_stats, find_duplicates, number_signature
+import metrics
+from ingest import EmbeddingSpool, ProgressReporter, batched, encode_batches, iter_documents
 
 logger = logging.getLogger(__name__)
 
+INDEX_FORMAT_VERSION = 4
+MANIFEST_FILE = 'manifest.json'
+INDEX_FILE = 'index.faiss'
+EMBEDDINGS_FILE = 'embeddings.npy'
+# ไฟล์ข้อมูลของแต่ละ artifact อยู่ในโฟลเดอร์ gen-<n> ของตัวเอง manifest ชี้ว่าโฟลเดอร์ไหนใช้งานอยู่
+GENERATION_DIR = re.compile(r'gen-(\d+)')
+
+# ค่าคงที่ของ Reciprocal Rank Fusion
+RRF_K = 60
+# เวลารอผลจาก micro-batcher สูงสุด ก่อนค้นหาเองในเธรดของคำขอ
+BATCH_TIMEOUT_SECONDS = 10.0
+
+
+def _file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _atomic_write(path: str, write_fn, mode: str = 'wb'):
+    """Write to a temp file next to ``path`` and rename it into place"""
+    tmp_path = f"{path}.tmp"
+    encoding = 'utf-8' if 'b' not in mode else None
+    with open(tmp_path, mode, encoding=encoding) as f:
+        write_fn(f)
+    os.replace(tmp_path, path)
+
+
+def _link_files(source_dir: str, target_dir: str, skip=()):
+    """Hard-link (or copy, across filesystems) the files of ``source_dir`` into ``target_dir``"""
+    for name in os.listdir(source_dir):
+        if name in skip:
+            continue
+        try:
+            os.link(os.path.join(source_dir, name), os.path.join(target_dir, name))
+        except OSError:
+            shutil.copy2(os.path.join(source_dir, name), os.path.join(target_dir, name))
+
+
+def list_json_files(json_path: str) -> List[str]:
+    if os.path.isdir(json_path):
+        # ถ้าเป็นโฟลเดอร์ ให้หาไฟล์ .json และ .jsonl ทั้งหมด
+        return [os.path.join(json_path, file) for file in sorted(os.listdir(json_path))
+                if file.endswith(('.json', '.jsonl'))]
+    # ถ้าเป็นไฟล์เดี่ยว
+    return [json_path]
+
+
+def encode_with_cache(encode_fn: Callable[[List[str]], np.ndarray], cache: EmbeddingCache,
+                      queries: List[str]) -> np.ndarray:
+    """Encode ``queries`` in one forward pass, taking what it can from ``cache``"""
+    queries = [normalize_query(query) for query in queries]
+    embeddings = [cache.get(query) for query in queries]
+    missing = list(dict.fromkeys(query for query, emb in zip(queries, embeddings) if emb is None))
+    if missing:
+        encoded = dict(zip(missing, encode_fn(missing)))
+        for query, embedding in encoded.items():
+            cache.put(query, embedding)
+        embeddings = [emb if emb is not None else encoded[query] for query, emb in zip(queries, embeddings)]
+    return np.vstack(embeddings).astype('float32')
+
+
+def parse_documents(json_file: str) -> List[Dict]:
+    # Prepare documents for indexing from each file (JSON array หรือ JSONL)
+    return list(iter_documents(json_file))
+
+
+class IndexSnapshot:
+    """Immutable view of the index and the documents it points at
+
+    ``RAGSystem`` never mutates a published snapshot; reloads build a new one
+    and swap the reference, so a search that already grabbed a snapshot keeps
+    a consistent index/document pair until it finishes. ``documents``,
+    ``ids`` and ``embeddings`` cover every document; near-duplicates listed
+    in ``aliases`` (alias id -> canonical id) are left out of ``index`` and
+    ``lexical``.
+
+    ``lexical`` is built on first use, so a read-only worker that never runs
+    hybrid search or FAQ matching does not decode the memory-mapped
+    document store. Building it still reads every question and answer once
+    per process and keeps the postings in that process's heap, which is
+    why the bot leaves it off for read-only workers by default.
+    """
+
+    def __init__(self, index=None, documents: Optional[Dict[int, Dict]] = None,
+                 ids: Optional[np.ndarray] = None, embeddings: Optional[np.ndarray] = None,
+                 sources: Optional[Dict[str, Dict]] = None, next_id: int = 0, version: int = 0,
+                 lexical: Optional[LexicalIndex] = None, aliases: Optional[Dict[int, int]] = None):
+        self.index = index
+        self.documents = documents or {}
+        self.ids = ids if ids is not None else np.zeros(0, dtype='int64')
+        self.embeddings = embeddings
+        self.sources = sources or {}
+        self.next_id = next_id
+        self.version = version
+        self.aliases = aliases or {}
+        self._lexical = lexical
+        self._lexical_lock = threading.Lock()
+
+    @property
+    def lexical(self) -> LexicalIndex:
+        if self._lexical is None:
+            with self._lexical_lock:
+                if self._lexical is None:
+                    self._lexical = LexicalIndex(self.documents, aliases=self.aliases)
+        return self._lexical
+
+    def row_of(self, doc_id: int) -> int:
+        """Row of ``doc_id`` in ``embeddings``; ids are kept sorted ascending"""
+        return int(np.searchsorted(self.ids, doc_id))
+
+
 class RAGSystem:
-    def __init__(self, model_name: str = 'intfloat/multilingual-e5-base'):
-        self.encoder = SentenceTransformer(model_name)
-        self.index = None
-        self.documents = []
-        self.dimension = None
-        logger.info(f"Initialized RAG system with model: {model_name}")
+    def __init__(self, model_name: str = 'intfloat/multilingual-e5-base', index_dir: Optional[str] = None,
+                 hybrid: bool = True, index_type: str = 'flat', index_params: Optional[Dict] = None,
+                 batch_size: int = 1, batch_wait_ms: float = 2.0, query_cache_size: int = 1024,
+                 encoder_backend: str = 'torch', onnx_dir: Optional[str] = None, onnx_quantize: bool = True,
+                 onnx_threads: Optional[int] = None, read_only: bool = False,
+                 file_filter: Optional[Callable[[str], bool]] = None, encoder=None,
+                 query_cache: Optional[EmbeddingCache] = None, dedupe_threshold: float = 0.0):
+        self.model_name = model_name
+        self.index_dir = index_dir
+        # read_only: เปิด artifact ที่ process อื่นสร้างไว้แบบ mmap ใช้หน่วยความจำร่วมกันหลาย worker
+        self.read_only = read_only
+        self._artifact_mtime = None
+        self._artifact_rebuilt = False
+        # โฟลเดอร์ gen-<n> ที่ manifest ชี้อยู่ (ข้อมูลของ snapshot ที่บันทึกล่าสุด)
+        self._data_dir = None
+        # ชนิดของ FAISS index: flat, ivf_flat, hnsw หรือ ivf_pq (ดู index_factory)
+        self.index_type = index_type
+        self.index_params = index_params or {}
+        # รวมผลค้นหาแบบคำ (BM25) กับแบบเวกเตอร์ด้วย rank fusion
+        self.hybrid = hybrid
+        # รวมเอกสารที่ซ้ำกันเกือบทั้งหมด (cosine >= dedupe_threshold) ไว้เป็นรายการเดียวใน index, 0 = ปิด
+        self.dedupe_threshold = dedupe_threshold
+        # เลือกเฉพาะไฟล์ที่ file_filter(ชื่อไฟล์) เป็นจริง ใช้แบ่ง corpus เป็น shard (ดู sharding.py)
+        self.file_filter = file_filter
+        # encoder_backend: 'torch' (SentenceTransformer) หรือ 'onnx' (ONNX Runtime, int8 เมื่อ onnx_quantize)
+        # shard หลายตัวใช้ encoder และแคชของคำถามร่วมกันได้โดยส่ง encoder/query_cache เข้ามา
+        self.encoder = encoder if encoder is not None else \
+            create_encoder(encoder_backend, model_name, onnx_dir, onnx_quantize, onnx_threads)
+        self.encoder_id = encoder_id(encoder_backend, model_name, onnx_quantize)
+        # ใช้สร้าง encoder ใน worker process ตอน ingest แบบขนาน
+        self._encoder_args = (encoder_backend, model_name, onnx_dir, onnx_quantize, onnx_threads)
+        # แคช embedding ของคำถามล่าสุด และรวมคำถามที่เข้ามาพร้อมกันเป็น batch เดียว (batch_size > 1)
+        self._query_cache = query_cache if query_cache is not None else EmbeddingCache(query_cache_size)
+        self._batcher = MicroBatcher(self._search_batch, batch_size, batch_wait_ms, name="rag-batcher") \
+            if batch_size > 1 else None
+        self.json_path = None
+        self._snapshot = IndexSnapshot()
+        self._reload_lock = threading.Lock()
+        logger.info(f"Initialized RAG system with model: {self.encoder_id}")
+
+    @property
+    def snapshot(self) -> IndexSnapshot:
+        return self._snapshot
+
+    @property
+    def index(self):
+        return self._snapshot.index
+
+    @property
+    def documents(self) -> Dict[int, Dict]:
+        return self._snapshot.documents
+
+    @property
+    def version(self) -> int:
+        """Incremented every time a reload publishes a new snapshot"""
+        return self._snapshot.version
+
+    @property
+    def dimension(self) -> Optional[int]:
+        return self._snapshot.index.d if self._snapshot.index is not None else None
+
+    def get_stats(self) -> Dict:
+        snapshot = self._snapshot
+        return {
+            'documents': len(snapshot.documents),
+            'version': snapshot.version,
+            'compaction': compaction_stats(len(snapshot.documents), len(snapshot.aliases)),
+            'query_cache_hits': self._query_cache.hits,
+            'query_cache_misses': self._query_cache.misses,
+            'batching': self._batcher.get_stats() if self._batcher is not None else None
+        }
 
     def load_documents(self, json_path: str):
-        """Load documents from a JSON file or directory containing JSON files"""
+        """Load documents from a JSON file or directory containing JSON files
+
+        When ``index_dir`` is set, the persisted artifact is loaded first and
+        only files whose content hash changed are re-encoded.
+        """
         try:
-            json_files = []
-            if os.path.isdir(json_path):
-                # ถ้าเป็นโฟลเดอร์ ให้หาไฟล์ .json ทั้งหมด
-                for file in os.listdir(json_path):
-                    if file.endswith('.json'):
-                        json_files.append(os.path.join(json_path, file))
-            else:
-                # ถ้าเป็นไฟล์เดี่ยว
-                json_files = [json_path]
-            
-            processed_docs = []
-            for json_file in json_files:
-                try:
-                    with open(json_file, 'r', encoding='utf-8') as f:
-                        data = json.load(f)
-                    
-                    # Prepare documents for indexing from each file
-                    for item in data:
-                        if isinstance(item, dict) and "question" in item and "answer" in item:
-                            text = f"{item['question']} {item['answer']}"
-                            processed_docs.append({
-                                'text': text,
-                                'question': item['question'],
-                                'answer': item['answer'],
-                                'source': os.path.basename(json_file)  # เก็บชื่อไฟล์ต้นทาง
-                            })
-                except Exception as e:
-                    logger.error(f"Error loading file {json_file}: {str(e)}")
-                    continue
-            
-            self.documents = processed_docs
-            self._build_index()
-            logger.info(f"Loaded {len(self.documents)} documents from {len(json_files)} files")
-            return True
-            
+            self.json_path = json_path
+            if self.read_only:
+                return self._open_shared()
+            cached = self._load_artifact()
+            if cached is not None:
+                self._snapshot = cached
+            changes = self.reload(json_path)
+            if cached is not None and changes is not None and self._snapshot is cached and self._artifact_rebuilt:
+                # index ถูกสร้างใหม่จาก embedding เดิม (เปลี่ยนชนิด index หรือเกณฑ์การรวมเอกสารซ้ำ)
+                self.save_artifact(write_data=False)
+            logger.info(f"Loaded {len(self.documents)} documents from {len(self._snapshot.sources)} files")
+            return changes is not None
+
         except Exception as e:
             logger.error(f"Error loading documents: {str(e)}")
             return False
 
-    def _build_index(self):
-        if not self.documents:
+    def reload(self, json_path: Optional[str] = None) -> Optional[Dict]:
+        """Apply added, changed and deleted JSON files to the live index
+
+        Only Q&A items of changed files are re-embedded. The new vectors are
+        added to (and stale ones removed from) a copy of the ID-mapped index,
+        which is then published atomically. Returns a summary of the changes,
+        or None on failure.
+        """
+        if self.read_only:
+            return self._reopen_shared()
+        json_path = json_path or self.json_path
+        with self._reload_lock:
+            try:
+                current = self._snapshot
+                json_files = self._list_files(json_path)
+
+                sources = {}
+                changed = {}
+                for json_file in json_files:
+                    source = os.path.basename(json_file)
+                    try:
+                        stat = os.stat(json_file)
+                        entry = current.sources.get(source)
+                        if entry and entry['mtime_ns'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+                            sources[source] = entry
+                            continue
+                        file_hash = _file_sha256(json_file)
+                        if entry and entry['sha256'] == file_hash:
+                            # แค่ mtime เปลี่ยน เนื้อหาเหมือนเดิม
+                            sources[source] = dict(entry, mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+                            continue
+                        changed[source] = (self._parse_file(json_file), {
+                            'sha256': file_hash,
+                            'mtime_ns': stat.st_mtime_ns,
+                            'size': stat.st_size
+                        })
+                    except Exception as e:
+                        logger.error(f"Error loading file {json_file}: {str(e)}")
+                        # คงข้อมูลเดิมของไฟล์ที่อ่านไม่ได้ไว้ แทนที่จะลบออกจาก index
+                        if source in current.sources:
+                            sources[source] = current.sources[source]
+
+                removed = [source for source in current.sources if source not in sources and source not in changed]
+                summary = {
+                    'added': [source for source in changed if source not in current.sources],
+                    'changed': [source for source in changed if source in current.sources],
+                    'removed': removed,
+                    'version': current.version
+                }
+                if not changed and not removed and current.index is not None:
+                    # ไม่มีอะไรเปลี่ยน แต่ mtime อาจถูกอัปเดต
+                    if sources != current.sources:
+                        self._snapshot = IndexSnapshot(current.index, current.documents, current.ids,
+                                                       current.embeddings, sources, current.next_id, current.version,
+                                                       current._lexical, current.aliases)
+                        self.save_artifact()
+                    return summary
+
+                snapshot = self._apply_changes(current, sources, changed, removed)
+                if self.hybrid:
+                    # สร้าง BM25 ในเธรดที่ reload ก่อนเผยแพร่ คำขอแรกหลัง reload จะได้ไม่ต้องรอ
+                    snapshot.lexical
+                self._snapshot = snapshot
+                summary['version'] = self._snapshot.version
+                summary['compaction'] = compaction_stats(len(self._snapshot.documents), len(self._snapshot.aliases))
+                self.save_artifact()
+                logger.info(f"Reloaded documents: {len(summary['added'])} added, "
+                            f"{len(summary['changed'])} changed, {len(removed)} removed")
+                return summary
+
+            except Exception as e:
+                logger.error(f"Error reloading documents: {str(e)}")
+                return None
+
+    def _has_index_type(self, index) -> bool:
+        return index_kind(index) == effective_index_type(self.index_type, index.ntotal, self.index_params)
+
+    def _apply_changes(self, current: IndexSnapshot, sources: Dict[str, Dict],
+                       changed: Dict[str, tuple], removed: List[str]) -> IndexSnapshot:
+        stale_ids = []
+        for source in list(changed) + removed:
+            if source in current.sources:
+                stale_ids.extend(current.sources[source]['ids'])
+
+        new_docs = []
+        next_id = current.next_id
+        for source, (docs, entry) in changed.items():
+            ids = list(range(next_id, next_id + len(docs)))
+            next_id += len(docs)
+            sources[source] = dict(entry, ids=ids)
+            new_docs.extend(zip(ids, docs))
+
+        new_ids = np.array([doc_id for doc_id, _ in new_docs], dtype='int64')
+        new_embeddings = None
+        if new_docs:
+            logger.info(f"Encoding {len(new_docs)} new or changed documents")
+            new_embeddings = self._encode_unique([document_text(doc) for _, doc in new_docs])
+
+        documents = dict(current.documents)
+        for doc_id in stale_ids:
+            documents.pop(doc_id, None)
+        documents.update(new_docs)
+
+        # เก็บเฉพาะแถวที่ยังใช้งานอยู่ แล้วต่อท้ายด้วย embedding ใหม่
+        keep = ~np.isin(current.ids, np.array(stale_ids, dtype='int64'))
+        ids = np.concatenate([current.ids[keep], new_ids])
+        parts = [] if current.embeddings is None else [current.embeddings[keep]]
+        if new_embeddings is not None:
+            parts.append(new_embeddings)
+        embeddings = np.vstack(parts).astype('float32') if parts else None
+
+        stale = set(stale_ids)
+        aliases = {alias: canonical for alias, canonical in current.aliases.items()
+                   if alias not in stale and canonical not in stale}
+        # alias ที่เอกสารหลักถูกลบไป ต้องหาเอกสารหลักใหม่พร้อมกับเอกสารใหม่
+        pending_ids = np.array(sorted(alias for alias, canonical in current.aliases.items()
+                                      if alias not in stale and canonical in stale), dtype='int64')
+        pending_ids = np.concatenate([pending_ids, new_ids])
+        pending_embeddings = embeddings[np.searchsorted(ids, pending_ids)] if embeddings is not None else None
+
+        # เทียบกับชนิดที่ build_index จะสร้างได้จริง index เล็กที่ถอยไปเป็น flat จึงไม่ถูกสร้างใหม่ทุกครั้ง
+        rebuild = current.index is None or not self._has_index_type(current.index) \
+            or (stale_ids and not supports_remove(current.index))
+        if embeddings is None:
+            index = None
             logger.warning("No documents to index")
-            return
+        elif rebuild and not self.dedupe_threshold:
+            # สร้าง index ใหม่ทั้งหมดจาก embedding ที่มีอยู่ (ไม่ต้อง encode ซ้ำ)
+            index = build_index(self.index_type, embeddings, ids, self.index_params)
+        else:
+            if rebuild:
+                # สร้างจากเอกสารหลักที่ยังอยู่ก่อน แล้วค่อยเพิ่มเอกสารหลักของชุดใหม่
+                base = ~np.isin(ids, np.concatenate([np.array(list(aliases), dtype='int64'), pending_ids]))
+                index = build_index(self.index_type, embeddings[base], ids[base], self.index_params) \
+                    if base.any() else None
+            else:
+                index = faiss.clone_index(current.index)
+                configure_search(index, self.index_params)
+                if stale_ids:
+                    index.remove_ids(np.array([doc_id for doc_id in stale_ids if doc_id not in current.aliases],
+                                              dtype='int64'))
+            if self.dedupe_threshold and len(pending_ids):
+                duplicates = find_duplicates(
+                    pending_ids, pending_embeddings,
+                    [number_signature(document_text(documents[int(doc_id)])) for doc_id in pending_ids],
+                    self.dedupe_threshold, index,
+                    lambda doc_id: number_signature(document_text(documents[doc_id]))
+                )
+                aliases.update(duplicates)
+                canonical = np.array([int(doc_id) not in duplicates for doc_id in pending_ids], dtype=bool)
+                pending_ids, pending_embeddings = pending_ids[canonical], pending_embeddings[canonical]
+            if index is None:
+                index = build_index(self.index_type, pending_embeddings, pending_ids, self.index_params)
+            elif len(pending_ids):
+                index.add_with_ids(pending_embeddings, pending_ids)
+            logger.info(f"Updated FAISS index with {index.ntotal} documents")
+        if self.dedupe_threshold and documents:
+            stats = compaction_stats(len(documents), len(aliases))
+            logger.info(f"Compacted {stats['documents']} documents into {stats['indexed']} index entries "
+                        f"({stats['reduction']:.1%} smaller)")
+        return IndexSnapshot(index, documents, ids, embeddings, sources, next_id, current.version + 1,
+                             aliases=aliases)
+
+    def ingest(self, json_path: str, batch_size: int = 256, workers: int = 0, progress_every: int = 1000,
+               progress: Optional[Callable[[Dict], None]] = None) -> Optional[Dict]:
+        """Rebuild the index from ``json_path`` with memory bounded by ``batch_size``
+
+        Records are parsed lazily from JSON arrays or JSONL files, encoded
+        ``batch_size`` at a time (across ``workers`` processes when > 1) and
+        appended to the index, the document store and the embedding file as
+        they arrive. A file that fails midway keeps the documents read before
+        the error and is retried on the next reload; the run carries on with
+        the remaining files. Returns a summary, or None on failure.
+
+        Everything is written into a new generation directory that only
+        becomes visible when the manifest is switched to it, so readers of
+        the previous artifact never see a half-written one, and a failed run
+        leaves it untouched.
+        """
+        if self.read_only:
+            logger.error("Cannot ingest into a read-only index")
+            return None
+        with self._reload_lock:
+            self.json_path = json_path
+            current = self._snapshot
+            sources = {}
+            failed = []
+            stats = {}
+            next_id = current.next_id
 
-        # Encode all documents
-        texts = [doc['text'] for doc in self.documents]
+            def batches():
+                nonlocal next_id
+                for json_file in self._list_files(json_path):
+                    source = os.path.basename(json_file)
+                    try:
+                        stat = os.stat(json_file)
+                        entry = {'sha256': _file_sha256(json_file), 'mtime_ns': stat.st_mtime_ns,
+                                 'size': stat.st_size, 'ids': []}
+                        sources[source] = entry
+                        for docs in batched(iter_documents(json_file, stats), batch_size):
+                            ids = list(range(next_id, next_id + len(docs)))
+                            next_id += len(docs)
+                            entry['ids'].extend(ids)
+                            yield (source, ids, docs), [document_text(doc) for doc in docs]
+                    except Exception as e:
+                        logger.error(f"Error ingesting file {json_file}: {str(e)}")
+                        failed.append(source)
+                        if source in sources:
+                            # ไม่มี hash ให้เทียบ reload ครั้งถัดไปจะอ่านไฟล์นี้ใหม่
+                            sources[source].update(sha256=None, mtime_ns=None, size=None)
+
+            staging = self._new_generation() if self.index_dir else None
+            writer = DocumentStoreWriter(staging) if staging else None
+            documents = {}
+            spool = EmbeddingSpool(os.path.join(staging, EMBEDDINGS_FILE) if staging else None)
+            reporter = ProgressReporter(progress_every, progress)
+            # flat/HNSW รับเวกเตอร์เพิ่มได้ทีละ batch ส่วน IVF ต้อง train จาก embedding ทั้งหมดก่อน
+            incremental = self.index_type in ('flat', 'hnsw')
+            index = None
+            id_parts = []
+            aliases = {}
+            # ลายเซ็นตัวเลขของเอกสารหลัก และ index ชั่วคราวของเอกสารหลักเมื่อ index จริงต้องรอ train ตอนจบ
+            signatures = {}
+            searcher = None
+            try:
+                for (source, ids, docs), embeddings in encode_batches(batches(), self._encode_unique, workers,
+                                                                      self._encoder_args):
+                    id_array = np.array(ids, dtype='int64')
+                    for doc_id, doc in zip(ids, docs):
+                        if writer is not None:
+                            writer.add(doc_id, doc)
+                        else:
+                            documents[doc_id] = doc
+                    spool.append(embeddings)
+                    id_parts.append(id_array)
+                    reporter.update(len(docs), source)
+                    if self.dedupe_threshold:
+                        batch_signatures = [number_signature(document_text(doc)) for doc in docs]
+                        if not incremental and searcher is None:
+                            searcher = faiss.IndexIDMap2(faiss.IndexFlatIP(embeddings.shape[1]))
+                        duplicates = find_duplicates(id_array, embeddings, batch_signatures, self.dedupe_threshold,
+                                                     index if incremental else searcher, signatures.get)
+                        aliases.update(duplicates)
+                        canonical = np.array([doc_id not in duplicates for doc_id in ids], dtype=bool)
+                        signatures.update((doc_id, signature) for doc_id, signature, keep
+                                          in zip(ids, batch_signatures, canonical) if keep)
+                        id_array, embeddings = id_array[canonical], embeddings[canonical]
+                        if searcher is not None:
+                            searcher.add_with_ids(embeddings, id_array)
+                    if incremental and index is None:
+                        index = build_index(self.index_type, embeddings, id_array, self.index_params)
+                    elif incremental and len(id_array):
+                        index.add_with_ids(embeddings, id_array)
+
+                if not id_parts:
+                    raise ValueError(f"No documents found in {json_path}")
+                if writer is not None:
+                    writer.close()
+                    documents = DocumentStore(staging)
+                embeddings = spool.finish()
+
+                ids = np.concatenate(id_parts)
+                if index is None:
+                    canonical = ~np.isin(ids, np.array(list(aliases), dtype='int64'))
+                    index = build_index(self.index_type, np.ascontiguousarray(embeddings[canonical]), ids[canonical],
+                                        self.index_params)
+                snapshot = IndexSnapshot(index, documents, ids, embeddings, sources, next_id, current.version + 1,
+                                         aliases=aliases)
+                if staging:
+                    self._publish(staging, snapshot)
+            except Exception as e:
+                logger.error(f"Error ingesting documents: {str(e)}")
+                if writer is not None and not isinstance(documents, DocumentStore):
+                    writer.abort()
+                spool.abort()
+                if staging:
+                    shutil.rmtree(staging, ignore_errors=True)
+                return None
+            self._snapshot = snapshot
+
+            final = reporter.report()
+            summary = {
+                'documents': len(ids),
+                'files': len(sources),
+                'failed': failed,
+                'skipped': stats.get('skipped', 0),
+                'bad_records': stats.get('bad_records', 0),
+                'seconds': final['seconds'],
+                'docs_per_second': final['docs_per_second'],
+                'version': self._snapshot.version,
+                'compaction': compaction_stats(len(ids), len(aliases))
+            }
+            logger.info(f"Ingested {summary['documents']} documents from {summary['files']} files "
+                        f"({len(failed)} failed, {summary['skipped'] + summary['bad_records']} records skipped)")
+            return summary
+
+    def _list_files(self, json_path: str) -> List[str]:
+        files = list_json_files(json_path)
+        if self.file_filter is None:
+            return files
+        return [json_file for json_file in files if self.file_filter(os.path.basename(json_file))]
+
+    def _parse_file(self, json_file: str) -> List[Dict]:
+        return parse_documents(json_file)
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
         embeddings = self.encoder.encode(texts, convert_to_numpy=True, normalize_embeddings=True)
-        
-        # Initialize FAISS index
-        self.dimension = embeddings.shape[1]
-        self.index = faiss.IndexFlatIP(self.dimension)
-        self.index.add(embeddings.astype('float32'))
-        logger.info(f"Built FAISS index with {len(self.documents)} documents")
+        return embeddings.astype('float32')
 
-    def search(self, query: str, k: int = 3) -> List[Dict]:
+    def _encode_unique(self, texts: List[str]) -> np.ndarray:
+        """Encode each distinct text once; exact duplicates share the embedding"""
+        unique = list(dict.fromkeys(texts))
+        if len(unique) == len(texts):
+            return self._encode(texts)
+        rows = {text: row for row, text in enumerate(unique)}
+        return self._encode(unique)[[rows[text] for text in texts]]
+
+    def _find_all_duplicates(self, ids: np.ndarray, embeddings: np.ndarray, documents,
+                             batch_size: int = 4096) -> Dict[int, int]:
+        """Compact an existing corpus from its stored embeddings, in id order"""
+        if not self.dedupe_threshold or not len(ids):
+            return {}
+        aliases = {}
+        signatures = {}
+        searcher = faiss.IndexIDMap2(faiss.IndexFlatIP(embeddings.shape[1]))
+        for start in range(0, len(ids), batch_size):
+            batch_ids = np.asarray(ids[start:start + batch_size], dtype='int64')
+            batch_embeddings = np.asarray(embeddings[start:start + batch_size], dtype='float32')
+            batch_signatures = [number_signature(document_text(documents[int(doc_id)])) for doc_id in batch_ids]
+            duplicates = find_duplicates(batch_ids, batch_embeddings, batch_signatures, self.dedupe_threshold,
+                                         searcher, signatures.get)
+            aliases.update(duplicates)
+            canonical = np.array([int(doc_id) not in duplicates for doc_id in batch_ids], dtype=bool)
+            signatures.update((int(doc_id), signature) for doc_id, signature, keep
+                              in zip(batch_ids, batch_signatures, canonical) if keep)
+            searcher.add_with_ids(batch_embeddings[canonical], batch_ids[canonical])
+        return aliases
+
+    def _open_shared(self) -> bool:
+        snapshot = self._load_artifact(mmap=True)
+        if snapshot is None:
+            logger.error(f"No usable index artifact in {self.index_dir} for read-only mode")
+            return False
+        self._snapshot = snapshot
+        logger.info(f"Opened shared index with {len(snapshot.documents)} documents (read-only)")
+        return True
+
+    def _reopen_shared(self) -> Optional[Dict]:
+        """Read-only reload: switch to the artifact another process has rewritten"""
+        with self._reload_lock:
+            try:
+                mtime = os.stat(os.path.join(self.index_dir, MANIFEST_FILE)).st_mtime_ns
+                if mtime == self._artifact_mtime:
+                    return {'added': [], 'changed': [], 'removed': [], 'version': self._snapshot.version}
+                current = self._snapshot
+                snapshot = self._load_artifact(mmap=True)
+                if snapshot is None:
+                    return None
+                snapshot.version = current.version + 1
+                self._snapshot = snapshot
+                return {
+                    'added': [source for source in snapshot.sources if source not in current.sources],
+                    'changed': [source for source in snapshot.sources if source in current.sources
+                                and snapshot.sources[source]['sha256'] != current.sources[source]['sha256']],
+                    'removed': [source for source in current.sources if source not in snapshot.sources],
+                    'version': snapshot.version
+                }
+            except Exception as e:
+                logger.error(f"Error reopening shared index: {str(e)}")
+                return None
+
+    def _load_artifact(self, mmap: bool = False) -> Optional[IndexSnapshot]:
+        """Read the persisted index artifact, or None if missing or stale
+
+        With ``mmap`` the FAISS index, embeddings and document store are
+        memory-mapped read-only instead of copied into this process.
+        """
+        if not self.index_dir:
+            return None
+        manifest_path = os.path.join(self.index_dir, MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            return None
         try:
-            if self.index is None:
-                return []
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest.get('version') != INDEX_FORMAT_VERSION or manifest.get('model_name') != self.encoder_id:
+                logger.info("Index artifact was built with a different model or format, rebuilding")
+                return None
+
+            manifest_mtime = os.stat(manifest_path).st_mtime_ns
+            data_dir = os.path.join(self.index_dir, manifest['data_dir'])
+            documents = DocumentStore(data_dir)
+            ids = documents.ids
+            embeddings = np.load(os.path.join(data_dir, EMBEDDINGS_FILE), mmap_mode='r')
+            index = read_index(os.path.join(data_dir, INDEX_FILE), mmap=mmap)
+            aliases = {int(alias): canonical for alias, canonical in (manifest.get('aliases') or {}).items()}
+            if not (len(documents) == len(embeddings) == index.ntotal + len(aliases)):
+                logger.warning("Index artifact is inconsistent, rebuilding")
+                return None
+            rebuild = False
+            if manifest.get('dedupe_threshold', 0.0) != self.dedupe_threshold and not mmap:
+                logger.info("Duplicate threshold changed, compacting again from stored embeddings")
+                aliases = self._find_all_duplicates(ids, embeddings, documents)
+                rebuild = True
+            elif not self._has_index_type(index) and not mmap:
+                logger.info(f"Index type changed to {self.index_type}, rebuilding from stored embeddings")
+                rebuild = True
+            if rebuild:
+                canonical = ~np.isin(ids, np.array(list(aliases), dtype='int64'))
+                index = build_index(self.index_type, np.ascontiguousarray(embeddings[canonical]), ids[canonical],
+                                    self.index_params) if aliases else \
+                    build_index(self.index_type, embeddings, ids, self.index_params)
+            self._artifact_rebuilt = rebuild
+            configure_search(index, self.index_params)
 
-            query_embedding = self.encoder.encode([query], convert_to_numpy=True, normalize_embeddings=True)
-            scores, indices = self.index.search(query_embedding.astype('float32'), k)
+            self._artifact_mtime = manifest_mtime
+            self._data_dir = data_dir
+            logger.info(f"Loaded index artifact from {data_dir}")
+            return IndexSnapshot(
+                index,
+                documents,
+                ids,
+                embeddings,
+                manifest['files'],
+                manifest['next_id'],
+                aliases=aliases
+            )
+        except Exception as e:
+            logger.error(f"Error reading index artifact: {str(e)}")
+            return None
 
-            results = []
-            for idx, score in zip(indices[0], scores[0]):
-                if idx >= 0 and idx < len(self.documents):
-                    doc = self.documents[idx]
-                    results.append({
-                        'question': doc['question'],
-                        'answer': doc['answer'],
-                        'score': float(score),
-                        'text': doc['text']
-                    })
+    def save_artifact(self, write_data: bool = True):
+        """Persist the index, embeddings, documents and manifest to ``index_dir``
 
-            # Sort by score
-            results.sort(key=lambda x: x['score'], reverse=True)
+        The files go into a new generation directory and the manifest is
+        switched to it last. ``write_data=False`` hard-links the embeddings
+        and document store of the loaded generation instead of rewriting
+        them, for when only the index changed.
+        """
+        snapshot = self._snapshot
+        if not self.index_dir or snapshot.index is None or self.read_only:
+            return
+        data_dir = None
+        try:
+            data_dir = self._new_generation()
+            if write_data or self._data_dir is None:
+                np.save(os.path.join(data_dir, EMBEDDINGS_FILE), snapshot.embeddings)
+                DocumentStore.write(data_dir, snapshot.documents, snapshot.ids)
+            else:
+                _link_files(self._data_dir, data_dir, skip=(INDEX_FILE,))
+            self._publish(data_dir, snapshot)
+        except Exception as e:
+            logger.error(f"Error saving index artifact: {str(e)}")
+            if data_dir:
+                shutil.rmtree(data_dir, ignore_errors=True)
+
+    def _new_generation(self) -> str:
+        os.makedirs(self.index_dir, exist_ok=True)
+        numbers = [int(match.group(1)) for match in map(GENERATION_DIR.fullmatch, os.listdir(self.index_dir)) if match]
+        path = os.path.join(self.index_dir, f"gen-{max(numbers, default=0) + 1:06d}")
+        os.makedirs(path)
+        return path
+
+    def _publish(self, data_dir: str, snapshot: IndexSnapshot):
+        """Write the index into ``data_dir`` and point the manifest at it"""
+        faiss.write_index(snapshot.index, os.path.join(data_dir, INDEX_FILE))
+        manifest = {
+            'version': INDEX_FORMAT_VERSION,
+            'model_name': self.encoder_id,
+            'dimension': snapshot.index.d,
+            'index_type': index_kind(snapshot.index),
+            'next_id': snapshot.next_id,
+            'files': snapshot.sources,
+            'dedupe_threshold': self.dedupe_threshold,
+            # เอกสารที่ซ้ำกับเอกสารหลัก (ไม่อยู่ใน FAISS index) id -> id ของเอกสารหลัก
+            'aliases': {str(alias): canonical for alias, canonical in snapshot.aliases.items()},
+            'data_dir': os.path.basename(data_dir)
+        }
+        # เปลี่ยน manifest เป็นขั้นสุดท้าย ผู้อ่านจึงเห็นแต่ artifact ที่เขียนครบแล้ว
+        _atomic_write(os.path.join(self.index_dir, MANIFEST_FILE),
+                      lambda f: json.dump(manifest, f, ensure_ascii=False, indent=2), mode='w')
+        previous, self._data_dir = self._data_dir, data_dir
+        # เก็บรุ่นก่อนหน้าไว้ให้ worker ที่ยังเปิดอยู่ ลบรุ่นที่เก่ากว่าและที่ค้างจากการเขียนที่ล้มเหลว
+        for name in os.listdir(self.index_dir):
+            path = os.path.join(self.index_dir, name)
+            if GENERATION_DIR.fullmatch(name) and path not in (data_dir, previous):
+                shutil.rmtree(path, ignore_errors=True)
+        logger.info(f"Saved index artifact to {data_dir}")
+
+    def encode_query(self, query: str) -> np.ndarray:
+        query = normalize_query(query)
+        embedding = self._query_cache.get(query)
+        if embedding is None:
+            embedding = self._encode([query])[0]
+            self._query_cache.put(query, embedding)
+        return embedding.reshape(1, -1)
+
+    def encode_queries(self, queries: List[str]) -> np.ndarray:
+        """Encode many queries in one forward pass, reusing cached embeddings"""
+        return encode_with_cache(self._encode, self._query_cache, queries)
+
+    def match_question(self, query: str, min_similarity: float = 0.85) -> Optional[Dict]:
+        """Return the document whose question (nearly) equals ``query``, without encoding"""
+        snapshot = self._snapshot
+        with metrics.timed('faq_match'):
+            doc_id = snapshot.lexical.match_question(query, min_similarity)
+        if doc_id is None:
+            return None
+        doc = snapshot.documents[doc_id]
+        return {
+            'id': doc_id,
+            'question': doc['question'],
+            'answer': doc['answer'],
+            'source': doc['source'],
+            'score': 1.0,
+            'text': document_text(doc)
+        }
+
+    def search(self, query: str, k: int = 3) -> List[Dict]:
+        try:
+            if self._snapshot.index is None:
+                return []
+            _, results = self.search_with_embedding(query, k)
             logger.info(f"Query: {query}")
-            logger.info(f"Top result: {results[0]['question']} (score: {results[0]['score']:.4f})")
-            
+            if results:
+                logger.info(f"Top result: {results[0]['question']} (score: {results[0]['score']:.4f})")
             return results
 
         except Exception as e:
             logger.error(f"Error during search: {str(e)}")
             return []
+
+    def search_with_embedding(self, query: str, k: int = 3):
+        """Search ``query`` and also return its embedding
+
+        With micro-batching enabled the call is queued and encoded/searched
+        together with other concurrent queries.
+        """
+        with metrics.timed('retrieval'):
+            if self._batcher is not None:
+                try:
+                    return self._batcher.submit((query, k), BATCH_TIMEOUT_SECONDS)
+                except TimeoutError:
+                    logger.warning(f"Batched search did not finish in {BATCH_TIMEOUT_SECONDS}s, searching directly")
+            return self._search_batch([(query, k)])[0]
+
+    def _search_batch(self, requests: List[tuple]) -> List[tuple]:
+        snapshot = self._snapshot
+        queries = [query for query, _ in requests]
+        with metrics.timed('encode'):
+            embeddings = self.encode_queries(queries)
+        if snapshot.index is None:
+            return [(embeddings[i:i + 1], []) for i in range(len(requests))]
+
+        max_k = max(k for _, k in requests)
+        fetch_k = max_k * 4 if self.hybrid else max_k
+        with metrics.timed('faiss_search'):
+            scores, indices = snapshot.index.search(embeddings, fetch_k)
+        return [
+            (embeddings[i:i + 1], self._rank(snapshot, embeddings[i:i + 1], scores[i], indices[i], k, query))
+            for i, (query, k) in enumerate(requests)
+        ]
+
+    def search_by_embedding(self, query_embedding: np.ndarray, k: int = 3, query: Optional[str] = None) -> List[Dict]:
+        """Dense search, fused with BM25 results when ``query`` text is given
+
+        ``score`` is always the cosine similarity to the query so callers can
+        keep using absolute thresholds; the order follows the fused rank.
+        """
+        # อ่าน snapshot ครั้งเดียว เพื่อไม่ให้เห็น index ที่กำลังถูกสลับ
+        snapshot = self._snapshot
+        if snapshot.index is None:
+            return []
+
+        query_embedding = query_embedding.reshape(1, -1)
+        fetch_k = k * 4 if self.hybrid and query else k
+        with metrics.timed('faiss_search'):
+            scores, indices = snapshot.index.search(query_embedding, fetch_k)
+        return self._rank(snapshot, query_embedding, scores[0], indices[0], k, query)
+
+    def document_embeddings(self, results: List[Dict]) -> np.ndarray:
+        """Stored embeddings of search ``results``, row for row
+
+        Documents that disappeared in a reload since the search are re-encoded.
+        """
+        snapshot = self._snapshot
+        rows = []
+        missing = []
+        for i, result in enumerate(results):
+            row = snapshot.row_of(result['id'])
+            if snapshot.embeddings is not None and row < len(snapshot.ids) and snapshot.ids[row] == result['id']:
+                rows.append(np.asarray(snapshot.embeddings[row], dtype='float32'))
+            else:
+                rows.append(None)
+                missing.append(i)
+        if missing:
+            encoded = self._encode([results[i]['text'] for i in missing])
+            for i, embedding in zip(missing, encoded):
+                rows[i] = embedding
+        return np.vstack(rows) if rows else np.zeros((0, self.dimension or 0), dtype='float32')
+
+    def _rank(self, snapshot: IndexSnapshot, query_embedding: np.ndarray, scores: np.ndarray,
+              indices: np.ndarray, k: int, query: Optional[str]) -> List[Dict]:
+        dense = [(int(idx), float(score)) for idx, score in zip(indices, scores) if idx >= 0]
+        cosine = dict(dense)
+
+        use_lexical = self.hybrid and query
+        if use_lexical:
+            fused = {}
+            for ranking in (dense, snapshot.lexical.search(query, len(indices))):
+                for rank, (doc_id, _) in enumerate(ranking):
+                    fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+            ranked = sorted(fused, key=fused.get, reverse=True)[:k]
+        else:
+            ranked = [doc_id for doc_id, _ in dense[:k]]
+
+        results = []
+        for doc_id in ranked:
+            doc = snapshot.documents.get(doc_id)
+            if doc is None:
+                continue
+            if doc_id not in cosine:
+                # เอกสารที่พบจาก BM25 อย่างเดียว คำนวณ cosine จาก embedding ที่เก็บไว้
+                cosine[doc_id] = float(snapshot.embeddings[snapshot.row_of(doc_id)] @ query_embedding[0])
+            results.append({
+                'id': doc_id,
+                'question': doc['question'],
+                'answer': doc['answer'],
+                'source': doc['source'],
+                'score': cosine[doc_id],
+                'text': document_text(doc)
+            })
+
+        if not use_lexical:
+            # Sort by score
+            results.sort(key=lambda x: x['score'], reverse=True)
+        return results
@@ -1,68 +1,465 @@
 import os
 import json
 import logging
+import threading
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+import metrics
 from rag import RAGSystem
-from ollama_client import generate_response
+from sharding import ShardedRAGSystem, ShardRouter, load_shard_rules
+from ollama_client import generate_response, OLLAMA_ERROR_RESPONSES
+from semantic_cache import SemanticCache
+from context_builder import select_passages
+from admission import AdmissionController, AdmissionRejected
 
 logger = logging.getLogger(__name__)
 rag_system = None
+_rag_init_lock = threading.Lock()
+# ระบบที่สร้างแล้วแต่โหลดเอกสารไม่สำเร็จ ใช้ซ้ำตอนลองใหม่โดยไม่ต้องโหลด encoder อีกครั้ง
+_unloaded_rag_system = None
+_reload_thread = None
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+# โฟลเดอร์ไฟล์เอกสาร JSON/JSONL
+RAG_DATA_DIR = os.path.join(BASE_DIR, 'data', 'json')
+# worker ที่เปิด index ร่วมกันแบบ read-only (สร้าง index ด้วย build_index.py)
+RAG_READ_ONLY = os.getenv("RAG_READ_ONLY", "false").lower() in ("1", "true", "yes")
+# ดัชนี BM25 (hybrid search และ FAQ fast path) ไม่ได้อยู่ใน artifact ที่แชร์ แต่ละ worker ต้องสร้างเองใน heap
+# worker แบบ read-only จึงค้นด้วย dense อย่างเดียว เว้นแต่เปิดค่านี้
+RAG_READ_ONLY_LEXICAL = os.getenv("RAG_READ_ONLY_LEXICAL", "false").lower() in ("1", "true", "yes")
+RAG_LEXICAL = not RAG_READ_ONLY or RAG_READ_ONLY_LEXICAL
+
+# ตอบจาก answer ในเอกสารทันทีเมื่อคำถามตรง (หรือเกือบตรง) กับ question ที่มีอยู่
+RAG_FAQ_FAST_PATH = RAG_LEXICAL and os.getenv("RAG_FAQ_FAST_PATH", "true").lower() in ("1", "true", "yes")
+RAG_FAQ_MIN_SIMILARITY = float(os.getenv("RAG_FAQ_MIN_SIMILARITY") or 0.85)
+
+# context ที่ส่งให้ LLM: จำนวนผลค้นหาที่พิจารณา งบ token และการตัด passage ที่ซ้ำกันด้วย MMR
+RAG_CONTEXT_CANDIDATES = int(os.getenv("RAG_CONTEXT_CANDIDATES") or 5)
+RAG_CONTEXT_MAX_TOKENS = int(os.getenv("RAG_CONTEXT_MAX_TOKENS") or 512)
+RAG_MMR_LAMBDA = float(os.getenv("RAG_MMR_LAMBDA") or 0.7)
+RAG_DUPLICATE_THRESHOLD = float(os.getenv("RAG_DUPLICATE_THRESHOLD") or 0.95)
+
+# แคชคำตอบจาก LLM ตามความหมายของคำถาม (ปิดได้ด้วย SEMANTIC_CACHE_SIZE=0)
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE") or 1000)
+answer_cache = SemanticCache(
+    max_entries=SEMANTIC_CACHE_SIZE,
+    ttl=float(os.getenv("SEMANTIC_CACHE_TTL") or 3600),
+    threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD") or 0.95),
+    max_bytes=int(os.getenv("SEMANTIC_CACHE_MAX_BYTES") or 32 * 1024 * 1024)
+) if SEMANTIC_CACHE_SIZE > 0 else None
+
+# จำกัดการเรียก LLM: จำนวนพร้อมกัน, คิวรอ, เวลารอสูงสุด และอัตราต่อผู้ใช้ (ครั้ง/นาที, 0 = ไม่จำกัด)
+# คำขอที่รอนานเกินหรือถูกจำกัดจะตอบด้วยคำตอบของเอกสารที่ใกล้ที่สุดแทน, LLM_MAX_CONCURRENCY=0 = ปิด
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY") or 4)
+LLM_QUEUE_SIZE = int(os.getenv("LLM_QUEUE_SIZE") or 16)
+LLM_QUEUE_TIMEOUT_MS = float(os.getenv("LLM_QUEUE_TIMEOUT_MS") or 5000)
+LLM_USER_RATE_PER_MINUTE = float(os.getenv("LLM_USER_RATE_PER_MINUTE") or 10)
+LLM_USER_BURST = int(os.getenv("LLM_USER_BURST") or 5)
+llm_admission = AdmissionController(
+    max_concurrent=LLM_MAX_CONCURRENCY,
+    max_queue=LLM_QUEUE_SIZE,
+    queue_timeout=LLM_QUEUE_TIMEOUT_MS / 1000,
+    rate_per_minute=LLM_USER_RATE_PER_MINUTE,
+    burst=LLM_USER_BURST
+) if LLM_MAX_CONCURRENCY > 0 else None
+LLM_SHED = metrics.registry.register(metrics.Counter(
+    'linebot_llm_shed_total', 'LLM calls shed by admission control, answered from the best document', ['reason']))
+if llm_admission is not None:
+    metrics.gauge('linebot_llm_queue_depth', 'Requests waiting for an LLM slot', lambda: llm_admission.queue_depth)
+    metrics.gauge('linebot_llm_active', 'LLM calls holding an admission slot', lambda: llm_admission.active)
+
+# ค้นหาเอกสารไปพร้อมกับการรอ Dialogflow (และเรียก LLM ล่วงหน้าเมื่อเปิด RAG_SPECULATIVE_LLM)
+RAG_SPECULATIVE = os.getenv("RAG_SPECULATIVE", "false").lower() in ("1", "true", "yes")
+RAG_SPECULATIVE_WORKERS = int(os.getenv("RAG_SPECULATIVE_WORKERS") or 4)
+RAG_SPECULATIVE_LLM = os.getenv("RAG_SPECULATIVE_LLM", "false").lower() in ("1", "true", "yes")
+# จำนวน LLM call ล่วงหน้าที่ทำพร้อมกันได้ และเวลาที่รอ Dialogflow ก่อนเริ่ม LLM
+RAG_SPECULATIVE_LLM_MAX = int(os.getenv("RAG_SPECULATIVE_LLM_MAX") or 2)
+RAG_SPECULATIVE_LLM_DELAY_MS = float(os.getenv("RAG_SPECULATIVE_LLM_DELAY_MS") or 0)
+_speculation_pool = None
+_speculation_lock = threading.Lock()
+_speculative_llm_slots = threading.BoundedSemaphore(max(1, RAG_SPECULATIVE_LLM_MAX))
+SPECULATION = metrics.registry.register(metrics.Counter(
+    'linebot_speculation_total', 'Speculative document searches by how they ended', ['result']))
+
+# แบ่ง index ตาม corpus: RAG_SHARDS = กฎเป็น JSON {"ชื่อ": {"files": [glob], "keywords": [...]}}
+# RAG_SHARD_BY_SOURCE=true = หนึ่ง shard ต่อไฟล์ที่ไม่ตรงกฎใด, RAG_SHARD_ROUTE_TOP = ค้นเฉพาะ N shard
+# ที่ centroid ใกล้คำถามที่สุด (0 = ค้นทุก shard)
+RAG_SHARDS = load_shard_rules(os.getenv("RAG_SHARDS"))
+RAG_SHARD_BY_SOURCE = os.getenv("RAG_SHARD_BY_SOURCE", "false").lower() in ("1", "true", "yes")
+RAG_SHARD_ROUTE_TOP = int(os.getenv("RAG_SHARD_ROUTE_TOP") or 0)
+RAG_SHARD_WORKERS = int(os.getenv("RAG_SHARD_WORKERS") or 4)
+
+# ช่วงเวลา (วินาที) ในการตรวจหาไฟล์เอกสารที่เปลี่ยนแปลง, 0 = ปิดการ reload อัตโนมัติ
+RAG_RELOAD_INTERVAL = float(os.getenv("RAG_RELOAD_INTERVAL") or 0)
 
 def initialize_rag():
-    global rag_system
+    """
+    สร้างระบบค้นเอกสารครั้งเดียว (โหลด encoder และ index) คำขอที่เข้ามาระหว่างนั้นจะรอให้เสร็จแทนการสร้างซ้ำ
+    """
+    with _rag_init_lock:
+        if rag_system is not None:
+            return True
+        return _initialize_rag()
+
+def _create_rag_system():
+    """
+    สร้างระบบค้นเอกสารตามค่าใน environment (ยังไม่โหลดเอกสาร)
+    """
+    # artifact ของ index ที่บันทึกไว้ ใช้ซ้ำเมื่อเนื้อหาไฟล์ไม่เปลี่ยน
+    index_dir = os.getenv("RAG_INDEX_DIR") or os.path.join(BASE_DIR, 'data', 'index')
+    options = dict(
+        index_dir=index_dir,
+        index_type=os.getenv("RAG_INDEX_TYPE") or 'flat',
+        index_params={
+            'nlist': int(os.getenv("RAG_NLIST") or 0) or None,
+            'nprobe': int(os.getenv("RAG_NPROBE") or 0) or None,
+            'ef_search': int(os.getenv("RAG_EF_SEARCH") or 0) or None
+        },
+        query_cache_size=int(os.getenv("RAG_QUERY_CACHE_SIZE") or 1024),
+        encoder_backend=os.getenv("RAG_ENCODER_BACKEND") or 'torch',
+        onnx_dir=os.getenv("RAG_ONNX_DIR") or None,
+        onnx_threads=int(os.getenv("RAG_ONNX_THREADS") or 0) or None,
+        # รวมเอกสารถาม-ตอบที่ซ้ำกันเกือบทั้งหมดไว้เป็นรายการเดียวใน index (เช่น 0.97), 0 = ปิด
+        dedupe_threshold=float(os.getenv("RAG_DEDUPE_THRESHOLD") or 0),
+        read_only=RAG_READ_ONLY,
+        hybrid=RAG_LEXICAL
+    )
+    if RAG_SHARDS or RAG_SHARD_BY_SOURCE:
+        # แต่ละ shard ถูกค้นพร้อมกันใน thread pool ของตัวเอง จึงไม่ใช้ micro-batching
+        router = ShardRouter(RAG_SHARDS, by_source=RAG_SHARD_BY_SOURCE, route_top=RAG_SHARD_ROUTE_TOP)
+        return ShardedRAGSystem(router, workers=RAG_SHARD_WORKERS, **options)
+    return RAGSystem(
+        batch_size=int(os.getenv("RAG_BATCH_SIZE") or 16),
+        batch_wait_ms=float(os.getenv("RAG_BATCH_WAIT_MS") or 2),
+        **options
+    )
+
+def _initialize_rag():
+    global rag_system, _unloaded_rag_system
     try:
-        rag_system = RAGSystem()
-        base_dir = os.path.abspath(os.path.dirname(__file__))
-        json_dir = os.path.join(base_dir, 'data', 'json')
-        
-        if os.path.exists(json_dir):
-            success = rag_system.load_documents(json_dir)  # ส่งโฟลเดอร์แทนไฟล์เดียว
-            if success:
-                logger.info("RAG system initialized successfully")
-                return True
-        logger.error(f"JSON directory not found at {json_dir}")
-        return False
+        json_dir = RAG_DATA_DIR
+        if not os.path.exists(json_dir):
+            logger.error(f"JSON directory not found at {json_dir}")
+            return False
+        system = _unloaded_rag_system or _create_rag_system()
+        if not system.load_documents(json_dir):  # ส่งโฟลเดอร์แทนไฟล์เดียว
+            # ยังไม่เผยแพร่ คำขอหรือ warm-up ครั้งถัดไปจะลองโหลดใหม่ด้วยระบบเดิม
+            _unloaded_rag_system = system
+            reason = f"no usable index artifact in {system.index_dir} yet (build it with build_index.py)" \
+                if RAG_READ_ONLY else f"loading documents from {json_dir} failed"
+            logger.error(f"RAG system is not ready: {reason}")
+            return False
+        # เผยแพร่หลังโหลดเสร็จ คำขอที่เข้ามาระหว่างนั้นจึงไม่เห็น index ที่ยังสร้างไม่เสร็จ
+        rag_system = system
+        _unloaded_rag_system = None
+        logger.info("RAG system initialized successfully")
+        if RAG_RELOAD_INTERVAL > 0:
+            start_reload_watcher(RAG_RELOAD_INTERVAL)
+        return True
     except Exception as e:
         logger.error(f"Error initializing RAG system: {str(e)}")
         return False
 
-def search_from_documents(question):
+def reload_documents():
+    """
+    ตรวจหาไฟล์ JSON ที่เพิ่ม/แก้ไข/ลบ แล้วอัปเดต index โดยไม่ต้องรีสตาร์ท
+    """
+    if rag_system is None:
+        return None
+    return rag_system.reload()
+
+def _reload_loop(interval):
+    stop_event = threading.Event()
+    while not stop_event.wait(interval):
+        try:
+            reload_documents()
+        except Exception as e:
+            logger.error(f"เกิดข้อผิดพลาดในการ reload เอกสาร: {str(e)}")
+
+def start_reload_watcher(interval):
+    """
+    เริ่ม thread เบื้องหลังที่คอยตรวจไฟล์เอกสารทุก ๆ interval วินาที
+    """
+    global _reload_thread
+    if _reload_thread is not None and _reload_thread.is_alive():
+        return
+    _reload_thread = threading.Thread(target=_reload_loop, args=(interval,), name="rag-reload", daemon=True)
+    _reload_thread.start()
+    logger.info(f"เริ่มตรวจสอบการเปลี่ยนแปลงเอกสารทุก {interval} วินาที")
+
+def warm_up_rag():
+    """
+    โหลด encoder และ index แล้วค้นหาหนึ่งครั้ง เพื่อให้ forward pass แรกของโมเดลและหน้าของ index
+    ที่ถูก mmap ไว้เกิดขึ้นก่อนคำขอจริง
+    """
+    if not initialize_rag():
+        return False
+    if not rag_system.get_stats()['documents']:
+        # โหลดสำเร็จแต่ยังไม่มีเอกสาร ตรวจไฟล์ (หรือ artifact ในโหมด read-only) อีกครั้งทุกรอบที่ลองใหม่
+        reload_documents()
+        if not rag_system.get_stats()['documents']:
+            logger.error(f"No documents indexed from {RAG_DATA_DIR}")
+            return False
+    if RAG_FAQ_FAST_PATH:
+        # ดัชนี BM25 ถูกสร้างเมื่อใช้ครั้งแรก ให้เกิดตอน warm-up แทนคำขอแรก
+        rag_system.match_question("ทดสอบระบบ", RAG_FAQ_MIN_SIMILARITY)
+    query_embedding, results = rag_system.search_with_embedding("ทดสอบระบบ", k=max(3, RAG_CONTEXT_CANDIDATES))
+    if results:
+        select_passages(query_embedding[0], results, rag_system.document_embeddings(results),
+                        max_tokens=RAG_CONTEXT_MAX_TOKENS)
+    return True
+
+def get_rag_stats():
+    """
+    สถานะของระบบค้นเอกสาร (โฟลเดอร์ข้อมูล, จำนวนเอกสาร, version ของ index) จากสถานะที่โหลดไว้แล้ว
+    """
+    stats = {'path': RAG_DATA_DIR, 'exists': os.path.exists(RAG_DATA_DIR), 'loaded': rag_system is not None}
+    if rag_system is not None:
+        stats.update(rag_system.get_stats())
+    return stats
+
+def get_cache_stats():
+    """
+    สถิติของแคชคำตอบ (hit rate, ขนาด, จำนวนที่ถูกลบ)
+    """
+    return answer_cache.get_stats() if answer_cache is not None else None
+
+def get_llm_admission_stats():
+    """
+    สถิติการจำกัดการเรียก LLM (จำนวนที่รอ, กำลังทำงาน และที่ถูกตัดแยกตามเหตุผล)
+    """
+    return llm_admission.get_stats() if llm_admission is not None else None
+
+def encode_texts(texts):
+    """
+    encode ข้อความด้วย encoder และ query cache เดียวกับการค้นเอกสาร (ใช้โดย intent classifier ในเครื่อง)
+    """
+    if rag_system is None and not initialize_rag():
+        raise RuntimeError("RAG system is not available")
+    return rag_system.encode_queries(texts)
+
+def retrieve_context(question, user_id=None):
+    """
+    ขั้นค้นหา (FAQ, embedding + FAISS และเลือก context) โดยยังไม่เรียก LLM
+    คืนค่า dict ที่ส่งต่อให้ answer_from_context หรือ None ถ้าระบบยังไม่พร้อม
+    user_id ใช้จำกัดอัตราการเรียก LLM ต่อผู้ใช้
+    """
+    global rag_system
+    if rag_system is None:
+        if not initialize_rag():
+            return None
+
+    if RAG_FAQ_FAST_PATH:
+        faq_match = rag_system.match_question(question, RAG_FAQ_MIN_SIMILARITY)
+        if faq_match is not None:
+            return {'question': question, 'faq_match': faq_match}
+
+    corpus_version = rag_system.version
+    query_embedding, results = rag_system.search_with_embedding(question, k=max(3, RAG_CONTEXT_CANDIDATES))
+    logger.info(f"คำถาม: {question}")
+    if not results:
+        return {'question': question, 'results': []}
+
+    # ลำดับของ results มาจาก rank fusion ส่วนเกณฑ์และคำตอบสำรองใช้ผลที่ cosine สูงสุด
+    best_match = max(results, key=lambda result: result['score'])
+    logger.info(f"คำตอบที่ดีที่สุด: {best_match['question']} (คะแนน: {best_match['score']:.4f})")
+    contexts = []
+    context_ids = []
+    if best_match['score'] >= 0.3:
+        # เลือก passage ที่เกี่ยวข้องและไม่ซ้ำกันให้พอดีงบ token แทนการต่อทุกผลลัพธ์
+        passages = select_passages(
+            query_embedding[0], results, rag_system.document_embeddings(results),
+            max_tokens=RAG_CONTEXT_MAX_TOKENS, mmr_lambda=RAG_MMR_LAMBDA,
+            duplicate_threshold=RAG_DUPLICATE_THRESHOLD, min_score=0.2
+        )
+        contexts = [passage['passage'] for passage in passages]
+        context_ids = [passage['id'] for passage in passages]
+        logger.info(f"เลือก context {len(passages)} จาก {len(results)} รายการ "
+                    f"({sum(passage['tokens'] for passage in passages)} token โดยประมาณ)")
+    return {
+        'question': question,
+        'results': results,
+        'best_match': best_match,
+        'query_embedding': query_embedding,
+        'contexts': contexts,
+        'context_ids': context_ids,
+        'corpus_version': corpus_version,
+        'user_id': user_id
+    }
+
+def answer_from_context(retrieval):
+    """
+    ขั้นตอบ: ใช้คำตอบจาก FAQ, แคช หรือเรียก LLM ด้วย context ที่ค้นได้
+    คืนค่า (คำตอบ, พบในเอกสารหรือไม่, context, ชนิดของผลลัพธ์สำหรับ metrics)
+    """
+    if retrieval is None:
+        return "ขออภัย ระบบยังไม่พร้อมใช้งาน", False, None, None
+    question = retrieval['question']
+
+    faq_match = retrieval.get('faq_match')
+    if faq_match is not None:
+        logger.info(f"คำถามตรงกับ FAQ: {faq_match['question']} ตอบทันทีโดยไม่เรียก LLM")
+        return faq_match['answer'], True, {
+            'question': question,
+            'contexts': [f"Q: {faq_match['question']}\nA: {faq_match['answer']}"],
+            'combined_context': None,
+            'top_score': faq_match['score'],
+            'cache_hit': False,
+            'exact_match': True
+        }, 'faq_match'
+
+    if not retrieval['results']:
+        return "ขออภัย ไม่พบข้อมูลที่เกี่ยวข้อง", False, None, 'no_match'
+
+    contexts = retrieval['contexts']
+    if not contexts:
+        return "ขออภัย ไม่พบข้อมูลที่ตรงกับคำถามของคุณ", False, None, 'no_match'
+
+    best_match = retrieval['best_match']
+    query_embedding = retrieval['query_embedding']
+    context_ids = retrieval['context_ids']
+    corpus_version = retrieval['corpus_version']
+    combined_context = "\n\n".join(contexts)
+    answer = None
+    if answer_cache is not None:
+        answer = answer_cache.lookup(query_embedding, context_ids, corpus_version)
+    cache_hit = answer is not None
+    if cache_hit:
+        logger.info("พบคำตอบในแคช ไม่ต้องเรียก LLM")
+        outcome = 'cache_hit'
+    else:
+        try:
+            with llm_admission.admit(retrieval.get('user_id')) if llm_admission is not None else nullcontext():
+                answer = generate_response(question, combined_context)
+            if answer in OLLAMA_ERROR_RESPONSES:
+                outcome = 'llm_failure'
+            else:
+                outcome = 'llm_answer'
+                if answer_cache is not None:
+                    answer_cache.store(query_embedding, context_ids, answer, corpus_version)
+        except AdmissionRejected as e:
+            # LLM ไม่ว่างหรือผู้ใช้ถามถี่เกินไป ตอบจากเอกสารที่ใกล้ที่สุดทันทีแทนการรอ
+            logger.warning(f"ข้ามการเรียก LLM ({e.reason}) ใช้คำตอบจากเอกสารแทน")
+            LLM_SHED.inc(e.reason)
+            outcome = 'llm_shed'
+            answer = best_match['answer']
+        except:
+            # ถ้า Ollama ไม่พร้อม ใช้คำตอบจาก RAG โดยตรง
+            outcome = 'llm_failure'
+            answer = best_match['answer']
+    return answer, True, {
+        'question': question,
+        'contexts': contexts,
+        'combined_context': combined_context,
+        'top_score': best_match['score'],
+        'cache_hit': cache_hit,
+        'exact_match': False
+    }, outcome
+
+def _finish(answer):
+    reply_text, found, context, outcome = answer
+    if outcome:
+        metrics.record_outcome(outcome)
+    return reply_text, found, context
+
+def search_from_documents(question, user_id=None):
     try:
-        global rag_system
-        if rag_system is None:
-            if not initialize_rag():
-                return "ขออภัย ระบบยังไม่พร้อมใช้งาน", False, None
-
-        results = rag_system.search(question, k=3)
-        logger.info(f"คำถาม: {question}")
-        
-        if not results:
-            return "ขออภัย ไม่พบข้อมูลที่เกี่ยวข้อง", False, None
-
-        best_match = results[0]
-        logger.info(f"คำตอบที่ดีที่สุด: {best_match['question']} (คะแนน: {best_match['score']:.4f})")
-        
-        if best_match['score'] >= 0.3:
-            contexts = []
-            for result in results:
-                if result['score'] >= 0.2:
-                    contexts.append(f"Q: {result['question']}\nA: {result['answer']}")
-            
-            if contexts:
-                combined_context = "\n\n".join(contexts)
-                try:
-                    answer = generate_response(question, combined_context)
-                except:
-                    # ถ้า Ollama ไม่พร้อม ใช้คำตอบจาก RAG โดยตรง
-                    answer = best_match['answer']
-                return answer, True, {
-                    'question': question,
-                    'contexts': contexts,
-                    'combined_context': combined_context,
-                    'top_score': best_match['score']
-                }
-
-        return "ขออภัย ไม่พบข้อมูลที่ตรงกับคำถามของคุณ", False, None
+        return _finish(answer_from_context(retrieve_context(question, user_id)))
 
     except Exception as e:
         logger.error(f"เกิดข้อผิดพลาดในการค้นหา: {str(e)}")
         return "เกิดข้อผิดพลาดในการค้นหา", False, None
+
+class SpeculativeSearch:
+    """
+    ค้นหาเอกสารล่วงหน้าใน thread pool ระหว่างรอ Dialogflow
+    ถ้า Dialogflow ตอบได้ให้เรียก cancel() ถ้าไม่ได้ให้เรียก result() แทน search_from_documents
+    เมื่อ allow_llm จะเรียก LLM ล่วงหน้าด้วย ภายใต้จำนวนที่ RAG_SPECULATIVE_LLM_MAX กำหนด
+    การเรียกล่วงหน้าไม่หักโควตาต่อผู้ใช้ ถ้า Dialogflow ตอบได้และทิ้งผลไป ผู้ใช้จึงไม่เสียโควตา
+    """
+
+    def __init__(self, question, allow_llm=False, user_id=None):
+        self.question = question
+        self.user_id = user_id
+        self.allow_llm = allow_llm
+        self.llm_started = False
+        self._cancelled = threading.Event()
+        self._finished = False
+        # ส่ง trace ของคำขอไปด้วย เวลาที่ใช้ใน thread pool จะได้อยู่ใน trace เดียวกัน
+        self._future = _get_speculation_pool().submit(metrics.in_context(self._run))
+
+    def _run(self):
+        retrieval = retrieve_context(self.question, self.user_id)
+        needs_llm = retrieval is not None and retrieval.get('faq_match') is None and retrieval.get('contexts')
+        if not needs_llm:
+            return retrieval, answer_from_context(retrieval)
+        # รอ Dialogflow สักครู่ก่อน เพื่อไม่เสีย LLM ไปกับคำถามที่ Dialogflow ตอบได้เร็ว
+        if not self.allow_llm or self._cancelled.wait(RAG_SPECULATIVE_LLM_DELAY_MS / 1000):
+            return retrieval, None
+        if not _speculative_llm_slots.acquire(blocking=False):
+            SPECULATION.inc('llm_skipped')
+            return retrieval, None
+        try:
+            self.llm_started = True
+            # ไม่หักโควตาของผู้ใช้ตอนเรียกล่วงหน้า จะหักเมื่อใช้คำตอบนี้จริงใน result()
+            return retrieval, answer_from_context(dict(retrieval, user_id=None))
+        finally:
+            _speculative_llm_slots.release()
+
+    def cancel(self):
+        """
+        Dialogflow ตอบได้ ทิ้งผลที่คำนวณล่วงหน้า (LLM ที่เริ่มไปแล้วยังเก็บคำตอบลงแคช)
+        """
+        if self._finished:
+            return
+        self._finished = True
+        self._cancelled.set()
+        if self._future.cancel():
+            SPECULATION.inc('cancelled')
+            return
+        SPECULATION.inc('discarded')
+        if self.llm_started:
+            SPECULATION.inc('llm_wasted')
+
+    def result(self):
+        """
+        ผลการค้นหาในรูปแบบเดียวกับ search_from_documents
+        """
+        self._finished = True
+        if self._future.cancel():
+            # pool ยังไม่ได้เริ่มงานนี้ ค้นหาเองเลยดีกว่ารอคิว
+            SPECULATION.inc('not_started')
+            return search_from_documents(self.question, self.user_id)
+        try:
+            with metrics.timed('speculation_wait'):
+                retrieval, answer = self._future.result()
+            if answer is None:
+                answer = answer_from_context(retrieval)
+            elif self.llm_started and answer[3] in ('llm_answer', 'llm_failure') and llm_admission is not None:
+                llm_admission.charge(self.user_id)
+            SPECULATION.inc('used')
+            return _finish(answer)
+        except Exception as e:
+            logger.error(f"การค้นหาล่วงหน้าล้มเหลว ค้นหาใหม่อีกครั้ง: {str(e)}")
+            return search_from_documents(self.question, self.user_id)
+
+def start_speculative_search(question, user_id=None):
+    """
+    เริ่มค้นหาเอกสารพร้อมกับการเรียก Dialogflow (คืนค่า None เมื่อปิด RAG_SPECULATIVE)
+    """
+    if not RAG_SPECULATIVE:
+        return None
+    try:
+        return SpeculativeSearch(question, allow_llm=RAG_SPECULATIVE_LLM and RAG_SPECULATIVE_LLM_MAX > 0,
+                                 user_id=user_id)
+    except Exception as e:
+        logger.error(f"ไม่สามารถเริ่มค้นหาล่วงหน้าได้: {str(e)}")
+        return None
+
+def _get_speculation_pool():
+    global _speculation_pool
+    if _speculation_pool is None:
+        with _speculation_lock:
+            if _speculation_pool is None:
+                _speculation_pool = ThreadPoolExecutor(RAG_SPECULATIVE_WORKERS, thread_name_prefix="rag-speculative")
+    return _speculation_pool
@@ -0,0 +1,141 @@
+import time
+import logging
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import Dict, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+
+class SemanticCache:
+    """LRU/TTL cache of generated answers keyed by query embedding
+
+    A lookup hits when a cached query is within ``threshold`` cosine
+    similarity of the new one *and* retrieved the same documents, so a
+    paraphrase that would be answered from different context still goes to
+    the LLM. Entries are dropped whenever the corpus version changes.
+
+    ``max_bytes`` bounds the embedding matrix plus the cached answers. The
+    matrix starts empty and doubles (up to ``max_entries`` rows) only while
+    the budget allows, so a large ``max_entries`` does not preallocate
+    memory that was never asked for.
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 3600, threshold: float = 0.95,
+                 max_bytes: int = 32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._matrix = None  # แถวที่ i คือ embedding ของ slot i
+        self._entries = OrderedDict()  # slot -> entry, เรียงจากใช้ล่าสุดน้อยที่สุด
+        self._free_slots = []
+        self._bytes = 0  # ขนาดของคำตอบที่แคชไว้ (ไม่รวม matrix)
+        self._version = None
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0, "invalidations": 0}
+
+    def _used_bytes(self) -> int:
+        return self._bytes + (self._matrix.nbytes if self._matrix is not None else 0)
+
+    def _check_version(self, version):
+        if version != self._version:
+            if self._entries:
+                self._stats["invalidations"] += 1
+                logger.info(f"Corpus changed, dropping {len(self._entries)} cached answers")
+            self._entries.clear()
+            self._free_slots = list(range(len(self._matrix))) if self._matrix is not None else []
+            self._bytes = 0
+            self._version = version
+
+    def _remove(self, slot: int):
+        entry = self._entries.pop(slot)
+        self._bytes -= entry["bytes"]
+        self._free_slots.append(slot)
+
+    def _purge_expired(self, now: float):
+        for slot in [slot for slot, entry in self._entries.items() if now - entry["created_at"] > self.ttl]:
+            self._remove(slot)
+            self._stats["expired"] += 1
+
+    def _grow(self, entry_bytes: int):
+        rows, dimension = self._matrix.shape
+        affordable = (self.max_bytes - self._used_bytes() - entry_bytes) // (dimension * 4)
+        target = min(self.max_entries, max(16, rows * 2), rows + affordable)
+        if target > rows:
+            matrix = np.zeros((target, dimension), dtype='float32')
+            matrix[:rows] = self._matrix
+            self._matrix = matrix
+            self._free_slots.extend(range(rows, target))
+
+    def lookup(self, embedding: np.ndarray, doc_ids: Sequence[int], version=None) -> Optional[str]:
+        with self._lock:
+            self._check_version(version)
+            if not self._entries:
+                self._stats["misses"] += 1
+                return None
+
+            slots = np.fromiter(self._entries.keys(), dtype='int64', count=len(self._entries))
+            scores = self._matrix[slots] @ embedding.reshape(-1)
+            now = time.time()
+            doc_ids = tuple(doc_ids)
+            for position in np.argsort(-scores):
+                if scores[position] < self.threshold:
+                    break
+                slot = int(slots[position])
+                entry = self._entries[slot]
+                if now - entry["created_at"] > self.ttl:
+                    self._remove(slot)
+                    self._stats["expired"] += 1
+                    continue
+                if entry["doc_ids"] == doc_ids:
+                    self._entries.move_to_end(slot)
+                    self._stats["hits"] += 1
+                    return entry["answer"]
+
+            self._stats["misses"] += 1
+            return None
+
+    def store(self, embedding: np.ndarray, doc_ids: Sequence[int], answer: str, version=None):
+        with self._lock:
+            embedding = embedding.reshape(-1).astype('float32')
+            if self._matrix is None:
+                self._matrix = np.zeros((0, embedding.shape[0]), dtype='float32')
+            self._check_version(version)
+            now = time.time()
+            self._purge_expired(now)
+
+            entry_bytes = len(answer.encode('utf-8'))
+            if entry_bytes + embedding.nbytes > self.max_bytes:
+                return
+            if not self._free_slots:
+                self._grow(entry_bytes)
+            while self._entries and (not self._free_slots or self._used_bytes() + entry_bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+            if not self._free_slots or self._used_bytes() + entry_bytes > self.max_bytes:
+                return
+
+            slot = self._free_slots.pop()
+            self._matrix[slot] = embedding
+            self._entries[slot] = {
+                "doc_ids": tuple(doc_ids),
+                "answer": answer,
+                "created_at": now,
+                "bytes": entry_bytes
+            }
+            self._bytes += entry_bytes
+
+    def clear(self):
+        with self._lock:
+            self._check_version(object())
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._entries)
+            stats["bytes"] = self._used_bytes()
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
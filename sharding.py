@@ -0,0 +1,334 @@
+import os
+import re
+import time
+import json
+import fnmatch
+import logging
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from embedding_service import EmbeddingCache
+from encoders import create_encoder
+from rag import RAGSystem, encode_with_cache, list_json_files
+from compaction import compaction_stats
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SHARD = 'default'
+# id ของเอกสารที่ออกไปนอก ShardedRAGSystem = ลำดับของ shard * SHARD_ID_STRIDE + id ภายใน shard
+SHARD_ID_STRIDE = 1 << 40
+
+
+def load_shard_rules(raw: Optional[str]) -> Dict[str, Dict]:
+    """Parse routing rules from JSON, e.g. ``{"hr": {"files": ["hr_*.json"], "keywords": ["ลาป่วย"]}}``
+
+    ``files`` are glob patterns over file names; ``keywords`` send a question
+    containing any of them to that shard only.
+    """
+    if not raw:
+        return {}
+    try:
+        rules = json.loads(raw)
+        return {name: {'files': list(rule.get('files') or []), 'keywords': list(rule.get('keywords') or [])}
+                for name, rule in rules.items()}
+    except Exception as e:
+        logger.error(f"Invalid shard rules: {str(e)}")
+        return {}
+
+
+class ShardRouter:
+    """Assigns files to shards and picks the shards a question is searched in
+
+    A file belongs to the first rule whose ``files`` pattern matches it, to
+    a shard named after the file when ``by_source`` is set, or to the
+    default shard. A question goes to the shards whose keywords it contains;
+    otherwise, with ``route_top > 0``, to the shards whose document centroid
+    is closest to the query embedding; otherwise to every shard.
+    """
+
+    def __init__(self, rules: Optional[Dict[str, Dict]] = None, by_source: bool = False, route_top: int = 0):
+        self.rules = rules or {}
+        self.by_source = by_source
+        self.route_top = route_top
+
+    def shard_for_file(self, source: str) -> str:
+        for name, rule in self.rules.items():
+            if any(fnmatch.fnmatch(source, pattern) for pattern in rule['files']):
+                return name
+        if self.by_source:
+            return os.path.splitext(source)[0]
+        return DEFAULT_SHARD
+
+    def route(self, query: str, query_embedding: np.ndarray, centroids: Dict[str, np.ndarray]) -> List[str]:
+        names = list(centroids)
+        matched = [name for name in names
+                   if any(keyword in query for keyword in self.rules.get(name, {}).get('keywords', []))]
+        if matched:
+            return matched
+        if self.route_top > 0 and len(names) > self.route_top:
+            scores = {name: float(centroid @ query_embedding) for name, centroid in centroids.items()}
+            return sorted(names, key=scores.get, reverse=True)[:self.route_top]
+        return names
+
+
+def _directory_name(name: str) -> str:
+    return re.sub(r'[^\w.-]', '_', name) or '_'
+
+
+class ShardedRAGSystem:
+    """One ``RAGSystem`` per corpus shard, searched in parallel with merged top-k
+
+    All shards share one encoder and query-embedding cache. Each shard keeps
+    its own artifact under ``index_dir/shards/<name>``, so reloading or
+    rebuilding one shard leaves the others untouched. Document ids handed
+    out are unique across shards (see ``SHARD_ID_STRIDE``) and every result
+    also carries its ``shard``.
+    """
+
+    def __init__(self, router: ShardRouter, index_dir: Optional[str] = None, workers: int = 4,
+                 model_name: str = 'intfloat/multilingual-e5-base', encoder_backend: str = 'torch',
+                 onnx_dir: Optional[str] = None, onnx_quantize: bool = True, onnx_threads: Optional[int] = None,
+                 query_cache_size: int = 1024, **shard_kwargs):
+        self.router = router
+        self.index_dir = index_dir
+        self.encoder = create_encoder(encoder_backend, model_name, onnx_dir, onnx_quantize, onnx_threads)
+        self._query_cache = EmbeddingCache(query_cache_size)
+        self._shard_kwargs = dict(shard_kwargs, model_name=model_name, encoder_backend=encoder_backend,
+                                  onnx_dir=onnx_dir, onnx_quantize=onnx_quantize, onnx_threads=onnx_threads)
+        self._pool = ThreadPoolExecutor(max(1, workers), thread_name_prefix="rag-shard")
+        self._shards = {}  # name -> RAGSystem
+        self._numbers = {}  # name -> ลำดับที่ใช้สร้าง id (ไม่นำกลับมาใช้ใหม่)
+        self._centroids = {}  # name -> (version, centroid)
+        self._topology_version = 0
+        self._lock = threading.Lock()
+        self.json_path = None
+
+    @property
+    def shards(self) -> Dict[str, RAGSystem]:
+        return dict(self._shards)
+
+    @property
+    def version(self) -> int:
+        """Grows whenever any shard publishes a new snapshot or a shard is added or removed"""
+        return self._topology_version + sum(shard.version for shard in self._shards.values())
+
+    @property
+    def dimension(self) -> Optional[int]:
+        for shard in self._shards.values():
+            if shard.dimension is not None:
+                return shard.dimension
+        return None
+
+    def document_count(self) -> int:
+        return sum(len(shard.documents) for shard in self._shards.values())
+
+    def get_stats(self) -> Dict:
+        shards = self.shards
+        return {
+            'documents': self.document_count(),
+            'version': self.version,
+            'compaction': compaction_stats(sum(len(shard.documents) for shard in shards.values()),
+                                           sum(len(shard.snapshot.aliases) for shard in shards.values())),
+            'query_cache_hits': self._query_cache.hits,
+            'query_cache_misses': self._query_cache.misses,
+            'shards': {name: {'documents': len(shard.documents), 'version': shard.version}
+                       for name, shard in shards.items()}
+        }
+
+    def _make_shard(self, name: str) -> RAGSystem:
+        index_dir = os.path.join(self.index_dir, 'shards', _directory_name(name)) if self.index_dir else None
+        return RAGSystem(index_dir=index_dir, encoder=self.encoder, query_cache=self._query_cache,
+                         file_filter=lambda source, name=name: self.router.shard_for_file(source) == name,
+                         **self._shard_kwargs)
+
+    def _shard_names(self, json_path: str) -> List[str]:
+        names = {self.router.shard_for_file(os.path.basename(json_file)) for json_file in list_json_files(json_path)}
+        return sorted(names)
+
+    def _sync_shards(self, json_path: str) -> Tuple[List[str], List[str]]:
+        """Create shards for new file groups and drop shards whose files are gone
+
+        Returns the names of the added shards and the files of the removed ones.
+        """
+        names = self._shard_names(json_path)
+        with self._lock:
+            added = [name for name in names if name not in self._shards]
+            removed = [name for name in self._shards if name not in names]
+            if not added and not removed:
+                return [], []
+            removed_files = [source for name in removed for source in self._shards[name].snapshot.sources]
+            shards = dict(self._shards)
+            for name in removed:
+                # เก็บ version ของ shard ที่ลบไว้ใน _topology_version เพื่อให้ version รวมไม่ลดลง
+                self._topology_version += shards[name].version
+                del shards[name]
+                logger.info(f"Shard {name} has no files left, removing it")
+            for name in added:
+                shards[name] = self._make_shard(name)
+                self._numbers.setdefault(name, len(self._numbers))
+            self._shards = shards
+            self._topology_version += 1
+            return added, removed_files
+
+    def load_documents(self, json_path: str) -> bool:
+        """Load (or build) every shard of ``json_path``; False if any shard failed"""
+        self.json_path = json_path
+        self._sync_shards(json_path)
+        ok = True
+        for name, shard in self._shards.items():
+            if not shard.load_documents(json_path):
+                logger.error(f"Failed to load shard {name}")
+                ok = False
+        logger.info(f"Loaded {self.document_count()} documents into {len(self._shards)} shards")
+        return ok
+
+    def reload(self, json_path: Optional[str] = None, shard: Optional[str] = None) -> Optional[Dict]:
+        """Apply file changes to all shards, or only to ``shard``
+
+        Returns the merged change summary with a per-shard breakdown, or
+        None if any shard failed.
+        """
+        json_path = json_path or self.json_path
+        added_shards, removed_files = self._sync_shards(json_path)
+        if shard is not None and shard not in self._shards:
+            logger.error(f"Unknown shard {shard}, have: {', '.join(self._shards)}")
+            return None
+        summary = {'added': [], 'changed': [], 'removed': list(removed_files), 'shards': {}}
+        ok = True
+        for name, rag in self._shards.items():
+            if shard is not None and name != shard:
+                continue
+            if name in added_shards:
+                if not rag.load_documents(json_path):
+                    ok = False
+                    continue
+                result = {'added': list(rag.snapshot.sources), 'changed': [], 'removed': [], 'version': rag.version}
+            else:
+                result = rag.reload(json_path)
+                if result is None:
+                    ok = False
+                    continue
+            summary['shards'][name] = result
+            for key in ('added', 'changed', 'removed'):
+                summary[key].extend(result[key])
+        summary['version'] = self.version
+        return summary if ok else None
+
+    def ingest(self, json_path: str, shard: Optional[str] = None, **kwargs) -> Optional[Dict]:
+        """Rebuild every shard, or only ``shard``, with :meth:`RAGSystem.ingest`"""
+        self.json_path = json_path
+        self._sync_shards(json_path)
+        if shard is not None and shard not in self._shards:
+            logger.error(f"Unknown shard {shard}, have: {', '.join(self._shards)}")
+            return None
+        start = time.perf_counter()
+        summaries = {}
+        for name, rag in self._shards.items():
+            if shard is not None and name != shard:
+                continue
+            summaries[name] = rag.ingest(json_path, **kwargs)
+            if summaries[name] is None:
+                return None
+        return {
+            'documents': sum(summary['documents'] for summary in summaries.values()),
+            'files': sum(summary['files'] for summary in summaries.values()),
+            'failed': [source for summary in summaries.values() for source in summary['failed']],
+            'seconds': time.perf_counter() - start,
+            'docs_per_second': sum(summary['documents'] for summary in summaries.values())
+            / max(time.perf_counter() - start, 1e-9),
+            'shards': summaries,
+            'version': self.version,
+            'compaction': compaction_stats(sum(summary['compaction']['documents'] for summary in summaries.values()),
+                                           sum(summary['compaction']['duplicates'] for summary in summaries.values()))
+        }
+
+    def encode_query(self, query: str) -> np.ndarray:
+        return self.encode_queries([query])
+
+    def encode_queries(self, queries: List[str]) -> np.ndarray:
+        return encode_with_cache(self._encode, self._query_cache, queries)
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        embeddings = self.encoder.encode(texts, convert_to_numpy=True, normalize_embeddings=True)
+        return embeddings.astype('float32')
+
+    def _centroid(self, name: str, shard: RAGSystem) -> Optional[np.ndarray]:
+        cached = self._centroids.get(name)
+        if cached is not None and cached[0] == shard.version:
+            return cached[1]
+        embeddings = shard.snapshot.embeddings
+        if embeddings is None or not len(embeddings):
+            return None
+        centroid = np.asarray(embeddings, dtype='float32').mean(axis=0)
+        centroid /= max(float(np.linalg.norm(centroid)), 1e-12)
+        self._centroids[name] = (shard.version, centroid)
+        return centroid
+
+    def _global(self, name: str, result: Dict) -> Dict:
+        return dict(result, id=self._numbers[name] * SHARD_ID_STRIDE + result['id'], shard=name, shard_id=result['id'])
+
+    def _route(self, query: str, query_embedding: np.ndarray) -> Dict[str, RAGSystem]:
+        shards = {name: shard for name, shard in self._shards.items() if shard.index is not None}
+        if self.router.rules or self.router.route_top > 0:
+            centroids = {}
+            for name, shard in shards.items():
+                centroid = self._centroid(name, shard) if self.router.route_top > 0 else None
+                centroids[name] = centroid if centroid is not None else np.zeros(query_embedding.shape[-1], 'float32')
+            shards = {name: shards[name] for name in self.router.route(query, query_embedding.reshape(-1), centroids)}
+        return shards
+
+    def search_by_embedding(self, query_embedding: np.ndarray, k: int = 3, query: Optional[str] = None) -> List[Dict]:
+        """Search the routed shards in parallel and merge their results by cosine score"""
+        shards = self._route(query or '', query_embedding)
+        if not shards:
+            return []
+        if len(shards) == 1:
+            name, shard = next(iter(shards.items()))
+            return [self._global(name, result) for result in shard.search_by_embedding(query_embedding, k, query)]
+        futures = {name: self._pool.submit(metrics.in_context(shard.search_by_embedding), query_embedding, k, query)
+                   for name, shard in shards.items()}
+        merged = []
+        for name, future in futures.items():
+            try:
+                merged.extend(self._global(name, result) for result in future.result())
+            except Exception as e:
+                logger.error(f"Error searching shard {name}: {str(e)}")
+        merged.sort(key=lambda result: result['score'], reverse=True)
+        return merged[:k]
+
+    def search_with_embedding(self, query: str, k: int = 3):
+        with metrics.timed('retrieval'):
+            with metrics.timed('encode'):
+                query_embedding = self.encode_query(query)
+            return query_embedding, self.search_by_embedding(query_embedding, k, query)
+
+    def search(self, query: str, k: int = 3) -> List[Dict]:
+        try:
+            return self.search_with_embedding(query, k)[1]
+        except Exception as e:
+            logger.error(f"Error during search: {str(e)}")
+            return []
+
+    def match_question(self, query: str, min_similarity: float = 0.85) -> Optional[Dict]:
+        for name, shard in self._shards.items():
+            match = shard.match_question(query, min_similarity)
+            if match is not None:
+                return self._global(name, match)
+        return None
+
+    def document_embeddings(self, results: List[Dict]) -> np.ndarray:
+        """Stored embeddings of merged ``results``, row for row"""
+        rows = [None] * len(results)
+        by_shard = {}
+        for i, result in enumerate(results):
+            by_shard.setdefault(result['shard'], []).append(i)
+        for name, positions in by_shard.items():
+            shard = self._shards.get(name)
+            local = [dict(results[i], id=results[i]['shard_id']) for i in positions]
+            embeddings = shard.document_embeddings(local) if shard is not None else \
+                self._encode([result['text'] for result in local])
+            for i, embedding in zip(positions, embeddings):
+                rows[i] = embedding
+        return np.vstack(rows) if rows else np.zeros((0, self.dimension or 0), dtype='float32')
@@ -0,0 +1,40 @@
+import hashlib
+import json
+
+import numpy as np
+import pytest
+
+
+class FakeEncoder:
+    """Deterministic encoder: normalized counts of hashed character bigrams"""
+
+    dimension = 32
+
+    def __init__(self):
+        self.calls = []
+
+    def encode(self, texts, convert_to_numpy=True, normalize_embeddings=True, **kwargs):
+        self.calls.append(list(texts))
+        embeddings = np.zeros((len(texts), self.dimension), dtype='float32')
+        for row, text in enumerate(texts):
+            for i in range(len(text) - 1):
+                embeddings[row, int(hashlib.md5(text[i:i + 2].encode('utf-8')).hexdigest(), 16) % self.dimension] += 1
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.where(norms > 0, norms, 1)
+
+
+@pytest.fixture
+def encoder(monkeypatch):
+    import rag
+    fake = FakeEncoder()
+    monkeypatch.setattr(rag, 'create_encoder', lambda *args, **kwargs: fake)
+    return fake
+
+
+@pytest.fixture
+def write_json():
+    def write(path, items):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(items, ensure_ascii=False), encoding='utf-8')
+        return path
+    return write
@@ -0,0 +1,81 @@
+import threading
+
+import pytest
+
+import admission
+from admission import AdmissionController, AdmissionRejected
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(admission.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def _rejection(controller, key=None):
+    with pytest.raises(AdmissionRejected) as rejected:
+        with controller.admit(key):
+            pass
+    return rejected.value.reason
+
+
+def test_full_queue_is_shed_immediately():
+    controller = AdmissionController(max_concurrent=1, max_queue=0)
+    with controller.admit():
+        assert _rejection(controller) == 'queue_full'
+    with controller.admit():
+        pass
+    stats = controller.get_stats()
+    assert stats['admitted'] == 2 and stats['queue_full'] == 1
+
+
+def test_waiter_gives_up_after_queue_timeout():
+    controller = AdmissionController(max_concurrent=1, max_queue=1, queue_timeout=0.05)
+    with controller.admit():
+        assert _rejection(controller) == 'timeout'
+    assert controller.get_stats()['queue_depth'] == 0
+
+
+def test_waiter_gets_slot_when_released():
+    controller = AdmissionController(max_concurrent=1, max_queue=1, queue_timeout=2)
+    holding = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with controller.admit():
+            holding.set()
+            release.wait(2)
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    holding.wait(2)
+    threading.Timer(0.05, release.set).start()
+    with controller.admit():
+        pass
+    holder.join()
+    assert controller.get_stats()['queued'] == 1
+
+
+def test_expected_wait_beyond_deadline_is_shed(clock):
+    controller = AdmissionController(max_concurrent=1, max_queue=4, queue_timeout=5)
+    with controller.admit():
+        clock[0] += 10
+    with controller.admit():
+        assert _rejection(controller) == 'deadline'
+
+
+def test_token_bucket_limits_each_user(clock):
+    controller = AdmissionController(rate_per_minute=60, burst=2)
+    for _ in range(2):
+        with controller.admit('alice'):
+            pass
+    assert _rejection(controller, 'alice') == 'rate_limited'
+    with controller.admit('bob'):
+        pass
+    with controller.admit(None):
+        pass
+    clock[0] += 1
+    with controller.admit('alice'):
+        pass
+    assert controller.charge('alice') is False
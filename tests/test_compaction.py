@@ -0,0 +1,81 @@
+import os
+
+import faiss
+import numpy as np
+
+from compaction import compaction_stats, find_duplicates
+from rag import RAGSystem
+
+FEES = [{'question': 'ค่าเทอมเท่าไร', 'answer': 'ภาคละ 15,000 บาท'},
+        {'question': 'สมัครเรียนได้ที่ไหน', 'answer': 'สมัครผ่านเว็บไซต์'}]
+COPY = [{'question': 'ค่าเทอมเท่าไร', 'answer': 'ภาคละ 15,000 บาท'}]
+
+
+def _vectors(*rows):
+    vectors = np.array(rows, dtype='float32')
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def test_find_duplicates_within_batch_and_against_index():
+    index = faiss.IndexIDMap2(faiss.IndexFlatIP(2))
+    index.add_with_ids(_vectors([1, 0]), np.array([1], dtype='int64'))
+    ids = np.array([2, 3, 4], dtype='int64')
+    signatures = [frozenset(), frozenset(), frozenset()]
+    aliases = find_duplicates(ids, _vectors([1, 0.01], [0, 1], [0.01, 1]), signatures, 0.99, index,
+                              lambda doc_id: frozenset())
+    assert aliases == {2: 1, 4: 3}
+
+
+def test_find_duplicates_keeps_documents_with_other_numbers():
+    ids = np.array([1, 2], dtype='int64')
+    aliases = find_duplicates(ids, _vectors([1, 0], [1, 0]), [frozenset({'2566'}), frozenset({'2567'})], 0.99)
+    assert aliases == {}
+
+
+def test_find_duplicates_does_not_chain():
+    ids = np.array([1, 2, 3], dtype='int64')
+    step = np.deg2rad(5)
+    rows = _vectors([1, 0], [np.cos(step), np.sin(step)], [np.cos(2 * step), np.sin(2 * step)])
+    aliases = find_duplicates(ids, rows, [frozenset()] * 3, float(np.cos(step * 1.5)))
+    assert aliases == {2: 1}
+
+
+def test_duplicate_documents_share_one_index_entry(encoder, write_json, tmp_path):
+    write_json(tmp_path / 'data' / 'a.json', FEES)
+    write_json(tmp_path / 'data' / 'b.json', COPY)
+    rag = RAGSystem(index_dir=str(tmp_path / 'index'), dedupe_threshold=0.97)
+    assert rag.load_documents(str(tmp_path / 'data'))
+    assert len(rag.documents) == 3
+    assert rag.index.ntotal == 2
+    assert rag.get_stats()['compaction'] == compaction_stats(3, 1)
+
+
+def test_alias_takes_over_when_canonical_is_deleted(encoder, write_json, tmp_path):
+    write_json(tmp_path / 'data' / 'a.json', FEES)
+    write_json(tmp_path / 'data' / 'b.json', COPY)
+    rag = RAGSystem(index_dir=str(tmp_path / 'index'), dedupe_threshold=0.97)
+    assert rag.load_documents(str(tmp_path / 'data'))
+
+    os.remove(tmp_path / 'data' / 'a.json')
+    assert rag.reload()['removed'] == ['a.json']
+    assert rag.index.ntotal == 1
+    assert rag.snapshot.aliases == {}
+    result = rag.search('ค่าเทอมเท่าไร', k=1)[0]
+    assert result['source'] == 'b.json'
+
+
+def test_threshold_change_regroups_from_stored_embeddings(encoder, write_json, tmp_path):
+    write_json(tmp_path / 'data' / 'a.json', FEES)
+    write_json(tmp_path / 'data' / 'b.json', COPY)
+    index_dir = str(tmp_path / 'index')
+    assert RAGSystem(index_dir=index_dir).load_documents(str(tmp_path / 'data'))
+
+    start = len(encoder.calls)
+    compacted = RAGSystem(index_dir=index_dir, dedupe_threshold=0.97)
+    assert compacted.load_documents(str(tmp_path / 'data'))
+    assert encoder.calls[start:] == []
+    assert compacted.index.ntotal == 2
+
+    restarted = RAGSystem(index_dir=index_dir, dedupe_threshold=0.97)
+    assert restarted.load_documents(str(tmp_path / 'data'))
+    assert restarted.index.ntotal == 2 and len(restarted.snapshot.aliases) == 1
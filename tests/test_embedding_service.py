@@ -0,0 +1,74 @@
+import threading
+import time
+
+import pytest
+
+from embedding_service import MicroBatcher
+
+
+def test_concurrent_calls_share_a_batch():
+    sizes = []
+
+    def double(items):
+        sizes.append(len(items))
+        return [item * 2 for item in items]
+
+    batcher = MicroBatcher(double, max_batch_size=8, max_wait_ms=50)
+    results = {}
+    threads = [threading.Thread(target=lambda i=i: results.__setitem__(i, batcher.submit(i))) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == {i: i * 2 for i in range(8)}
+    assert len(sizes) < 8 and sum(sizes) == 8
+
+
+def test_errors_reach_every_caller():
+    def fail(items):
+        raise KeyError('broken')
+
+    batcher = MicroBatcher(fail, max_wait_ms=0)
+    with pytest.raises(KeyError):
+        batcher.submit(1, timeout=1)
+
+    batcher = MicroBatcher(lambda items: [], max_wait_ms=0)
+    with pytest.raises(ValueError):
+        batcher.submit(1, timeout=1)
+
+
+def test_timed_out_item_is_dropped_from_its_batch():
+    release = threading.Event()
+    seen = []
+
+    def slow(items):
+        seen.extend(items)
+        release.wait(1)
+        return items
+
+    batcher = MicroBatcher(slow, max_wait_ms=0)
+    worker = threading.Thread(target=batcher.submit, args=('first',))
+    worker.start()
+    while not seen:
+        time.sleep(0.001)
+    with pytest.raises(TimeoutError):
+        batcher.submit('late', timeout=0.05)
+    release.set()
+    worker.join()
+    assert batcher.submit('next', timeout=1) == 'next'
+    assert seen == ['first', 'next']
+
+
+@pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning')
+def test_dead_batch_thread_is_restarted():
+    def stop_on_exit(items):
+        if 'exit' in items:
+            raise SystemExit
+        return items
+
+    batcher = MicroBatcher(stop_on_exit, max_wait_ms=0)
+    with pytest.raises(RuntimeError):
+        batcher.submit('exit', timeout=1)
+    batcher._thread.join(1)
+    assert batcher.submit('again', timeout=1) == 'again'
+    assert batcher.get_stats()['restarts'] == 1
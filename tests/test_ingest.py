@@ -0,0 +1,79 @@
+import io
+import json
+import os
+
+import pytest
+
+import rag
+from ingest import _iter_json_array
+from rag import MANIFEST_FILE, RAGSystem
+
+FIRST = [{'question': 'สมัครเรียนได้ที่ไหน', 'answer': 'สมัครผ่านเว็บไซต์'},
+         {'question': 'ค่าเทอมเท่าไร', 'answer': 'ภาคละ 15,000 บาท'}]
+SECOND = [{'question': 'หอพักมีไหม', 'answer': 'มีหอพักในมหาวิทยาลัย'}]
+
+
+def _manifest(index_dir):
+    with open(os.path.join(index_dir, MANIFEST_FILE), encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _generations(index_dir):
+    return sorted(name for name in os.listdir(index_dir) if name.startswith('gen-'))
+
+
+def test_iter_json_array_caps_record_size():
+    items = _iter_json_array(io.StringIO('[{"a": 1}, {"b": "' + 'x' * 1000), chunk_size=64, max_record_size=256)
+    assert next(items) == {'a': 1}
+    with pytest.raises(ValueError):
+        next(items)
+
+
+def test_iter_json_array_reads_records_across_chunks():
+    text = json.dumps([{'question': 'q' * 100, 'answer': str(i)} for i in range(5)])
+    assert len(list(_iter_json_array(io.StringIO(text), chunk_size=16, max_record_size=256))) == 5
+
+
+def test_ingest_publishes_a_new_generation(encoder, write_json, tmp_path):
+    data = tmp_path / 'data'
+    index_dir = str(tmp_path / 'index')
+    write_json(data / 'faq.json', FIRST)
+    writer = RAGSystem(index_dir=index_dir)
+    assert writer.ingest(str(data))['documents'] == 2
+    reader = RAGSystem(index_dir=index_dir, read_only=True)
+    assert reader.load_documents(str(data))
+    first_generation = _manifest(index_dir)['data_dir']
+
+    write_json(data / 'faq.json', SECOND)
+    assert writer.ingest(str(data))['documents'] == 1
+    assert _manifest(index_dir)['data_dir'] != first_generation
+    # worker ที่ยังไม่ reload อ่าน generation เดิมได้ครบ
+    assert sorted(doc['question'] for doc in reader.documents.values()) == sorted(d['question'] for d in FIRST)
+
+    assert reader.reload() is not None
+    assert [doc['question'] for doc in reader.documents.values()] == ['หอพักมีไหม']
+    writer.ingest(str(data))
+    assert len(_generations(index_dir)) == 2
+
+
+def test_failed_ingest_leaves_published_artifact(encoder, write_json, tmp_path, monkeypatch):
+    data = tmp_path / 'data'
+    index_dir = str(tmp_path / 'index')
+    write_json(data / 'faq.json', FIRST)
+    writer = RAGSystem(index_dir=index_dir, index_type='ivf_flat')
+    assert writer.ingest(str(data)) is not None
+    manifest = _manifest(index_dir)
+
+    def fail(*args, **kwargs):
+        raise RuntimeError('training failed')
+
+    monkeypatch.setattr(rag, 'build_index', fail)
+    write_json(data / 'faq.json', SECOND)
+    assert writer.ingest(str(data)) is None
+    assert _manifest(index_dir) == manifest
+    assert _generations(index_dir) == [manifest['data_dir']]
+    assert len(writer.documents) == 2
+
+    reader = RAGSystem(index_dir=index_dir, read_only=True)
+    assert reader.load_documents(str(data))
+    assert len(reader.documents) == 2
@@ -0,0 +1,26 @@
+from lexical import LexicalIndex, normalize_text
+
+DOCUMENTS = {
+    1: {'question': 'ค่าธรรมเนียมการศึกษาปี 2566 เท่าไร', 'answer': 'ภาคการศึกษาละ 15,000 บาท'},
+    2: {'question': 'สมัครเรียนได้ที่ไหน', 'answer': 'สมัครผ่านเว็บไซต์ของมหาวิทยาลัย'},
+}
+
+
+def test_match_question_requires_same_numbers():
+    index = LexicalIndex(DOCUMENTS)
+    assert index.match_question('ค่าธรรมเนียมการศึกษาปี 2566 เท่าไร') == 1
+    assert index.match_question('ค่าธรรมเนียมการศึกษาปี 2567 เท่าไร') is None
+    assert index.match_question('ค่าธรรมเนียมการศึกษาปี 2566 เท่าไหร่') == 1
+
+
+def test_match_question_without_numbers_skips_numbered_questions():
+    index = LexicalIndex(DOCUMENTS)
+    assert index.match_question('ค่าธรรมเนียมการศึกษาปี เท่าไร') is None
+    assert index.match_question('สมัครเรียนได้ที่ไหนคะ') == 2
+
+
+def test_normalize_text_keeps_words_ending_in_particle_letters():
+    assert normalize_text('ใครชนะ') == 'ใครชนะ'
+    assert normalize_text('ใครชนะ ครับ') == 'ใครชนะ'
+    assert normalize_text('สมัครเรียนได้ที่ไหน นะคะ?') == 'สมัครเรียนได้ที่ไหน'
+    assert normalize_text('ครับ') == 'ครับ'
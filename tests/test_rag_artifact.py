@@ -0,0 +1,50 @@
+from rag import RAGSystem
+
+FAQ = [{'question': 'สมัครเรียนได้ที่ไหน', 'answer': 'สมัครผ่านเว็บไซต์'},
+       {'question': 'ค่าเทอมเท่าไร', 'answer': 'ภาคละ 15,000 บาท'}]
+DORM = [{'question': 'หอพักมีไหม', 'answer': 'มีหอพักในมหาวิทยาลัย'}]
+
+
+def _encoded(encoder, start=0):
+    return [text for call in encoder.calls[start:] for text in call]
+
+
+def test_unchanged_files_reuse_stored_embeddings(encoder, write_json, tmp_path):
+    write_json(tmp_path / 'data' / 'faq.json', FAQ)
+    write_json(tmp_path / 'data' / 'dorm.json', DORM)
+    index_dir = str(tmp_path / 'index')
+    assert RAGSystem(index_dir=index_dir).load_documents(str(tmp_path / 'data'))
+    assert len(_encoded(encoder)) == 3
+
+    start = len(encoder.calls)
+    restarted = RAGSystem(index_dir=index_dir)
+    assert restarted.load_documents(str(tmp_path / 'data'))
+    assert _encoded(encoder, start) == []
+    assert len(restarted.documents) == 3
+    assert restarted.index.ntotal == 3
+
+
+def test_only_changed_file_is_encoded_again(encoder, write_json, tmp_path):
+    write_json(tmp_path / 'data' / 'faq.json', FAQ)
+    write_json(tmp_path / 'data' / 'dorm.json', DORM)
+    index_dir = str(tmp_path / 'index')
+    assert RAGSystem(index_dir=index_dir).load_documents(str(tmp_path / 'data'))
+
+    write_json(tmp_path / 'data' / 'dorm.json', [{'question': 'หอพักราคาเท่าไร', 'answer': 'เดือนละ 3,000 บาท'}])
+    start = len(encoder.calls)
+    restarted = RAGSystem(index_dir=index_dir)
+    assert restarted.load_documents(str(tmp_path / 'data'))
+    assert _encoded(encoder, start) == ['หอพักราคาเท่าไร เดือนละ 3,000 บาท']
+    assert len(restarted.documents) == 3
+    assert restarted.search('หอพักราคาเท่าไร', k=1)[0]['question'] == 'หอพักราคาเท่าไร'
+
+
+def test_other_model_does_not_reuse_artifact(encoder, write_json, tmp_path):
+    write_json(tmp_path / 'data' / 'faq.json', FAQ)
+    index_dir = str(tmp_path / 'index')
+    assert RAGSystem(index_dir=index_dir).load_documents(str(tmp_path / 'data'))
+
+    start = len(encoder.calls)
+    assert RAGSystem(model_name='intfloat/multilingual-e5-small', index_dir=index_dir) \
+        .load_documents(str(tmp_path / 'data'))
+    assert len(_encoded(encoder, start)) == 2
@@ -0,0 +1,61 @@
+import os
+
+from rag import RAGSystem
+
+FAQ = [{'question': 'สมัครเรียนได้ที่ไหน', 'answer': 'สมัครผ่านเว็บไซต์'},
+       {'question': 'ค่าเทอมเท่าไร', 'answer': 'ภาคละ 15,000 บาท'}]
+DORM = [{'question': 'หอพักมีไหม', 'answer': 'มีหอพักในมหาวิทยาลัย'}]
+BUS = [{'question': 'มีรถรับส่งไหม', 'answer': 'มีรถรับส่งทุกชั่วโมง'}]
+
+
+def _questions(rag):
+    return sorted(doc['question'] for doc in rag.documents.values())
+
+
+def _loaded(write_json, tmp_path):
+    write_json(tmp_path / 'data' / 'faq.json', FAQ)
+    write_json(tmp_path / 'data' / 'dorm.json', DORM)
+    rag = RAGSystem(index_dir=str(tmp_path / 'index'))
+    assert rag.load_documents(str(tmp_path / 'data'))
+    return rag
+
+
+def test_reload_adds_new_file(encoder, write_json, tmp_path):
+    rag = _loaded(write_json, tmp_path)
+    write_json(tmp_path / 'data' / 'bus.json', BUS)
+    start = len(encoder.calls)
+    summary = rag.reload()
+    assert summary['added'] == ['bus.json'] and summary['changed'] == [] and summary['removed'] == []
+    assert [text for call in encoder.calls[start:] for text in call] == ['มีรถรับส่งไหม มีรถรับส่งทุกชั่วโมง']
+    assert rag.search('มีรถรับส่งไหม', k=1)[0]['question'] == 'มีรถรับส่งไหม'
+    assert rag.index.ntotal == 4
+
+
+def test_reload_replaces_changed_file(encoder, write_json, tmp_path):
+    rag = _loaded(write_json, tmp_path)
+    write_json(tmp_path / 'data' / 'dorm.json', BUS)
+    summary = rag.reload()
+    assert summary['changed'] == ['dorm.json']
+    assert _questions(rag) == ['ค่าเทอมเท่าไร', 'มีรถรับส่งไหม', 'สมัครเรียนได้ที่ไหน']
+    assert rag.index.ntotal == 3
+
+
+def test_reload_removes_deleted_file(encoder, write_json, tmp_path):
+    rag = _loaded(write_json, tmp_path)
+    os.remove(tmp_path / 'data' / 'faq.json')
+    summary = rag.reload()
+    assert summary['removed'] == ['faq.json']
+    assert _questions(rag) == ['หอพักมีไหม']
+    assert rag.index.ntotal == 1
+    assert all(result['question'] == 'หอพักมีไหม' for result in rag.search('สมัครเรียนได้ที่ไหน', k=3))
+
+
+def test_reload_without_changes_keeps_snapshot(encoder, write_json, tmp_path):
+    rag = _loaded(write_json, tmp_path)
+    index = rag.index
+    os.utime(tmp_path / 'data' / 'faq.json')
+    start = len(encoder.calls)
+    summary = rag.reload()
+    assert summary['added'] == summary['changed'] == summary['removed'] == []
+    assert rag.index is index
+    assert encoder.calls[start:] == []
@@ -0,0 +1,60 @@
+import numpy as np
+
+import semantic_cache
+from semantic_cache import SemanticCache
+
+
+def _unit(*values):
+    vector = np.zeros(8, dtype='float32')
+    vector[:len(values)] = values
+    return vector / np.linalg.norm(vector)
+
+
+def test_lookup_needs_similar_query_and_same_documents():
+    cache = SemanticCache(threshold=0.95)
+    cache.store(_unit(1, 0), [1, 2], 'ตอบ', version=1)
+    assert cache.lookup(_unit(1, 0.1), [1, 2], version=1) == 'ตอบ'
+    assert cache.lookup(_unit(1, 0.1), [1, 3], version=1) is None
+    assert cache.lookup(_unit(0, 1), [1, 2], version=1) is None
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = SemanticCache(max_entries=2)
+    cache.store(_unit(1), [1], 'a')
+    cache.store(_unit(0, 1), [2], 'b')
+    assert cache.lookup(_unit(1), [1]) == 'a'
+    cache.store(_unit(0, 0, 1), [3], 'c')
+    assert cache.lookup(_unit(0, 1), [2]) is None
+    assert cache.lookup(_unit(1), [1]) == 'a'
+    assert cache.lookup(_unit(0, 0, 1), [3]) == 'c'
+    assert cache.get_stats()['evictions'] == 1
+
+
+def test_byte_budget_covers_matrix_and_answers():
+    cache = SemanticCache(max_entries=1000, max_bytes=2048)
+    for i in range(50):
+        cache.store(_unit(1, i), [i], 'x' * 100)
+    stats = cache.get_stats()
+    assert 0 < stats['size'] < 50
+    assert stats['bytes'] <= 2048
+    assert cache.lookup(_unit(1, 49), [49]) == 'x' * 100
+
+
+def test_corpus_version_change_drops_entries():
+    cache = SemanticCache()
+    cache.store(_unit(1), [1], 'เก่า', version=1)
+    assert cache.lookup(_unit(1), [1], version=2) is None
+    stats = cache.get_stats()
+    assert stats['size'] == 0 and stats['invalidations'] == 1
+    cache.store(_unit(1), [1], 'ใหม่', version=2)
+    assert cache.lookup(_unit(1), [1], version=2) == 'ใหม่'
+
+
+def test_expired_entry_is_not_served(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(semantic_cache.time, 'time', lambda: now[0])
+    cache = SemanticCache(ttl=60)
+    cache.store(_unit(1), [1], 'ตอบ')
+    now[0] += 61
+    assert cache.lookup(_unit(1), [1]) is None
+    assert cache.get_stats()['expired'] == 1
@@ -0,0 +1,35 @@
+import os
+
+import faiss
+import numpy as np
+import pytest
+
+from index_factory import read_index
+
+
+def _anon_rss_bytes():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('RssAnon:'):
+                return int(line.split()[1]) * 1024
+    pytest.skip('RssAnon is not reported')
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/status'), reason='needs /proc')
+def test_mmap_flat_index_stays_out_of_process_heap(tmp_path):
+    dimension, count = 256, 40000
+    index = faiss.IndexIDMap2(faiss.IndexFlatIP(dimension))
+    vectors = np.random.RandomState(0).rand(count, dimension).astype('float32')
+    index.add_with_ids(vectors, np.arange(count, dtype='int64'))
+    path = str(tmp_path / 'index.faiss')
+    faiss.write_index(index, path)
+    del index, vectors
+
+    before = _anon_rss_bytes()
+    mapped = read_index(path, mmap=True)
+    grown = _anon_rss_bytes() - before
+
+    assert mapped.ntotal == count
+    assert grown < os.path.getsize(path) // 4
+    scores, ids = mapped.search(np.ones((1, dimension), dtype='float32'), 3)
+    assert len(ids[0]) == 3
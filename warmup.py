@@ -0,0 +1,112 @@
+import time
+import logging
+import threading
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class WarmUp:
+    """Start-up warm-up steps whose outcome is kept for readiness checks
+
+    Steps run in parallel, each on its own thread, so a slow model load does
+    not hold up the others; a step that needs another (the intent
+    classifier needs the encoder) simply blocks on it, and its timing
+    includes that wait. The service is ready once every ``required`` step
+    has succeeded and every optional step has finished either way. Failed
+    steps are retried every ``retry_interval`` seconds. :meth:`get_status`
+    only reads the recorded state, so a load balancer may poll it freely.
+    """
+
+    def __init__(self, retry_interval: float = 30.0):
+        self.retry_interval = retry_interval
+        self._steps = []  # (name, fn, required) ตามลำดับที่เพิ่ม
+        self._state = {}  # name -> {'status', 'required', 'seconds', 'error', 'attempts'}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.started_at = None
+        self.ready_at = None
+
+    def add(self, name: str, fn: Callable[[], object], required: bool = True):
+        """Register ``fn``; it fails by raising or returning False"""
+        self._steps.append((name, fn, required))
+        self._state[name] = {'status': 'pending', 'required': required, 'seconds': None, 'error': None,
+                             'attempts': 0}
+
+    @property
+    def ready(self) -> bool:
+        with self._lock:
+            return self._is_ready()
+
+    def _is_ready(self) -> bool:
+        # step ที่ไม่จำเป็นนับว่าพร้อมเมื่อรันจบไปแล้วอย่างน้อยหนึ่งครั้ง แม้กำลังลองใหม่อยู่
+        return all(state['status'] == 'ok' if state['required'] else state['seconds'] is not None
+                   for state in self._state.values())
+
+    def _run_step(self, name: str, fn: Callable[[], object]):
+        with self._lock:
+            self._state[name]['status'] = 'running'
+            self._state[name]['attempts'] += 1
+        start = time.perf_counter()
+        error = None
+        try:
+            if fn() is False:
+                error = 'returned False'
+        except Exception as e:
+            error = str(e)
+        seconds = time.perf_counter() - start
+        with self._lock:
+            self._state[name].update(status='failed' if error else 'ok', seconds=seconds, error=error)
+            if self.ready_at is None and self._is_ready():
+                self.ready_at = time.time()
+        if error:
+            logger.error(f"Warm-up of {name} failed after {seconds:.1f}s: {error}")
+        else:
+            logger.info(f"Warmed up {name} in {seconds:.1f}s")
+
+    def run(self, names: Optional[List[str]] = None) -> bool:
+        """Run the given steps (default: all) concurrently and wait for them; returns :attr:`ready`"""
+        if self.started_at is None:
+            self.started_at = time.time()
+        threads = [threading.Thread(target=self._run_step, args=(name, fn), name=f"warmup-{name}", daemon=True)
+                   for name, fn, _ in self._steps if names is None or name in names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.ready
+
+    def _run_until_warm(self):
+        with self._lock:
+            pending = [name for name, state in self._state.items() if state['status'] == 'pending']
+        if pending:
+            self.run(pending)
+        while True:
+            with self._lock:
+                failed = [name for name, state in self._state.items() if state['status'] == 'failed']
+            if not failed:
+                return
+            time.sleep(self.retry_interval)
+            self.run(failed)
+
+    def start(self) -> threading.Thread:
+        """Warm up in a background thread, retrying failed steps until all succeed
+
+        Steps already run by :meth:`run` are not run again unless they failed.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run_until_warm, name="warmup", daemon=True)
+            self._thread.start()
+        return self._thread
+
+    def get_status(self) -> Dict:
+        with self._lock:
+            components = {name: dict(state) for name, state in self._state.items()}
+            ready = self._is_ready()
+        return {
+            'ready': ready,
+            'started_at': self.started_at,
+            'ready_after_seconds': self.ready_at - self.started_at if ready and self.ready_at and self.started_at
+            else None,
+            'components': components
+        }
@@ -0,0 +1,61 @@
+import logging
+import queue
+import threading
+import zlib
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class KeyedWorkerPool:
+    """Bounded thread pool that keeps tasks with the same key in order
+
+    Each key is pinned to one worker queue, so tasks for one LINE user run
+    one after another while different users are handled in parallel.
+    """
+
+    def __init__(self, num_workers: int = 4, max_queue_size: int = 100, name: str = "worker"):
+        self.num_workers = max(1, num_workers)
+        self._queues = [queue.Queue(maxsize=max_queue_size) for _ in range(self.num_workers)]
+        self._threads = []
+        for i, task_queue in enumerate(self._queues):
+            thread = threading.Thread(target=self._run, args=(task_queue,), name=f"{name}-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Started {self.num_workers} workers (queue size {max_queue_size})")
+
+    def _queue_for(self, key) -> queue.Queue:
+        # ใช้ crc32 แทน hash() เพื่อให้ผลคงที่และกระจายคีย์สม่ำเสมอ
+        return self._queues[zlib.crc32(str(key).encode('utf-8')) % self.num_workers]
+
+    def submit(self, key, func, *args, **kwargs) -> bool:
+        """Queue ``func`` for the worker owning ``key``; False if that queue is full"""
+        try:
+            self._queue_for(key).put_nowait((func, args, kwargs))
+            return True
+        except queue.Full:
+            return False
+
+    def qsize(self) -> int:
+        return sum(task_queue.qsize() for task_queue in self._queues)
+
+    def shutdown(self, wait: bool = True):
+        for task_queue in self._queues:
+            task_queue.put(_STOP)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _run(self, task_queue: queue.Queue):
+        while True:
+            task = task_queue.get()
+            try:
+                if task is _STOP:
+                    return
+                func, args, kwargs = task
+                func(*args, **kwargs)
+            except Exception as e:
+                logger.error(f"Error in worker task: {str(e)}")
+            finally:
+                task_queue.task_done()